@@ -0,0 +1,73 @@
+"""
+Benchmark memory of chat members in the chat object cache, with a
+synthetic cache of group chats from a slave channel.
+
+Members are measured as converted from slave channel chats, and as
+decoded from the database or the snapshot of the cache, against members
+of slave channel chats.
+
+Usage::
+
+    python -m benchmarks.chat_members [--members N] [--group-size N]
+"""
+
+import argparse
+import gc
+import tracemalloc
+from typing import Callable, List, Tuple, Any
+
+from ehforwarderbot.chat import GroupChat
+
+from efb_telegram_master.chat import convert_chat, encode_chat, unpickle
+
+
+def make_groups(members: int, group_size: int) -> List[GroupChat]:
+    groups = []
+    for group_idx in range(0, members, group_size):
+        group = GroupChat(module_id="bench.slave", module_name="Bench Slave", channel_emoji="🧪",
+                          name=f"Group {group_idx}", uid=f"group_{group_idx}")
+        for i in range(group_idx, min(members, group_idx + group_size)):
+            group.add_member(name=f"Member {i}", uid=f"member_{i}", alias=f"Alias {i}" if i % 3 == 0 else None)
+        groups.append(group)
+    return groups
+
+
+def measure(build: Callable[[], Any]) -> Tuple[Any, int]:
+    """Return the object built, and bytes allocated to build it."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def run(members: int, group_size: int) -> List[Tuple[str, int]]:
+    results = []
+    groups, size = measure(lambda: make_groups(members, group_size))
+    results.append(("slave channel chats", size))
+    chats, size = measure(lambda: [convert_chat(None, i) for i in groups])
+    results.append(("converted", size))
+    encoded = [encode_chat(i) for i in chats]
+    del chats
+    chats, size = measure(lambda: [unpickle(i, None) for i in encoded])
+    results.append(("decoded", size))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=50000, help="Number of members in total.")
+    parser.add_argument("--group-size", type=int, default=500, help="Number of members in each group.")
+    args = parser.parse_args()
+
+    print(f"{'chats':<20} {'total (KiB)':>12} {'per member (B)':>15}")
+    for name, size in run(args.members, args.group_size):
+        print(f"{name:<20} {size / 1024:>12.0f} {size / args.members:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark throughput and latency of ``DatabaseManager`` lookups while
+message logs are written concurrently, with SQLite default pragmas, with
+tuned pragmas, and with tuned pragmas and the read-only connection pool.
+
+Usage::
+
+    python -m benchmarks.db_concurrency [--rows N] [--readers N] [--writers N] [--seconds S]
+
+The message log cache is disabled so that every lookup hits the database.
+"""
+
+import argparse
+import datetime
+import random
+import threading
+import time
+from typing import Any, Dict, List
+
+from peewee import SqliteDatabase
+
+from efb_telegram_master.db import database, DatabaseManager
+from .db_lookup import CHATS, MODELS, chat_uid, populate
+from .helpers import database_manager
+
+CONFIGS: Dict[str, Dict[str, Any]] = {
+    "default pragmas": {
+        "database_pragmas": {"synchronous": "full", "cache_size": -2000, "mmap_size": 0, "temp_store": "default"},
+        "database_read_connections": 0,
+    },
+    "tuned pragmas": {"database_read_connections": 0},
+    "tuned pragmas + read pool": {},
+}
+
+
+def reader(manager: DatabaseManager, rows: int, stop: threading.Event, latencies: List[float]):
+    while not stop.is_set():
+        i = random.randrange(rows)
+        start = time.perf_counter()
+        if i % 2:
+            manager.get_msg_log(slave_msg_id=f"msg_{i}", slave_origin_uid=chat_uid(i % CHATS))
+        else:
+            manager.get_recent_slave_chats(-1000000 - i % CHATS)
+        latencies.append(time.perf_counter() - start)
+
+
+def writer(manager: DatabaseManager, offset: int, stop: threading.Event, latencies: List[float]):
+    i = offset
+    while not stop.is_set():
+        row = {"master_msg_id": f"{-1000000 - i % CHATS}.{i}", "master_msg_id_alt": None,
+               "master_chat_id": -1000000 - i % CHATS, "master_message_id": i,
+               "slave_message_id": f"msg_{i}", "text": f"Message {i}",
+               "slave_origin_uid": chat_uid(i % CHATS), "slave_member_uid": chat_uid(i % CHATS),
+               "msg_type": "Text", "sent_to": "blueset.telegram", "media_type": "Text",
+               "file_id": None, "file_unique_id": None, "mime": None, "pickle": None,
+               "target_msg_id": None, "time": datetime.datetime.now()}
+        start = time.perf_counter()
+        manager._write_message_logs([row])
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def run(flags: Dict[str, Any], args: argparse.Namespace) -> Dict[str, float]:
+    with database_manager({"message_log_cache_size": 0, "database_maintenance_interval": 0, **flags}) as manager:
+        db = SqliteDatabase(database.database, pragmas={"journal_mode": "wal"})
+        with db.bind_ctx(MODELS):
+            populate(db, args.rows)
+        db.close()
+
+        stop = threading.Event()
+        read_latencies: List[List[float]] = [[] for _ in range(args.readers)]
+        write_latencies: List[List[float]] = [[] for _ in range(args.writers)]
+        threads = [threading.Thread(target=reader, args=(manager, args.rows, stop, i)) for i in read_latencies]
+        threads += [threading.Thread(target=writer, args=(manager, args.rows + idx * 10_000_000, stop, i))
+                    for idx, i in enumerate(write_latencies)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    reads = [j for i in read_latencies for j in i]
+    writes = [j for i in write_latencies for j in i]
+    return {
+        "reads/s": len(reads) / args.seconds,
+        "read p50 (ms)": percentile(reads, 0.5) * 1e3,
+        "read p99 (ms)": percentile(reads, 0.99) * 1e3,
+        "writes/s": len(writes) / args.seconds,
+        "write p99 (ms)": percentile(writes, 0.99) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="Number of message logs to populate.")
+    parser.add_argument("--readers", type=int, default=8, help="Number of reader threads.")
+    parser.add_argument("--writers", type=int, default=2, help="Number of writer threads.")
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of each run.")
+    args = parser.parse_args()
+
+    print(f"{'configuration':<28}" + "".join(f"{i:>16}" for i in ("reads/s", "read p50 (ms)", "read p99 (ms)",
+                                                                   "writes/s", "write p99 (ms)")))
+    for name, flags in CONFIGS.items():
+        result = run(flags, args)
+        print(f"{name:<28}" + "".join(f"{i:>16.2f}" for i in result.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark lookup latency of ``DatabaseManager`` queries on message logs of
+different sizes, with and without the indexes added in migration 4, and
+the integer Telegram chat ID column added in migration 6.
+
+Usage::
+
+    python -m benchmarks.db_lookup [ROWS ...] [--lookups N]
+
+Rows default to 10k, 1M and 5M. Databases are created in a temporary
+directory and removed afterwards.
+"""
+
+import argparse
+import datetime
+import random
+import time
+from typing import Callable, Dict, List
+
+from peewee import SqliteDatabase
+
+from efb_telegram_master.db import ChatAssoc, MsgLog, SlaveChatInfo, database
+from .helpers import database_manager
+
+MODELS = [ChatAssoc, MsgLog, SlaveChatInfo]
+CHATS = 2000
+"""Number of distinct slave chats messages are spread across."""
+BATCH_SIZE = 5000
+
+
+def chat_uid(idx: int) -> str:
+    return f"bench.slave chat_{idx}"
+
+
+def populate(db: SqliteDatabase, rows: int):
+    """Fill the database with ``rows`` message logs and one chat
+    association and chat info per chat.
+    """
+    start = datetime.datetime(2020, 1, 1)
+    with db.atomic():
+        ChatAssoc.insert_many(
+            {"master_uid": f"blueset.telegram {-1000000 - i}", "slave_uid": chat_uid(i)}
+            for i in range(CHATS)
+        ).execute()
+        SlaveChatInfo.insert_many(
+            {"slave_channel_id": "bench.slave", "slave_channel_emoji": "B",
+             "slave_chat_uid": f"chat_{i}", "slave_chat_name": f"Chat {i}",
+             "slave_chat_type": "Private"}
+            for i in range(CHATS)
+        ).execute()
+    for offset in range(0, rows, BATCH_SIZE):
+        batch = [
+            {"master_msg_id": f"{-1000000 - i % CHATS}.{i}",
+             "master_chat_id": -1000000 - i % CHATS,
+             "master_message_id": i,
+             "slave_message_id": f"msg_{i}",
+             "text": f"Message {i}",
+             "slave_origin_uid": chat_uid(i % CHATS),
+             "slave_member_uid": chat_uid(i % CHATS),
+             "msg_type": "Text",
+             "sent_to": "blueset.telegram",
+             "time": start + datetime.timedelta(seconds=i)}
+            for i in range(offset, min(offset + BATCH_SIZE, rows))
+        ]
+        with db.atomic():
+            MsgLog.insert_many(batch).execute()
+
+
+def drop_indexes(db: SqliteDatabase):
+    for model in MODELS:
+        for index in db.get_indexes(model._meta.table_name):
+            if not index.name.startswith("sqlite_autoindex"):
+                db.execute_sql(f'DROP INDEX "{index.name}"')
+
+
+def measure(fn: Callable[[int], object], lookups: int, rows: int) -> float:
+    """Return average latency in microseconds."""
+    keys = [random.randrange(rows) for _ in range(lookups)]
+    begin = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - begin) / lookups * 1e6
+
+
+def run(rows: int, lookups: int) -> Dict[str, List[float]]:
+    with database_manager() as manager:
+        queries: Dict[str, Callable[[int], object]] = {
+            "get_msg_log(slave_msg_id)": lambda i: manager.get_msg_log(
+                slave_msg_id=f"msg_{i}", slave_origin_uid=chat_uid(i % CHATS)),
+            "get_last_message": lambda i: manager.get_last_message(chat_uid(i % CHATS)),
+            "get_chat_assoc(master_uid)": lambda i: manager.get_chat_assoc(
+                master_uid=f"blueset.telegram {-1000000 - i % CHATS}"),
+            "get_chat_assoc(slave_uid)": lambda i: manager.get_chat_assoc(slave_uid=chat_uid(i % CHATS)),
+            "get_slave_chat_info": lambda i: manager.get_slave_chat_info(
+                "bench.slave", f"chat_{i % CHATS}"),
+            "get_recent_slave_chats": lambda i: manager.get_recent_slave_chats(-1000000 - i % CHATS),
+        }
+        results: Dict[str, List[float]] = {k: [] for k in queries}
+        # Populate and query through a synchronous connection to the same
+        # database, as bulk inserts and transactions are not supported by
+        # the write queue.
+        db = SqliteDatabase(database.database, pragmas={"journal_mode": "wal"})
+        with db.bind_ctx(MODELS):
+            populate(db, rows)
+            for name, fn in queries.items():
+                results[name].append(measure(fn, lookups, rows))
+            drop_indexes(db)
+            # Look up recent chats with prefix scan as before migration 6.
+            manager.pending_backfills.add(6)
+            for name, fn in queries.items():
+                # Full table scans are slow, do not wait for too long
+                results[name].insert(0, measure(fn, max(1, lookups // 100), rows))
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("rows", nargs="*", type=int, default=[10_000, 1_000_000, 5_000_000],
+                        help="Number of message log rows to benchmark against.")
+    parser.add_argument("--lookups", type=int, default=1000,
+                        help="Number of lookups per query with indexes.")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}  {'query':<28} {'before (µs)':>14} {'after (µs)':>12} {'speedup':>9}")
+    for rows in args.rows:
+        for name, (before, after) in run(rows, args.lookups).items():
+            print(f"{rows:>10}  {name:<28} {before:>14.1f} {after:>12.1f} {before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from ehforwarderbot.types import ModuleID
+from efb_telegram_master.db import DatabaseManager, database
+from efb_telegram_master.utils import ExperimentalFlagsManager
+
+
+class BenchmarkChannel:
+    """Minimal stand-in of ``TelegramChannel`` required by ``DatabaseManager``."""
+
+    channel_id = ModuleID("blueset.telegram")
+
+    def __init__(self, flags: Optional[Dict[str, Any]] = None):
+        self.config = {"flags": flags or {}}
+        self.flag = ExperimentalFlagsManager(self)
+
+
+@contextmanager
+def database_manager(flags: Optional[Dict[str, Any]] = None) -> Iterator[DatabaseManager]:
+    """Create a database manager with a new database in a temporary directory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["EFB_DATA_PATH"] = tmp
+        db = DatabaseManager(BenchmarkChannel(flags))
+        try:
+            yield db
+        finally:
+            db.stop_worker()
+            database.close()
@@ -0,0 +1,84 @@
+"""
+Benchmark size and decode time of the versioned encoding of miscellaneous
+message data and chat objects, against pickle used before migration 8.
+
+Usage::
+
+    python -m benchmarks.serialization [--members N ...] [--repeat N]
+"""
+
+import argparse
+import pickle
+import timeit
+from typing import Any, Callable, Dict, List, Tuple
+
+from ehforwarderbot.message import LinkAttribute, MessageCommands, MessageCommand
+
+from efb_telegram_master import serialization
+from efb_telegram_master.chat import ETMPrivateChat, ETMGroupChat, encode_chat, unpickle, ETMChatType
+
+
+def make_misc_msg() -> Dict[str, Any]:
+    return {
+        "target": "-1001234567890.12345",
+        "attributes": LinkAttribute(title="Link title", description="Description of the link",
+                                    image="https://example.com/image.png", url="https://example.com/"),
+        "commands": MessageCommands([MessageCommand("Accept", "accept_friend", args=["user_1"]),
+                                     MessageCommand("Decline", "decline_friend", kwargs={"uid": "user_1"})]),
+        "substitutions": {(0, 5): "bench.slave user_1", (10, 15): "bench.slave user_2"},
+        "reactions": {"👍": ("bench.slave user_1", "bench.slave user_2")},
+    }
+
+
+def make_chat(members: int) -> ETMChatType:
+    if not members:
+        return ETMPrivateChat(None, module_id="bench.slave", module_name="Bench Slave", channel_emoji="🧪",
+                              name="Alice", alias="Alice A.", uid="alice", vendor_specific={"is_mp": False})
+    chat = ETMGroupChat(None, module_id="bench.slave", module_name="Bench Slave", channel_emoji="🧪",
+                        name="Group", uid="group")
+    for i in range(members):
+        chat.add_member(name=f"Member {i}", uid=f"member_{i}", alias=f"Alias {i}" if i % 3 == 0 else None)
+    return chat
+
+
+def measure(decode: Callable[[], Any], repeat: int) -> float:
+    """Return average decode time in microseconds."""
+    return timeit.timeit(decode, number=repeat) / repeat * 1e6
+
+
+def run(members: List[int], repeat: int) -> List[Tuple[str, int, int, float, float]]:
+    results = []
+    misc = make_misc_msg()
+    legacy, encoded = pickle.dumps(misc), serialization.encode_misc_msg(misc)
+    assert not serialization.is_pickle(encoded)
+    results.append(("misc message data", len(legacy), len(encoded),
+                    measure(lambda: serialization.decode_misc_msg(legacy), repeat),
+                    measure(lambda: serialization.decode_misc_msg(encoded), repeat)))
+    for count in members:
+        chat = make_chat(count)
+        legacy, encoded = pickle.dumps(chat), encode_chat(chat)
+        assert not serialization.is_pickle(encoded)
+        name = f"group, {count} members" if count else "private chat"
+        results.append((name, len(legacy), len(encoded),
+                        measure(lambda: unpickle(legacy, None), max(1, repeat // max(1, count))),
+                        measure(lambda: unpickle(encoded, None), max(1, repeat // max(1, count)))))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", nargs="*", type=int, default=[0, 10, 100, 1000],
+                        help="Number of members of group chats to benchmark, 0 for a private chat.")
+    parser.add_argument("--repeat", type=int, default=10000,
+                        help="Number of decodes per object.")
+    args = parser.parse_args()
+
+    print(f"{'object':<24} {'pickle (B)':>11} {'encoded (B)':>12} {'pickle (µs)':>12} {'encoded (µs)':>13} "
+          f"{'speedup':>8}")
+    for name, legacy_size, size, legacy_time, time in run(args.members, args.repeat):
+        print(f"{name:<24} {legacy_size:>11} {size:>12} {legacy_time:>12.1f} {time:>13.1f} "
+              f"{legacy_time / time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
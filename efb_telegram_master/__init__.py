@@ -36,9 +36,10 @@ from .chat_binding import ChatBindingManager
 from .chat_destination_cache import ChatDestinationCache
 from .chat_object_cache import ChatObjectCacheManager
 from .commands import CommandsManager
-from .db import DatabaseManager
+from .db import BaseDatabaseManager, create_database_manager
 from .master_message import MasterMessageProcessor
 from .message import ETMMsg
+from .message_search import MessageSearchManager
 from .rpc_utils import RPCUtilities
 from .slave_message import SlaveMessageProcessor
 from .utils import ExperimentalFlagsManager, EFBChannelChatIDStr, TelegramChatID, TelegramMessageID
@@ -121,12 +122,13 @@ class TelegramChannel(MasterChannel):
 
         # Initialize managers
         self.flag: ExperimentalFlagsManager = ExperimentalFlagsManager(self)
-        self.db: DatabaseManager = DatabaseManager(self)
+        self.db: BaseDatabaseManager = create_database_manager(self)
         self.chat_manager: ChatObjectCacheManager = ChatObjectCacheManager(self)
         self.chat_dest_cache: ChatDestinationCache = ChatDestinationCache(self.flag("send_to_last_chat"))
         self.bot_manager: TelegramBotManager = TelegramBotManager(self)
         self.commands: CommandsManager = CommandsManager(self)
         self.chat_binding: ChatBindingManager = ChatBindingManager(self)
+        self.message_search: MessageSearchManager = MessageSearchManager(self)
         self.slave_messages: SlaveMessageProcessor = SlaveMessageProcessor(self)
 
         if not self.flag('auto_locale'):
@@ -443,6 +445,8 @@ class TelegramChannel(MasterChannel):
                      "    Only works in singly linked group where the bot is an admin.\n"
                      "/rm\n"
                      "    Remove the quoted message from its remote chat.\n"
+                     "/search [keywords]\n"
+                     "    Search for messages in this chat.\n"
                      "/help\n"
                      "    Print this command list.")
         update.message.reply_text(txt)
@@ -583,6 +587,7 @@ class TelegramChannel(MasterChannel):
         self.rpc_utilities.shutdown()
         self.bot_manager.graceful_stop()
         self.master_messages.stop_worker()
+        self.chat_manager.stop_worker()
         self.db.stop_worker()
         self.logger.debug("%s (%s) gracefully stopped.", self.channel_name, self.channel_id)
 
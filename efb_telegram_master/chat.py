@@ -1,27 +1,26 @@
 import copy
-import pickle
-import time
 from abc import ABC
 from contextlib import suppress
 from datetime import datetime
-from typing import Optional, TYPE_CHECKING, Pattern, List, Dict, Any, Union, TypeVar, overload, MutableSequence
+from typing import Optional, TYPE_CHECKING, Pattern, List, Dict, Any, Union, TypeVar, overload, Set, \
+    Iterable, Mapping, cast
 
 from ehforwarderbot import Middleware, coordinator
 from ehforwarderbot.channel import SlaveChannel
 from ehforwarderbot.chat import ChatNotificationState, BaseChat, Chat, PrivateChat, ChatMember, SystemChatMember, \
     SelfChatMember, GroupChat, SystemChat
 from ehforwarderbot.types import ChatID, ModuleID
-from . import utils
+from . import utils, serialization
 from .constants import Emoji
 from .utils import EFBChannelChatIDStr
 
 if TYPE_CHECKING:
-    from .db import DatabaseManager
+    from .db import BaseDatabaseManager
 
 __all__ = ['ETMChatMember', 'ETMSelfChatMember', 'ETMSystemChatMember',
            'ETMPrivateChat', 'ETMSystemChat', 'ETMGroupChat',
-           'convert_chat', 'unpickle',
-           'ETMChatType', 'ETMBaseChatType']
+           'convert_chat', 'unpickle', 'encode_chat', 'decode_chat', 'chat_header',
+           'ETMChatType', 'ETMBaseChatType', 'MemberList']
 
 
 class ETMBaseChatMixin(BaseChat, ABC):  # lgtm [py/missing-equals]
@@ -30,7 +29,7 @@ class ETMBaseChatMixin(BaseChat, ABC):  # lgtm [py/missing-equals]
     chat_type_name = "BaseChat"
 
     # noinspection PyMissingConstructor
-    def __init__(self, db: 'DatabaseManager', *args, **kwargs):
+    def __init__(self, db: 'BaseDatabaseManager', *args, **kwargs):
         self.db = db
         super().__init__(*args, **kwargs)
 
@@ -39,7 +38,11 @@ class ETMBaseChatMixin(BaseChat, ABC):  # lgtm [py/missing-equals]
         self.db.delete_slave_chat_info(self.module_id, self.uid)
 
     def __getstate__(self) -> Dict[str, Any]:
-        state = self.__dict__.copy()
+        if isinstance(self, ETMChatMember):
+            # Reading ``__dict__`` of members would allocate it.
+            state = {k: getattr(self, k) for k in ETMChatMember.__slots__ if hasattr(self, k)}
+        else:
+            state = dict(self.__dict__)
         if 'db' in state:
             del state['db']
         return state
@@ -47,7 +50,8 @@ class ETMBaseChatMixin(BaseChat, ABC):  # lgtm [py/missing-equals]
     def __setstate__(self, state: Dict[str, Any]):
         from . import TelegramChannel
         # Import inline to prevent cyclic import
-        self.__dict__.update(state)
+        for k, v in state.items():
+            setattr(self, k, v)
         with suppress(NameError, AttributeError):
             if isinstance(coordinator.master, TelegramChannel):
                 self.db = coordinator.master.db
@@ -62,9 +66,13 @@ class ETMBaseChatMixin(BaseChat, ABC):  # lgtm [py/missing-equals]
 
 
 class ETMChatMember(ETMBaseChatMixin, ChatMember):
+    # Attributes are stored in slots, and __dict__ inherited from
+    # ehforwarderbot is only allocated for attributes not listed here.
+    __slots__ = ('db', 'chat', 'module_id', 'module_name', 'channel_emoji', 'name', 'alias', 'uid',
+                 'vendor_specific', 'description')
     chat_type_name = "ChatMember"
 
-    def __init__(self, db: 'DatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
+    def __init__(self, db: 'BaseDatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
                  uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None, description: str = "",
                  middleware: Optional[Middleware] = None):
         super().__init__(db, chat, name=name, alias=alias, uid=uid, vendor_specific=vendor_specific,
@@ -74,7 +82,7 @@ class ETMChatMember(ETMBaseChatMixin, ChatMember):
 class ETMSelfChatMember(ETMChatMember, SelfChatMember):
     chat_type_name = "SelfChatMember"
 
-    def __init__(self, db: 'DatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
+    def __init__(self, db: 'BaseDatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
                  uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None, description: str = "",
                  middleware: Optional[Middleware] = None):
         super().__init__(db, chat, name=name, alias=alias, uid=uid, vendor_specific=vendor_specific,
@@ -84,26 +92,115 @@ class ETMSelfChatMember(ETMChatMember, SelfChatMember):
 class ETMSystemChatMember(ETMChatMember, SystemChatMember):
     chat_type_name = "SystemChatMember"
 
-    def __init__(self, db: 'DatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
+    def __init__(self, db: 'BaseDatabaseManager', chat: 'Chat', *, name: str = "", alias: Optional[str] = None,
                  uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None, description: str = "",
                  middleware: Optional[Middleware] = None):
         super().__init__(db, chat, name=name, alias=alias, uid=uid, vendor_specific=vendor_specific,
                          description=description, middleware=middleware)
 
 
-class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
-    _last_message_time: Optional[datetime] = None
-    _last_message_time_query: float = 0
-    LAST_MESSAGE_QUERY_TIMEOUT_MS: float = 60000  # 60s
+class MemberList(List[ETMChatMember]):
+    """List of members of a chat, indexed by UID.
+
+    Where multiple members share a UID, the first one is indexed, as in
+    :meth:`ehforwarderbot.chat.Chat.get_member`.
+    """
+
+    def __init__(self, members: Iterable[ETMChatMember] = ()):
+        super().__init__(members)
+        self._by_uid: Dict[ChatID, ETMChatMember] = {}
+        self.reindex()
+
+    def __reduce__(self):
+        return MemberList, (list(self),)
+
+    def reindex(self):
+        """Rebuild the index, e.g. after UIDs of members are changed."""
+        by_uid: Dict[ChatID, ETMChatMember] = {}
+        for i in self:
+            by_uid.setdefault(i.uid, i)
+        # Replaced at once, so that lookups never see a partial index.
+        self._by_uid = by_uid
+
+    def find(self, uid: ChatID) -> ETMChatMember:
+        """Find a member by UID.
+
+        Raises:
+            KeyError: if the UID is not found.
+        """
+        member = self._by_uid[uid]
+        if member.uid != uid:
+            self.reindex()
+            member = self._by_uid[uid]
+        return member
+
+    def _unindex(self, member: ETMChatMember):
+        if self._by_uid.get(member.uid) is member:
+            del self._by_uid[member.uid]
+            # Index the next member with the same UID, if any.
+            for i in self:
+                if i.uid == member.uid:
+                    self._by_uid[i.uid] = i
+                    break
+
+    def append(self, member: ETMChatMember):
+        super().append(member)
+        self._by_uid.setdefault(member.uid, member)
+
+    def extend(self, members: Iterable[ETMChatMember]):
+        for i in members:
+            self.append(i)
+
+    def __iadd__(self, members):  # type: ignore
+        self.extend(members)
+        return self
+
+    def insert(self, index, member: ETMChatMember):
+        super().insert(index, member)
+        self.reindex()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self.reindex()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self.reindex()
+
+    def remove(self, member: ETMChatMember):
+        super().remove(member)
+        self._unindex(member)
+
+    def pop(self, index=-1) -> ETMChatMember:
+        member = super().pop(index)
+        self._unindex(member)
+        return member
+
+    def clear(self):
+        super().clear()
+        self._by_uid.clear()
 
-    _linked: Optional[List[EFBChannelChatIDStr]] = None
 
-    members: MutableSequence[ETMChatMember]  # type: ignore
+class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
     self: Optional[ETMSelfChatMember]
 
     chat_type_name = "Chat"
     chat_type_emoji = Emoji.UNKNOWN
 
+    @property  # type: ignore
+    def members(self) -> MemberList:
+        members = self.__dict__['members']
+        if not isinstance(members, MemberList):
+            # Lists assigned directly to __dict__, e.g. from pickles.
+            members = self.__dict__['members'] = MemberList(members)
+        return members
+
+    @members.setter
+    def members(self, value: Iterable[ChatMember]):
+        # Members of ETM chats are ETM chat members, see ``convert_chat``.
+        self.__dict__['members'] = value if isinstance(value, MemberList) \
+            else MemberList(cast(Iterable[ETMChatMember], value))
+
     def match(self, pattern: Union[Pattern, str, None]) -> bool:
         """
         Match the chat against a compiled regex pattern or string
@@ -156,24 +253,15 @@ class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
     def unlink(self):
         """ Unlink this chat from any Telegram group."""
         self.db.remove_chat_assoc(slave_uid=utils.chat_id_to_str(self.module_id, self.uid))
-        self._update_linked()
 
     def link(self, channel_id: ModuleID, chat_id: ChatID, multiple_slave: bool):
         self.db.add_chat_assoc(master_uid=utils.chat_id_to_str(channel_id, chat_id),
                                slave_uid=utils.chat_id_to_str(self.module_id, self.uid),
                                multiple_slave=multiple_slave)
-        self._update_linked()
 
     @property
     def linked(self) -> List[EFBChannelChatIDStr]:
-        if self._linked is None:
-            self._update_linked()
-        return self._linked or []
-
-    def _update_linked(self):
-        self._linked = self.db.get_chat_assoc(
-            slave_uid=utils.chat_id_to_str(self.module_id, self.uid)
-        )
+        return self.db.get_chat_assoc(slave_uid=utils.chat_id_to_str(self.module_id, self.uid))
 
     @property
     def full_name(self) -> str:
@@ -208,17 +296,7 @@ class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
         """Time of the last recorded message from this chat.
         Returns ``datetime.min`` when no recorded message is found.
         """
-        now = time.time()
-        if self._last_message_time is None or \
-                now - self._last_message_time_query < self.LAST_MESSAGE_QUERY_TIMEOUT_MS:
-            msg_log = self.db.get_last_message(slave_chat_id=utils.chat_id_to_str(chat=self))
-            self._last_message_time_query = now
-            if msg_log is None:
-                self._last_message_time = datetime.min
-            else:
-                self._last_message_time = msg_log.time
-        assert self._last_message_time
-        return self._last_message_time
+        return self.db.get_last_message_time(utils.chat_id_to_str(chat=self))
 
     def update_to_db(self):
         """Update this object to database."""
@@ -226,7 +304,8 @@ class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
 
     @property
     def pickle(self) -> bytes:
-        return pickle.dumps(self)
+        """Serialized chat object, see :func:`encode_chat`."""
+        return encode_chat(self)
 
     def remove_from_db(self):
         super().remove_from_db()
@@ -273,7 +352,7 @@ class ETMChatMixin(ETMBaseChatMixin, Chat, ABC):
                                    vendor_specific=vendor_specific, description=description, middleware=middleware)
 
     def get_member(self, member_id: ChatID) -> ETMChatMember:
-        return super().get_member(member_id)  # type: ignore
+        return self.members.find(member_id)
 
 
 class ETMPrivateChat(ETMChatMixin, PrivateChat):
@@ -282,7 +361,7 @@ class ETMPrivateChat(ETMChatMixin, PrivateChat):
 
     other: ETMChatMember
 
-    def __init__(self, db: 'DatabaseManager', *, channel: Optional[SlaveChannel] = None,
+    def __init__(self, db: 'BaseDatabaseManager', *, channel: Optional[SlaveChannel] = None,
                  middleware: Optional[Middleware] = None,
                  module_name: str = "", channel_emoji: str = "", module_id: ModuleID = ModuleID(""), name: str = "",
                  alias: Optional[str] = None, uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None,
@@ -301,7 +380,7 @@ class ETMSystemChat(ETMChatMixin, SystemChat):
 
     other: ETMSystemChatMember
 
-    def __init__(self, db: 'DatabaseManager', *, channel: Optional[SlaveChannel] = None,
+    def __init__(self, db: 'BaseDatabaseManager', *, channel: Optional[SlaveChannel] = None,
                  middleware: Optional[Middleware] = None,
                  module_name: str = "", channel_emoji: str = "", module_id: ModuleID = ModuleID(""), name: str = "",
                  alias: Optional[str] = None, uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None,
@@ -317,7 +396,7 @@ class ETMGroupChat(ETMChatMixin, GroupChat):
     chat_type_name = "Group"
     chat_type_emoji = Emoji.GROUP
 
-    def __init__(self, db: 'DatabaseManager', *, channel: Optional[SlaveChannel] = None,
+    def __init__(self, db: 'BaseDatabaseManager', *, channel: Optional[SlaveChannel] = None,
                  middleware: Optional[Middleware] = None,
                  module_name: str = "", channel_emoji: str = "", module_id: ModuleID = ModuleID(""), name: str = "",
                  alias: Optional[str] = None, uid: ChatID = ChatID(""), vendor_specific: Dict[str, Any] = None,
@@ -335,22 +414,22 @@ ETMBaseChatType = ETMBaseChatMixin
 
 
 @overload
-def convert_chat(db: 'DatabaseManager', chat: PrivateChat) -> ETMPrivateChat: ...
+def convert_chat(db: 'BaseDatabaseManager', chat: PrivateChat) -> ETMPrivateChat: ...
 
 
 @overload
-def convert_chat(db: 'DatabaseManager', chat: GroupChat) -> ETMGroupChat: ...
+def convert_chat(db: 'BaseDatabaseManager', chat: GroupChat) -> ETMGroupChat: ...
 
 
 @overload
-def convert_chat(db: 'DatabaseManager', chat: SystemChat) -> ETMSystemChat: ...
+def convert_chat(db: 'BaseDatabaseManager', chat: SystemChat) -> ETMSystemChat: ...
 
 
 @overload
-def convert_chat(db: 'DatabaseManager', chat: Chat) -> ETMChatType: ...
+def convert_chat(db: 'BaseDatabaseManager', chat: Chat) -> ETMChatType: ...
 
 
-def convert_chat(db: 'DatabaseManager', chat: Chat) -> ETMChatType:
+def convert_chat(db: 'BaseDatabaseManager', chat: Chat) -> ETMChatType:
     """Convert an EFB chat object to a ETM extended version.
 
     Raises:
@@ -416,7 +495,10 @@ def copy_member(source: ChatMember, dest: ETMChatMember):
     """Copy values from source object to destination object."""
     dest.name = source.name
     dest.alias = source.alias
-    dest.uid = source.uid
+    if dest.uid != source.uid:
+        dest.uid = source.uid
+        if isinstance(dest.chat.members, MemberList):
+            dest.chat.members.reindex()
     dest.vendor_specific = source.vendor_specific.copy()
     dest.module_id = source.module_id
     dest.module_name = source.module_name
@@ -424,7 +506,146 @@ def copy_member(source: ChatMember, dest: ETMChatMember):
     dest.description = source.description
 
 
-def unpickle(data: bytes, db: 'DatabaseManager') -> ETMChatType:
-    obj = pickle.loads(data)
+def unpickle(data: bytes, db: 'BaseDatabaseManager') -> ETMChatType:
+    """Deserialize a chat object encoded in any format."""
+    if not serialization.is_pickle(data):
+        return decode_chat(data, db)
+    obj = serialization.loads_pickle(data)
     obj.db = db
+    for i in obj.members:
+        i.db = db
     return obj
+
+
+_CHAT_TYPES = {i.chat_type_name: i for i in (ETMPrivateChat, ETMGroupChat, ETMSystemChat)}
+_MEMBER_TYPES = {i.chat_type_name: i for i in (ETMChatMember, ETMSelfChatMember, ETMSystemChatMember)}
+_CHAT_ATTRIBUTES = {'db', 'module_id', 'module_name', 'channel_emoji', 'name', 'alias', 'uid', 'description',
+                    'vendor_specific', 'notification', 'members', 'self', 'other'}
+_MEMBER_ATTRIBUTES = {'db', 'chat', 'module_id', 'module_name', 'channel_emoji', 'name', 'alias', 'uid',
+                      'description', 'vendor_specific'}
+
+CHAT_SCHEMA: serialization.Schema = (
+    ("type", None), ("module_id", None), ("module_name", None), ("channel_emoji", None), ("name", None),
+    ("uid", None), ("notification", None), ("members", None), ("self", None), ("other", None),
+    ("alias", None), ("description", ""), ("vendor_specific", None),
+)
+"""Schema of encoded chats, see :func:`encode_chat`."""
+MEMBER_SCHEMA: serialization.Schema = (
+    ("type", None), ("name", None), ("uid", None), ("alias", None), ("description", ""),
+    ("vendor_specific", None), ("module_id", None), ("module_name", None), ("channel_emoji", None),
+)
+"""Schema of encoded chat members, see :func:`encode_chat`."""
+
+
+def _check_attributes(obj: ETMBaseChatMixin, types: Mapping[str, type], attributes: Set[str]):
+    if types.get(obj.chat_type_name) is not type(obj):
+        raise TypeError(f"Type of {obj!r} is not supported.")
+    # Members keep their attributes in slots, where ``vars()`` would
+    # allocate an empty ``__dict__`` for each of them.
+    names = ETMChatMember.__slots__ if isinstance(obj, ETMChatMember) else vars(obj)
+    # Private attributes are caches, or left from earlier versions.
+    if not attributes.issuperset(k for k in names if not k.startswith('_')):
+        raise TypeError(f"Attributes of {obj!r} are not supported.")
+    if not serialization.is_plain(obj.vendor_specific):
+        raise TypeError(f"Vendor specific data of {obj!r} cannot be encoded.")
+
+
+def _encode_chat(chat: ETMChatType) -> List[Any]:
+    _check_attributes(chat, _CHAT_TYPES, _CHAT_ATTRIBUTES)
+    members = []
+    for i in chat.members:
+        _check_attributes(i, _MEMBER_TYPES, _MEMBER_ATTRIBUTES)
+        members.append(serialization.pack({
+            "type": i.chat_type_name, "name": i.name, "uid": i.uid, "alias": i.alias,
+            "description": i.description, "vendor_specific": i.vendor_specific or None,
+            "module_id": i.module_id if i.module_id != chat.module_id else None,
+            "module_name": i.module_name if i.module_name != chat.module_name else None,
+            "channel_emoji": i.channel_emoji if i.channel_emoji != chat.channel_emoji else None,
+        }, MEMBER_SCHEMA))
+    return serialization.pack({
+        "type": chat.chat_type_name, "module_id": chat.module_id, "module_name": chat.module_name,
+        "channel_emoji": chat.channel_emoji, "name": chat.name, "uid": chat.uid,
+        "notification": chat.notification.name, "members": members,
+        "self": chat.members.index(chat.self) if chat.self is not None else None,
+        "other": chat.members.index(chat.other) if isinstance(chat, (ETMPrivateChat, ETMSystemChat)) else None,
+        "alias": chat.alias, "description": chat.description, "vendor_specific": chat.vendor_specific or None,
+    }, CHAT_SCHEMA)
+
+
+def encode_chat(chat: ETMChatType) -> bytes:
+    """Encode a chat object with its members, see :mod:`.serialization`.
+
+    In format version 1, chats are records of :data:`CHAT_SCHEMA`, where
+
+    - ``type`` is the ``chat_type_name`` of the chat;
+    - ``notification`` is the name of the notification state;
+    - ``members`` is a list of records of :data:`MEMBER_SCHEMA`, where
+      ``module_id``, ``module_name`` and ``channel_emoji`` are null if
+      same as the chat;
+    - ``self`` and ``other`` are indexes of these members in ``members``;
+    - ``vendor_specific`` is null if empty.
+
+    Chats that cannot be represented in JSON, e.g. with vendor specific
+    data of custom types, or of types other than ETM chats and members,
+    are encoded as pickle.
+    """
+    try:
+        return serialization.dumps(_encode_chat(chat))
+    except (TypeError, ValueError):
+        return serialization.dumps_pickle(chat)
+
+
+def decode_chat(data: bytes, db: 'BaseDatabaseManager') -> ETMChatType:
+    """Decode a chat object encoded as JSON by :func:`encode_chat`.
+
+    Objects are rebuilt without calling their constructors, as pickle does.
+    """
+    record = serialization.loads(data)
+    (chat_type, module_id, module_name, channel_emoji, name, uid, notification, members, self_idx, other_idx,
+     alias, description, vendor_specific) = record + [i[1] for i in CHAT_SCHEMA[len(record):]]
+    cls = _CHAT_TYPES[chat_type]
+    chat = cls.__new__(cls)
+    chat.__dict__.update(db=db, module_id=module_id, module_name=module_name, channel_emoji=channel_emoji,
+                         name=name, alias=alias, uid=uid, description=description,
+                         vendor_specific=vendor_specific or {},
+                         notification=ChatNotificationState[notification], members=MemberList())
+    for member_record in members:
+        (member_type, m_name, m_uid, m_alias, m_description, m_vendor_specific,
+         m_module_id, m_module_name, m_channel_emoji) = \
+            member_record + [i[1] for i in MEMBER_SCHEMA[len(member_record):]]
+        member_cls = _MEMBER_TYPES[member_type]
+        member = member_cls.__new__(member_cls)
+        member.db, member.chat, member.name, member.uid, member.alias, member.description = \
+            db, chat, m_name, m_uid, m_alias, m_description
+        member.vendor_specific = m_vendor_specific or {}
+        member.module_id = module_id if m_module_id is None else m_module_id
+        member.module_name = module_name if m_module_name is None else m_module_name
+        member.channel_emoji = channel_emoji if m_channel_emoji is None else m_channel_emoji
+        chat.members.append(member)
+    chat.self = chat.members[self_idx] if self_idx is not None else None  # type: ignore
+    if other_idx is not None:
+        chat.other = chat.members[other_idx]  # type: ignore
+    return chat
+
+
+def chat_header(chat: ETMChatType) -> ETMChatType:
+    """Copy a chat object without its members, except for ``self`` and
+    ``other``, e.g. to list chats evicted from cache.
+    """
+    cls = type(chat)
+    header = cls.__new__(cls)
+    header.__dict__.update(db=chat.db, module_id=chat.module_id, module_name=chat.module_name,
+                           channel_emoji=chat.channel_emoji, name=chat.name, alias=chat.alias, uid=chat.uid,
+                           description=chat.description, vendor_specific=chat.vendor_specific.copy(),
+                           notification=chat.notification, members=MemberList())
+    copies: Dict[int, ETMChatMember] = {}
+    for attr in ('self', 'other'):
+        if attr not in chat.__dict__:
+            continue
+        member = chat.__dict__[attr]
+        if member is not None and id(member) not in copies:
+            copies[id(member)] = copy.copy(member)
+            copies[id(member)].chat = header
+            header.members.append(copies[id(member)])
+        header.__dict__[attr] = copies[id(member)] if member is not None else None
+    return header
@@ -33,7 +33,7 @@ if TYPE_CHECKING:
     from . import TelegramChannel
     from .bot_manager import TelegramBotManager
     from .chat_object_cache import ChatObjectCacheManager
-    from .db import DatabaseManager
+    from .db import BaseDatabaseManager
 
 __all__ = ['ChatBindingManager']
 
@@ -95,7 +95,7 @@ class ChatBindingManager(LocaleMixin):
     def __init__(self, channel: 'TelegramChannel'):
         self.channel: 'TelegramChannel' = channel
         self.bot: 'TelegramBotManager' = channel.bot_manager
-        self.db: 'DatabaseManager' = channel.db
+        self.db: 'BaseDatabaseManager' = channel.db
         self.chat_manager: 'ChatObjectCacheManager' = channel.chat_manager
 
         # Link handler
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+Snapshot of the chat object cache, so that chats are available right after
+ETM restarts, before slave channels report their chats.
+
+The snapshot file starts with ``MAGIC``, followed by a zlib-compressed
+sequence of chats, each a 4-byte big-endian length followed by the chat
+encoded with :func:`.chat.encode_chat`. Snapshots are replaced atomically.
+"""
+
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Iterable, List, TYPE_CHECKING
+
+from .chat import ETMChatType, unpickle
+
+if TYPE_CHECKING:
+    from .db import BaseDatabaseManager
+
+__all__ = ['save_snapshot', 'load_snapshot']
+
+MAGIC = b"ETMC\x01"
+"""Leading bytes of snapshot files, including the format version."""
+
+_LENGTH = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+
+def save_snapshot(path: Path, chats: Iterable[bytes]) -> int:
+    """Write a snapshot of chats.
+
+    Args:
+        path: Path of the snapshot.
+        chats: Chats encoded with :func:`.chat.encode_chat`.
+
+    Returns:
+        Number of chats written.
+    """
+    compressor = zlib.compressobj()
+    count = 0
+    temp_path = path.with_name(path.name + ".tmp")
+    with temp_path.open("wb") as f:
+        f.write(MAGIC)
+        for data in chats:
+            f.write(compressor.compress(_LENGTH.pack(len(data)) + data))
+            count += 1
+        f.write(compressor.flush())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return count
+
+
+def load_snapshot(path: Path, db: 'BaseDatabaseManager') -> List[ETMChatType]:
+    """Read chats from a snapshot.
+
+    Returns:
+        Chats in the snapshot, empty if the snapshot does not exist or
+        cannot be read.
+    """
+    if not path.exists():
+        return []
+    chats: List[ETMChatType] = []
+    # noinspection PyBroadException
+    try:
+        data = path.read_bytes()
+        if not data.startswith(MAGIC):
+            raise ValueError("Unknown format of chat cache snapshot.")
+        data = zlib.decompress(data[len(MAGIC):])
+        offset = 0
+        while offset < len(data):
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            chats.append(unpickle(data[offset:offset + length], db))
+            offset += length
+    except Exception:
+        logger.exception("Failed to load chat cache snapshot from %s, chats are loaded from slave channels.", path)
+        return []
+    return chats
@@ -1,14 +1,24 @@
+import datetime
+import itertools
 import logging
+import threading
+import time
+from collections import OrderedDict
 from contextlib import suppress
-from typing import TYPE_CHECKING, Optional, Dict, Tuple, Iterator, overload, cast, MutableSequence, Collection
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Dict, Tuple, Iterator, overload, Collection, List, Set, \
+    Iterable
 
 from typing_extensions import Literal
 
-from ehforwarderbot import coordinator
+from ehforwarderbot import coordinator, utils
+from ehforwarderbot.channel import SlaveChannel
 from ehforwarderbot.chat import Chat, ChatMember, BaseChat, SystemChatMember, SelfChatMember
 from ehforwarderbot.exceptions import EFBChatNotFound
 from ehforwarderbot.types import ModuleID, ChatID
-from .chat import convert_chat, ETMChatType, ETMChatMember, unpickle, ETMSystemChat
+from . import chat_cache_snapshot
+from .chat import convert_chat, ETMChatType, ETMChatMember, unpickle, ETMSystemChat, encode_chat, chat_header
+from .utils import chat_id_to_str
 
 if TYPE_CHECKING:
     from . import TelegramChannel
@@ -22,28 +32,286 @@ class ChatObjectCacheManager:
     middlewares.
     """
 
+    CHAT_ATTRIBUTES = ('name', 'alias', 'notification', 'description')
+    """Attributes of chats updated in cache, ``vendor_specific`` is also
+    updated in full updates."""
+
+    ESTIMATED_CHAT_SIZE = 1024
+    """Estimated bytes of a chat object in memory, excluding members."""
+    ESTIMATED_MEMBER_SIZE = 512
+    """Estimated bytes of a chat member object in memory."""
+    ACTIVE_PERIOD = datetime.timedelta(days=7)
+    """Chats with messages in this period are not evicted from cache."""
+    LOCK_STRIPES = 64
+    """Number of locks shared by chats in cache, see :meth:`chat_lock`."""
+
     def __init__(self, channel: 'TelegramChannel'):
         self.channel = channel
         self.db = channel.db
         self.logger = logging.getLogger(__name__)
 
-        self.cache: Dict[CacheKey, ETMChatType] = dict()
+        self.cache: 'OrderedDict[CacheKey, ETMChatType]' = OrderedDict()
+        """Chats in cache, least recently used first."""
+        self.lock = threading.RLock()
+        """Lock of the structure of the cache and records below, held only
+        briefly. Chat locks are always acquired before this lock."""
+        self.chat_locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        """Locks of changes to chat objects, see :meth:`chat_lock`."""
+
+        self.memory_limit: int = channel.flag("chat_cache_memory_limit") * 1024 * 1024
+        """Estimated bytes of chats in cache to start evicting chats, 0 if
+        unlimited."""
+        self.sizes: Dict[CacheKey, int] = {}
+        """Estimated bytes of each chat in cache."""
+        self.cache_bytes = 0
+        """Estimated bytes of all chats in cache."""
+        self.stored: Set[CacheKey] = set()
+        """Keys of chats in cache unchanged since loaded from or written to
+        the database."""
+        self.evicted: Dict[CacheKey, ETMChatType] = {}
+        """Chats evicted from cache, which are kept in the database, with
+        copies of their attributes without members to list them, see
+        :func:`.chat.chat_header`. Sizes of these copies are not counted."""
+        self.evictions = 0
+
+        self.snapshot_path: Optional[Path] = None
+        """Path to the snapshot of the cache, ``None`` if disabled."""
+        self.snapshot_keys: Set[CacheKey] = set()
+        """Keys of chats loaded from the snapshot, not yet reconciled with
+        slave channels."""
+        self._stop = threading.Event()
+        """Stop background threads of snapshots and writes of chats."""
+        self._snapshot_thread: Optional[threading.Thread] = None
+        snapshot_interval = channel.flag("chat_cache_snapshot_interval")
+        if snapshot_interval > 0:
+            self.snapshot_path = utils.get_data_path(channel.channel_id) / "chat_cache.snapshot"
+            self.load_snapshot()
+            self._snapshot_thread = threading.Thread(target=self._snapshot_worker, args=(snapshot_interval,),
+                                                     name="ETM chat cache snapshot thread", daemon=True)
+            self._snapshot_thread.start()
+
+        self.miss_ttl: float = channel.flag("chat_miss_ttl")
+        self.misses: 'OrderedDict[CacheKey, float]' = OrderedDict()
+        """Expiry time of chats not found anywhere, in order of expiry."""
+
+        self.dirty: Dict[CacheKey, ETMChatType] = {}
+        """Chats changed and not yet written to the database."""
+        self.flush_lock = threading.Lock()
+        """Lock held while chats are being written to the database."""
+        self._flush_thread: Optional[threading.Thread] = None
+        flush_interval = channel.flag("chat_flush_interval")
+        if flush_interval > 0:
+            self._flush_thread = threading.Thread(target=self._flush_worker, args=(flush_interval,),
+                                                  name="ETM chat writer thread", daemon=True)
+            self._flush_thread.start()
 
         self.logger.debug("Loading chats from slave channels...")
-        # load all chats from all slave channels and convert to ETMChat object
+        # Load chats from all slave channels concurrently, chats from
+        # channels not loaded in time are enrolled in background.
+        self.loaders: Dict[ModuleID, threading.Thread] = {}
+        """Threads loading chats from each slave channel."""
         for channel_id, module in coordinator.slaves.items():
-            # noinspection PyBroadException
-            try:
-                self.logger.debug("Loading chats from '%s'...", channel_id)
-                chats = module.get_chats()
-            except Exception:
-                self.logger.exception("Error occurred while getting chats from %. "
-                                      "ETM will report no chat from this channel until further noticed.", channel_id)
-                continue
-            self.logger.debug("Found %s chats from '%s'.", len(chats), channel_id)
+            thread = threading.Thread(target=self.load_chats, args=(channel_id, module),
+                                      name=f"ETM chat loader: {channel_id}", daemon=True)
+            thread.start()
+            self.loaders[channel_id] = thread
+        if self.snapshot_keys:
+            # Chats from the snapshot are reconciled in background.
+            return
+        timeout = channel.flag("chat_loading_timeout")
+        if not self.wait_for_chats(timeout):
+            self.logger.warning("Chats from %s are not loaded in %s seconds, continue loading in background.",
+                                ", ".join(self.loading_channels), timeout)
+
+    def load_chats(self, channel_id: ModuleID, module: SlaveChannel):
+        """Load all chats from a slave channel, and convert them to ETMChat
+        objects.
+        """
+        # noinspection PyBroadException
+        try:
+            self.logger.debug("Loading chats from '%s'...", channel_id)
+            start = time.monotonic()
+            chats = module.get_chats()
+        except Exception:
+            self.logger.exception("Error occurred while getting chats from %s. "
+                                  "ETM will report no chat from this channel until further noticed.", channel_id)
+            return
+        self.logger.debug("Found %s chats from '%s' in %.2f seconds.", len(chats), channel_id,
+                          time.monotonic() - start)
+        loaded: Set[CacheKey] = set()
+        for chat in chats:
+            key = self.get_cache_key(chat)
+            loaded.add(key)
+            if key in self.snapshot_keys:
+                self.reconcile_chat(chat)
+            else:
+                # Chats may be enrolled otherwise in the meantime.
+                self.update_chat_obj(chat)
+        with self.lock:
+            # Chats in the snapshot no longer reported by the channel.
+            for key in [i for i in self.snapshot_keys if i[0] == channel_id]:
+                self.snapshot_keys.discard(key)
+                if key not in loaded:
+                    self._remove(key)
+        self.logger.debug("All %s chats from '%s' are enrolled.", len(chats), channel_id)
+
+    def reconcile_chat(self, chat: Chat):
+        """Update a chat loaded from the snapshot with the chat from its
+        slave channel, if they are different.
+        """
+        key = self.get_cache_key(chat)
+        with self.chat_lock(key):
+            with self.lock:
+                self.snapshot_keys.discard(key)
+            self._update_chat_obj(chat, full_update=True)
+
+    def chat_lock(self, key: CacheKey) -> threading.RLock:
+        """Lock of changes to a chat object and its members.
+
+        Chats share a fixed number of locks by hash of their keys, so that
+        changes of a chat do not block changes of most other chats, and
+        lookups of chats in cache do not wait for any lock.
+        """
+        return self.chat_locks[hash(key) % self.LOCK_STRIPES]
+
+    def load_snapshot(self):
+        """Enrol chats of slave channels from the snapshot of the cache."""
+        start = time.monotonic()
+        chats = chat_cache_snapshot.load_snapshot(self.snapshot_path, self.db)
+        with self.lock:
             for chat in chats:
-                self.compound_enrol(chat)
-            self.logger.debug("All %s chats from '%s' are enrolled.", len(chats), channel_id)
+                if chat.module_id not in coordinator.slaves:
+                    continue
+                key = self.get_cache_key(chat)
+                self._put(key, chat)
+                self.snapshot_keys.add(key)
+        self.logger.debug("Loaded %s chats from the snapshot in %.3f seconds.", len(self.snapshot_keys),
+                          time.monotonic() - start)
+
+    def save_snapshot(self):
+        """Write a snapshot of the cache."""
+        if self.snapshot_path is None:
+            return
+        start = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            with self.lock:
+                chats = list(self.cache.items())
+            count = chat_cache_snapshot.save_snapshot(self.snapshot_path, (self._encode(*i) for i in chats))
+        except Exception:
+            self.logger.exception("Failed to save chat cache snapshot to %s.", self.snapshot_path)
+            return
+        self.logger.debug("Saved %s chats to the snapshot in %.3f seconds.", count, time.monotonic() - start)
+
+    def _encode(self, key: CacheKey, chat: ETMChatType) -> bytes:
+        with self.chat_lock(key):
+            return encode_chat(chat)
+
+    def _snapshot_worker(self, interval: float):
+        """Save a snapshot of the cache every ``interval`` seconds."""
+        while not self._stop.wait(interval):
+            self.save_snapshot()
+
+    def mark_dirty(self, chat: ETMChatType):
+        """Write a chat to the database in the next flush, or immediately if
+        writes of chats are not deferred.
+        """
+        key = self.get_cache_key(chat)
+        if self._flush_thread is None:
+            with self.chat_lock(key):
+                chat.update_to_db()
+                with self.lock:
+                    if self.cache.get(key) is chat:
+                        self.stored.add(key)
+            return
+        with self.lock:
+            self.stored.discard(key)
+            self.dirty[key] = chat
+
+    def _changed(self, key: CacheKey, chat: ETMChatType):
+        """Record a change of a chat object outside of full updates, with
+        the chat lock held.
+
+        Objects of chats evicted from cache may still be held and changed
+        by callers, and are written to the database again.
+        """
+        with self.lock:
+            if self.cache.get(key) is chat:
+                self._resize(key)
+                self.stored.discard(key)
+                return
+            if key not in self.evicted:
+                return
+            self.evicted[key] = chat_header(chat)
+        self.mark_dirty(chat)
+
+    def _write_evicted(self, chats: List[ETMChatType]):
+        """Write chats evicted from cache to the database, without the lock
+        held.
+        """
+        if self._flush_thread is None:
+            # Chats evicted are no longer changed through the cache.
+            for chat in chats:
+                chat.update_to_db()
+            return
+        with self.lock:
+            for chat in chats:
+                self.dirty[self.get_cache_key(chat)] = chat
+
+    def flush_chats(self):
+        """Write all changed chats to the database."""
+        with self.flush_lock:
+            with self.lock:
+                chats, self.dirty = list(self.dirty.values()), {}
+            for chat in chats:
+                # noinspection PyBroadException
+                try:
+                    key = self.get_cache_key(chat)
+                    with self.chat_lock(key):
+                        chat.update_to_db()
+                        with self.lock:
+                            if self.cache.get(key) is chat and key not in self.dirty:
+                                self.stored.add(key)
+                except Exception:
+                    self.logger.exception("Failed to write chat %s to database.", chat)
+            if chats:
+                self.logger.debug("Flushed %s chats to database.", len(chats))
+
+    def _flush_worker(self, interval: float):
+        """Write changed chats to the database every ``interval`` seconds."""
+        while not self._stop.wait(interval):
+            self.flush_chats()
+
+    def stop_worker(self):
+        """Stop background threads, write all changed chats to the database,
+        and save the final snapshot.
+        """
+        self._stop.set()
+        for thread in (self._snapshot_thread, self._flush_thread):
+            if thread is not None:
+                thread.join()
+        self.flush_chats()
+        self.save_snapshot()
+        self.logger.debug("Chat cache statistics: %s", self.stats())
+
+    @property
+    def loading_channels(self) -> List[ModuleID]:
+        """IDs of slave channels with chats still loading."""
+        return [k for k, v in self.loaders.items() if v.is_alive()]
+
+    def wait_for_chats(self, timeout: Optional[float] = None) -> bool:
+        """Wait for chats from all slave channels to be loaded.
+
+        Args:
+            timeout: Maximum seconds to wait in total, forever if ``None``.
+
+        Returns:
+            If chats from all slave channels are loaded.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.loaders.values():
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not self.loading_channels
 
     def compound_enrol(self, chat: Chat) -> ETMChatType:
         """Convert and enrol a chat object for the first time.
@@ -61,9 +329,83 @@ class ChatObjectCacheManager:
         This would not update the cached object upon conflicting.
         """
         key = self.get_cache_key(chat)
-        self.cache[key] = chat
+        with self.lock:
+            self._put(key, chat)
+            self.misses.pop(key, None)
+        evicted = self._evict()
+        if evicted:
+            self._write_evicted(evicted)
         self.logger.debug("Enrolling key %s with value %s", key, chat)
 
+    def _put(self, key: CacheKey, chat: ETMChatType):
+        """Add or replace a chat in cache, with the lock held."""
+        self.cache[key] = chat
+        self.cache.move_to_end(key)
+        self._resize(key)
+        self.stored.discard(key)
+        self.evicted.pop(key, None)
+
+    def _remove(self, key: CacheKey) -> Optional[ETMChatType]:
+        """Remove a chat from cache, with the lock held."""
+        self.cache_bytes -= self.sizes.pop(key, 0)
+        self.stored.discard(key)
+        return self.cache.pop(key, None)
+
+    def _resize(self, key: CacheKey):
+        """Update the estimated size of a chat in cache, with the lock held."""
+        size = self.ESTIMATED_CHAT_SIZE + self.ESTIMATED_MEMBER_SIZE * len(self.cache[key].members)
+        self.cache_bytes += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+
+    def _evict(self) -> List[ETMChatType]:
+        """Evict least recently used chats when the cache is over the memory
+        limit, until it is below 90% of the limit, without the lock held.
+
+        Chats linked or with recent messages are kept in cache, as looked up
+        from a snapshot of in-memory indexes of the database manager taken
+        before the lock. Chats with their chat locks held by other threads
+        are also kept, as they are being changed.
+
+        Returns:
+            Chats evicted to be written to the database, as their copies in
+            the database are outdated. Chats evicted are loaded from the
+            database when used again.
+        """
+        evicted: List[ETMChatType] = []
+        if not self.memory_limit or self.cache_bytes <= self.memory_limit:
+            return evicted
+        active = self.db.get_active_chats(datetime.datetime.now() - self.ACTIVE_PERIOD)
+        target = self.memory_limit * 0.9
+        pinned: List[CacheKey] = []
+        with self.lock:
+            for key, chat in list(self.cache.items()):
+                if self.cache_bytes <= target:
+                    break
+                if chat_id_to_str(chat=chat) in active:
+                    pinned.append(key)
+                    continue
+                lock = self.chat_lock(key)
+                if not lock.acquire(blocking=False):
+                    # The chat is being changed by another thread.
+                    continue
+                lock.release()
+                if key not in self.stored:
+                    evicted.append(chat)
+                self._remove(key)
+                self.evicted[key] = chat_header(chat)
+                self.evictions += 1
+            for key in pinned:
+                self.cache.move_to_end(key)
+            self.logger.debug("Chats evicted from cache, estimated size: %s bytes.", self.cache_bytes)
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """Number of chats and members in cache, and their estimated size."""
+        with self.lock:
+            return {"chats": len(self.cache), "members": sum(len(i.members) for i in self.cache.values()),
+                    "estimated_bytes": self.cache_bytes, "memory_limit": self.memory_limit,
+                    "evicted": len(self.evicted), "evictions": self.evictions}
+
     @staticmethod
     def get_cache_key(chat: BaseChat) -> CacheKey:
         module_id = chat.module_id
@@ -87,33 +429,95 @@ class ChatObjectCacheManager:
 
         If build_dummy is set to True, this will return a dummy object with
         the module_id, chat_id and group_id specified.
+
+        Chats not found are not looked up again until ``chat_miss_ttl``
+        seconds later, or until the chat is enrolled or chats of its
+        channel are updated.
         """
         key = (module_id, chat_id)
-        if key in self.cache:
-            return self.cache[key]
+        cached = self.cache.get(key)
+        if cached is not None:
+            if self.memory_limit:
+                # Reordering while stats() or _evict() iterates the cache
+                # would fail their iteration.
+                with self.lock, suppress(KeyError):
+                    self.cache.move_to_end(key)
+            return cached
+
+        if not self.is_missed(key):
+            chat = self._find_chat(module_id, chat_id)
+            if chat is not None:
+                return chat
+            self.add_miss(key)
 
-        c_log = self.db.get_slave_chat_info(module_id, chat_id)
-        if c_log is not None and c_log.pickle:
-            # Suppress AttributeError caused by change of class name in EFB 2.0.0b26, ETM 2.0.0b40
-            with suppress(AttributeError):
-                obj = unpickle(c_log.pickle, self.db)
+        if build_dummy:
+            return ETMSystemChat(self.db,
+                                 module_id=module_id,
+                                 module_name=module_id,
+                                 uid=chat_id,
+                                 name=chat_id)
+        return None
+
+    def _find_chat(self, module_id: ModuleID, chat_id: ChatID) -> Optional[ETMChatType]:
+        """Look up a chat not in cache from changes not yet written, the
+        database, then its slave channel, and enrol it if found.
+        """
+        key = (module_id, chat_id)
+        with self.chat_lock(key):
+            # The chat may be enrolled by another thread in the meantime.
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            obj = self.dirty.get(key) or self._load_chat(key)
+            if obj is not None:
                 self.enrol(obj)
+                with self.lock:
+                    if key not in self.dirty:
+                        self.stored.add(key)
                 return obj
 
         # Only look up from slave channels as middlewares don’t have get_chat_by_id method.
         if module_id in coordinator.slaves:
             with suppress(EFBChatNotFound, KeyError):
                 chat_obj = coordinator.slaves[module_id].get_chat(chat_id)
-                return self.compound_enrol(chat_obj)
+                with self.chat_lock(key):
+                    return self.cache.get(key) or self.compound_enrol(chat_obj)
+        return None
 
-        if build_dummy:
-            return ETMSystemChat(self.db,
-                                 module_id=module_id,
-                                 module_name=module_id,
-                                 uid=chat_id,
-                                 name=chat_id)
+    def _load_chat(self, key: CacheKey) -> Optional[ETMChatType]:
+        """Load a chat from the database without enrolling it."""
+        c_log = self.db.get_slave_chat_info(*key)
+        if c_log is not None and c_log.pickle:
+            # Suppress AttributeError caused by change of class name in EFB 2.0.0b26, ETM 2.0.0b40
+            with suppress(AttributeError):
+                return unpickle(c_log.pickle, self.db)
         return None
 
+    def is_missed(self, key: CacheKey) -> bool:
+        """If a chat is recently not found."""
+        expiry = self.misses.get(key)
+        return expiry is not None and expiry > time.monotonic()
+
+    def add_miss(self, key: CacheKey):
+        """Record a chat not found."""
+        if self.miss_ttl <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            # Remove expired entries, which are always at the front.
+            while self.misses and next(iter(self.misses.values())) <= now:
+                self.misses.popitem(last=False)
+            self.misses.pop(key, None)
+            self.misses[key] = now + self.miss_ttl
+
+    def clear_misses(self, module_id: ModuleID):
+        """Forget chats not found from a channel, e.g. when its chats are
+        updated.
+        """
+        with self.lock:
+            for key in [i for i in self.misses if i[0] == module_id]:
+                del self.misses[key]
+
     @overload
     def get_chat_member(self, module_id: ModuleID, chat_id: ChatID, member_id: ChatID,
                         build_dummy: Literal[True]) -> ETMChatMember:
@@ -135,65 +539,91 @@ class ChatObjectCacheManager:
             pass
         if not build_dummy:
             return None
-        return chat.add_system_member(name=member_id, uid=member_id)
+        key = self.get_cache_key(chat)
+        with self.chat_lock(key):
+            try:
+                return chat.get_member(member_id)
+            except KeyError:
+                pass
+            member = chat.add_system_member(name=member_id, uid=member_id)
+            self._changed(key, chat)
+            return member
 
     def update_chat_obj(self, chat: Chat, full_update: bool = False) -> ETMChatType:
         """Insert or update chat object to cache.
         Only checking name and alias, not checking group/member association,
         unless full update is requested.
         """
+        with self.chat_lock(self.get_cache_key(chat)):
+            return self._update_chat_obj(chat, full_update)
+
+    def _update_chat_obj(self, chat: Chat, full_update: bool) -> ETMChatType:
+        """Insert or update chat object to cache, with the chat lock held."""
         key = self.get_cache_key(chat)
         self.logger.debug("Trying to update key %s with object %s. Full update: %s", key, chat, full_update)
-        if key not in self.cache:
+        cached = self.cache.get(key)
+        if cached is None:
             self.logger.debug("Key %s is not in cache. Do compound enrol.", key)
             return self.compound_enrol(chat)
 
-        cached = cast(ETMChatType, self.cache[key])
         self.logger.debug("Cached object found with key %s.", key)
 
-        if full_update:
-            etm_chat = convert_chat(self.db, chat)
-            cached.name = etm_chat.name
-            cached.alias = etm_chat.alias
-            cached.description = etm_chat.description
-            cached.vendor_specific = etm_chat.vendor_specific
-            cached.notification = etm_chat.notification
-            cached.members = self.update_chat_members(cached, etm_chat.members, full_update)
-            cached.update_to_db()
-        else:
-            if chat.name != cached.name or \
-                    chat.alias != cached.alias or \
-                    chat.notification != cached.notification or \
-                    chat.description != cached.description:
-                cached.name = chat.name
-                cached.alias = chat.alias
-                cached.notification = chat.notification
-                cached.description = chat.description
-                cached.update_to_db()
+        if chat is cached:
+            return cached
+
+        attributes = self.CHAT_ATTRIBUTES + (('vendor_specific',) if full_update else ())
+        changed = [i for i in attributes if getattr(chat, i) != getattr(cached, i)]
+        for i in changed:
+            value = getattr(chat, i)
+            setattr(cached, i, value.copy() if i == 'vendor_specific' else value)
+        members_changed = self.update_chat_members(cached, chat.members, full_update) if full_update else 0
+        if members_changed:
+            with self.lock:
+                self._resize(key)
+        if changed or members_changed:
+            self.logger.debug("Updated %s of %s, %s members changed.", changed, key, members_changed)
+            self.mark_dirty(cached)
         return cached
 
     def update_chat_members(self,
                             chat: ETMChatType,
-                            members: MutableSequence[ETMChatMember],
-                            full_update: bool = False) -> MutableSequence[ETMChatMember]:
-        """Update chat members. Overwrite, add, and remove member objects if needed."""
-        cached_objs = {(i.module_id, i.uid): i for i in chat.members}
-        chat.members = []
-        for i in members:
-            idx = (i.module_id, i.uid)
-            if idx in cached_objs:
-                chat.members.append(self.update_chat_member_obj(cached_objs[idx], i))
-            else:
-                i.chat = chat
-                chat.members.append(i)
-        return chat.members
+                            members: Iterable[ChatMember],
+                            full_update: bool = False) -> int:
+        """Update chat members. Add, update and remove member objects only if
+        needed, with the chat lock held.
 
-    @staticmethod
-    def get_or_enrol_member(cached: ETMChatType, member: ChatMember) -> ETMChatMember:
+        Returns:
+            Number of members added, updated or removed.
+        """
+        changed = 0
+        uids: Set[ChatID] = set()
+        for i in members:
+            uids.add(i.uid)
+            try:
+                cached = chat.get_member(i.uid)
+            except KeyError:
+                self.get_or_enrol_member(chat, i)
+                changed += 1
+                continue
+            if cached is not i and self.update_chat_member_obj(cached, i, full_update):
+                changed += 1
+        removed = sum(1 for i in chat.members if i.uid not in uids)
+        if removed:
+            chat.members = [i for i in chat.members if i.uid in uids]
+        return changed + removed
+
+    def get_or_enrol_member(self, cached: ETMChatType, member: ChatMember) -> ETMChatMember:
         # TODO: Add test case for this
         try:
             return cached.get_member(member.uid)
         except KeyError:
+            pass
+        key = self.get_cache_key(cached)
+        with self.chat_lock(key):
+            try:
+                return cached.get_member(member.uid)
+            except KeyError:
+                pass
             cached_member: ETMChatMember
             if isinstance(member, SystemChatMember):
                 cached_member = cached.add_system_member(name=member.name, alias=member.alias, uid=member.uid,
@@ -208,46 +638,75 @@ class ChatObjectCacheManager:
             cached_member.module_id = member.module_id
             cached_member.module_name = member.module_name
             cached_member.channel_emoji = member.channel_emoji
+            self._changed(key, cached)
             return cached_member
 
     @staticmethod
-    def update_chat_member_obj(cached: ETMChatMember, member: ETMChatMember,
-                               full_update: bool = False) -> ETMChatMember:
-        """Insert or update chat member object to cache.
-        Only checking name and alias, not checking group/member association,
-        unless full update is requested.
+    def update_chat_member_obj(cached: ETMChatMember, member: ChatMember, full_update: bool = False) -> bool:
+        """Update chat member object in cache.
+        Only checking name, alias and description, unless full update is
+        requested.
+
+        Returns:
+            If the cached member is changed.
         """
-        if full_update:
+        changed = False
+        if member.name != cached.name or \
+                member.alias != cached.alias or \
+                member.description != cached.description:
             cached.name = member.name
             cached.alias = member.alias
             cached.description = member.description
-            cached.vendor_specific = member.vendor_specific
-        else:
-            if member.name != cached.name or \
-                    member.alias != cached.alias or \
-                    member.description != cached.description:
-                cached.name = member.name
-                cached.alias = member.alias
-                cached.description = member.description
-        return cached
+            changed = True
+        if full_update and member.vendor_specific != cached.vendor_specific:
+            cached.vendor_specific = member.vendor_specific.copy()
+            changed = True
+        return changed
 
     def delete_chat_object(self, module_id: ModuleID, chat_id: ChatID):
-        """Remove chat object from cache."""
-        key = (module_id, chat_id)
-        if key not in self.cache:
-            return
-        self.cache.pop(key)
+        """Remove chat object from cache, and discard its changes not yet
+        written to the database.
+
+        Callers should remove the chat from the database after this, so
+        that a write in flight is finished before the removal.
+        """
+        with self.flush_lock, self.lock:
+            self._remove((module_id, chat_id))
+            self.dirty.pop((module_id, chat_id), None)
+            self.evicted.pop((module_id, chat_id), None)
+
+    def delete_chat_members(self, module_id: ModuleID, chat_id: ChatID, member_ids: Collection[ChatID]) -> int:
+        """Remove chat member objects from cache, and write the chat to the
+        database.
 
-    def delete_chat_members(self, module_id: ModuleID, chat_id: ChatID, member_ids: Collection[ChatID]):
-        """Remove chat member objects from cache."""
+        Returns:
+            Number of members removed.
+        """
         key = (module_id, chat_id)
-        if key not in self.cache:
-            return
-        chat = self.cache[key]
-        member_ids = set(member_ids)
-        chat.members = [i for i in chat.members if i.uid not in member_ids]
+        with self.chat_lock(key):
+            chat = self.cache.get(key)
+            if chat is None and key in self.evicted:
+                chat = self._find_chat(module_id, chat_id)
+            if chat is None:
+                return 0
+            member_ids = set(member_ids)
+            removed = sum(1 for i in chat.members if i.uid in member_ids)
+            if not removed:
+                return 0
+            chat.members = [i for i in chat.members if i.uid not in member_ids]
+            with self.lock:
+                self._resize(key)
+            self.logger.debug("Removed %s members of %s.", removed, key)
+            self.mark_dirty(chat)
+        return removed
 
     @property
     def all_chats(self) -> Iterator[ETMChatType]:
-        """Return all chats that is not a group member and not myself."""
-        return (val for val in self.cache.values() if isinstance(val, ETMChatType))
+        """Return all chats that is not a group member and not myself.
+
+        Chats evicted from cache are listed by copies without their members,
+        see :attr:`evicted`.
+        """
+        with self.lock:
+            chats = list(itertools.chain(self.cache.values(), self.evicted.values()))
+        return (val for val in chats if isinstance(val, ETMChatType))
@@ -13,6 +13,8 @@ class Flags:
     COMMAND_PENDING = 0x31
     # Message recipient suggestions
     SUGGEST_RECIPIENTS = 0x32
+    # Message search
+    SEARCH_RESULTS = 0x41
 
 
 class Emoji:
@@ -2,24 +2,35 @@
 
 import datetime
 import logging
-import pickle
+import sqlite3
+import threading
 import time
-from contextlib import suppress
-from functools import partial
-from typing import List, Optional, Tuple, Dict, Collection, TYPE_CHECKING
+import urllib.request
+from abc import ABC, abstractmethod
+from contextlib import suppress, contextmanager
+from typing import List, Optional, Tuple, Dict, Collection, TYPE_CHECKING, Callable, NamedTuple, Set, Any, \
+    Iterator, Iterable, Type, Mapping
 
-from peewee import Model, TextField, DateTimeField, CharField, DoesNotExist, fn, BlobField
+from peewee import AutoField, Model, TextField, DateTimeField, CharField, DoesNotExist, fn, BlobField, IntegerField, \
+    BooleanField, SqliteDatabase, EXCLUDED, SQL, Case, Expression, CompositeKey, Column, Select, ModelInsert
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 from playhouse.sqliteq import SqliteQueueDatabase
-from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.migrate import SqliteMigrator, migrate, make_index_name
 from telegram import Message
 from typing_extensions import TypedDict
 
 from ehforwarderbot import Message as EFBMessage
 from ehforwarderbot import utils, Channel, coordinator, MsgType
-from ehforwarderbot.message import Substitutions, MessageCommands, MessageAttribute
+from ehforwarderbot.message import Substitutions, MessageCommands, MessageAttribute, Reactions
 from ehforwarderbot.types import ModuleID, ChatID, MessageID, ReactionName
+from . import serialization
+from .chat import encode_chat
 from .chat_object_cache import ChatObjectCacheManager
 from .message import ETMMsg
+from .msg_log_archive import MessageLogArchive
+from .msg_log_buffer import MessageLogBuffer, MsgLogRow, SlaveMsgKey
+from .msg_log_cache import MessageLogCache
 from .msg_type import TGMsgType
 from .utils import TelegramChatID, EFBChannelChatIDStr, TgChatMsgIDStr, message_id_to_str, \
     chat_id_to_str, OldMsgID, chat_id_str_to_id, TelegramMessageID
@@ -29,9 +40,46 @@ if TYPE_CHECKING:
     from .chat import ETMChatMember, ETMChatType
 
 database = SqliteQueueDatabase(None, autostart=False)
+read_database = PooledSqliteDatabase(None, autoconnect=False)
+"""Pool of read-only connections to the database, see :func:`reader`."""
+
+DEFAULT_PRAGMAS: Dict[str, Any] = {
+    # Commits in WAL mode are durable after a checkpoint, the database
+    # is still consistent after a power loss.
+    'synchronous': 'normal',
+    # 16 MiB of page cache per connection.
+    'cache_size': -16 * 1024,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+"""Pragmas of database connections, overridden by ``database_pragmas``."""
+
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+"""If SQLite supports ``INSERT ... ON CONFLICT DO UPDATE``, otherwise
+existing rows are looked up and updated separately.
+"""
+SQLITE_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+"""If SQLite supports window functions, otherwise search results are ranked
+in Python.
+"""
+
+
+@contextmanager
+def reader() -> Iterator[SqliteDatabase]:
+    """Database to run read queries on, with a connection from the read-only
+    pool, or the queued database if the pool is disabled.
+
+    Queries must be bound to the database yielded, and their results fetched
+    inside the context.
+    """
+    if read_database.deferred:
+        yield database
+        return
+    with read_database.connection_context():
+        yield read_database
 
 PickledDict = TypedDict('PickledDict', {
-    "target": EFBChannelChatIDStr,
+    "target": TgChatMsgIDStr,
     "is_system": bool,
     "attributes": MessageAttribute,
     "commands": MessageCommands,
@@ -46,7 +94,8 @@ Dict entries for ``pickle`` field of ``msglog`` log.
 - ``attributes``
 - ``commands``
 - ``substitutions``: ``Dict[Tuple[int, int], SlaveChatID]``
-- ``reactions``: ``Dict[str, Collection[SlaveChatID]]``
+- ``reactions``: ``Dict[str, Collection[SlaveChatID]]``, only in message logs
+  written before ``MsgReaction`` is introduced, and archived message logs.
 """
 
 
@@ -56,8 +105,10 @@ class BaseModel(Model):
 
 
 class ChatAssoc(BaseModel):
-    master_uid = TextField()
-    slave_uid = TextField()
+    id = AutoField()
+    """Order of linking."""
+    master_uid = TextField(index=True)
+    slave_uid = TextField(index=True)
 
 
 class MsgLog(BaseModel):
@@ -67,6 +118,10 @@ class MsgLog(BaseModel):
     """Editable message ID from Telegram if ``master_msg_id`` is not editable
     and a separate one is sent.
     """
+    master_chat_id = IntegerField(null=True)
+    """Telegram chat ID of ``master_msg_id``."""
+    master_message_id = IntegerField(null=True)
+    """Telegram message ID of ``master_msg_id``."""
     slave_message_id = TextField()
     """Message from slave channel."""
     text = TextField()
@@ -91,14 +146,32 @@ class MsgLog(BaseModel):
     msg_type = TextField()
     """Message type in EFB framework."""
     pickle = BlobField(null=True)
-    """Miscellaneous data serialized with ``pickle``, per spec in
-    ``DatabaseManager.pickle_misc_msg()``.
+    """Miscellaneous data serialized per spec in
+    ``DatabaseManager.pickle_misc_msg()``, see :mod:`.serialization`.
+    """
+    target_msg_id = TextField(null=True)
+    """``master_msg_id`` of the message this message replies to, same as
+    ``target`` in ``pickle``. Empty string if backfilled from a message
+    without target.
     """
     sent_to = TextField()
     """Module ID of the message sent to."""
     time = DateTimeField(default=datetime.datetime.now, null=True)
     """Time of the message sent."""
 
+    class Meta:
+        indexes = (
+            # Look up by slave message ID, see ``DatabaseManager.get_msg_log``.
+            (('slave_origin_uid', 'slave_message_id', 'time'), False),
+            # Last message in a slave chat, see ``DatabaseManager.get_last_message``.
+            (('slave_origin_uid', 'time'), False),
+            # Recent slave chats in a Telegram chat, see ``DatabaseManager.get_recent_slave_chats``.
+            (('master_chat_id', 'slave_origin_uid', 'time'), False),
+            # Reply targets and oldest messages, see ``DatabaseManager.run_maintenance``.
+            (('target_msg_id',), False),
+            (('time',), False),
+        )
+
     def build_etm_msg(self, chat_manager: ChatObjectCacheManager,
                       recur: bool = True) -> ETMMsg:
         c_module, c_id, _ = chat_id_str_to_id(self.slave_origin_uid)
@@ -126,11 +199,12 @@ class MsgLog(BaseModel):
         # - ``commands``
         # - ``substitutions``: ``Dict[Tuple[int, int], SlaveChatID]``
         # - ``reactions``: ``Dict[str, Collection[SlaveChatID]]``
+        misc_data: PickledDict = {}
         if self.pickle:
-            misc_data: PickledDict = pickle.loads(self.pickle)
+            misc_data = serialization.decode_misc_msg(self.pickle)  # type: ignore
 
             if 'target' in misc_data and recur:
-                target_row = self.get_or_none(MsgLog.master_msg_id == misc_data['target'])
+                target_row = chat_manager.db.get_msg_log(master_msg_id=misc_data['target'])
                 if target_row:
                     msg.target = target_row.build_etm_msg(chat_manager, recur=False)
             if 'is_system' in misc_data:
@@ -148,18 +222,27 @@ class MsgLog(BaseModel):
                     else:
                         subs[sk] = chat_manager.get_chat(module_id, chat_id, build_dummy=True)
                 msg.substitutions = subs
-            if 'reactions' in misc_data:
-                reactions: Dict[ReactionName, List[ETMChatMember]] = {}
-                for rk, rv in misc_data['reactions'].items():
-                    reactions[rk] = []
-                    for idx in rv:
-                        module_id, chat_id, group_id = chat_id_str_to_id(idx)
-                        reactions[rk].append(chat_manager.get_chat_member(module_id, group_id, chat_id, build_dummy=True))  # type: ignore
-                msg.reactions = reactions
+
+        reaction_ids: Mapping[ReactionName, Collection[EFBChannelChatIDStr]]
+        if 'reactions' in misc_data:
+            # Reactions not yet moved to ``MsgReaction`` in migration 10,
+            # or of archived message logs.
+            reaction_ids = misc_data['reactions']
+        else:
+            reaction_ids = chat_manager.db.get_message_reactions(TgChatMsgIDStr(self.master_msg_id))
+        if reaction_ids:
+            reactions: Dict[ReactionName, List[ETMChatMember]] = {}
+            for rk, rv in reaction_ids.items():
+                reactions[rk] = []
+                for idx in rv:
+                    module_id, chat_id, group_id = chat_id_str_to_id(idx)
+                    reactions[rk].append(chat_manager.get_chat_member(module_id, group_id, chat_id, build_dummy=True))  # type: ignore
+            msg.reactions = reactions
         return msg
 
 
 class SlaveChatInfo(BaseModel):
+    id = AutoField()
     slave_channel_id = TextField()
     slave_channel_emoji = CharField()
     slave_chat_uid = TextField()
@@ -170,83 +253,483 @@ class SlaveChatInfo(BaseModel):
     pickle = BlobField(null=True)
 
 
-class DatabaseManager:
-    logger = logging.getLogger(__name__)
-    FAIL_FLAG = '__fail__'
+SLAVE_CHAT_INFO_KEY = (SlaveChatInfo.slave_channel_id, SlaveChatInfo.slave_chat_uid,
+                       fn.COALESCE(SlaveChatInfo.slave_chat_group_id, SQL("''")))
+"""Unique key of a slave chat info entry. ``slave_chat_group_id`` is
+coalesced to an empty string as ``NULL`` values are distinct in unique indexes.
+"""
+SlaveChatInfo.add_index(SlaveChatInfo.index(*SLAVE_CHAT_INFO_KEY, unique=True, name="slavechatinfo_slave_chat_key"))
 
-    def __init__(self, channel: 'TelegramChannel'):
-        base_path = utils.get_data_path(channel.channel_id)
 
-        self.logger.debug("Loading database...")
-        database.init(str(base_path / 'tgdata.db'))
-        database.start()
-        database.connect()
-        self.logger.debug("Database loaded.")
+class ChatActivity(BaseModel):
+    slave_origin_uid = TextField(primary_key=True)
+    """Channel + chat ID of the slave chat."""
+    last_message_time = DateTimeField(null=True)
+    """Time of the last message logged in the chat."""
+    message_count = IntegerField(default=0)
+    """Number of messages logged in the chat."""
 
-        self.logger.debug("Checking database migration...")
-        if not ChatAssoc.table_exists():
-            self._create()
-        else:
-            msg_log_columns = {i.name for i in database.get_columns("msglog")}
-            slave_chat_info_columns = {i.name for i in database.get_columns("slavechatinfo")}
-            if "file_id" not in msg_log_columns:
-                self._migrate(0)
-            elif "pickle" not in msg_log_columns:
-                self._migrate(1)
-            elif "slave_chat_group_id" not in slave_chat_info_columns:
-                self._migrate(2)
-            elif "file_unique_id" not in msg_log_columns:
-                self._migrate(3)
-        self.logger.debug("Database migration finished...")
 
-    def stop_worker(self):
-        database.stop()
+CHAT_ACTIVITY_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS "msglog_chat_activity_insert" AFTER INSERT ON "msglog"
+    BEGIN
+        INSERT OR IGNORE INTO "chatactivity" ("slave_origin_uid", "last_message_time", "message_count")
+        VALUES (NEW."slave_origin_uid", NULL, 0);
+        UPDATE "chatactivity" SET
+            "last_message_time" = COALESCE(MAX("last_message_time", NEW."time"), "last_message_time", NEW."time"),
+            "message_count" = "message_count" + 1
+        WHERE "slave_origin_uid" = NEW."slave_origin_uid";
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "msglog_chat_activity_delete" AFTER DELETE ON "msglog"
+    BEGIN
+        UPDATE "chatactivity" SET
+            "last_message_time" = (SELECT MAX("time") FROM "msglog"
+                                   WHERE "slave_origin_uid" = OLD."slave_origin_uid"),
+            "message_count" = "message_count" - 1
+        WHERE "slave_origin_uid" = OLD."slave_origin_uid";
+    END""",
+]
+"""Triggers to maintain ``ChatActivity`` on every message log insertion and
+deletion. Updates to existing message logs keep their time, thus are not
+counted. Upsert is not used, as it is not supported before SQLite 3.24.0.
+"""
 
-    @staticmethod
-    def _create():
-        """
-        Initializing tables.
-        """
-        database.create_tables([ChatAssoc, MsgLog, SlaveChatInfo])
 
-    @staticmethod
-    def _migrate(i: int):
+class MsgReaction(BaseModel):
+    master_msg_id = TextField()
+    """``master_msg_id`` of the message reacted to."""
+    reaction = TextField()
+    """Name of the reaction."""
+    member_uid = TextField()
+    """Module + chat ID of the member reacted."""
+
+    class Meta:
+        primary_key = CompositeKey('master_msg_id', 'reaction', 'member_uid')
+
+
+MSG_REACTION_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS "msglog_msgreaction_delete" AFTER DELETE ON "msglog"
+    BEGIN
+        DELETE FROM "msgreaction" WHERE "master_msg_id" = OLD."master_msg_id";
+    END""",
+]
+"""Triggers to remove reactions with their message logs."""
+
+
+class MsgLogIndex(FTS5Model):
+    """Full-text index of message log text, see
+    ``DatabaseManager.search_message_logs``.
+
+    Text is not stored again in the index, but read from ``msglog`` by row
+    ID. Texts are tokenized into trigrams, so that substrings of at least
+    3 characters are matched regardless of language and word boundaries.
+    """
+    rowid = RowIDField()
+    """Row ID of the message log."""
+    text = SearchField()
+
+    class Meta:
+        database = database
+        table_name = "msglog_fts"
+        options = {'content': 'msglog', 'content_rowid': 'rowid', 'tokenize': 'trigram'}
+
+
+MSG_LOG_INDEX_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS "msglog_fts_insert" AFTER INSERT ON "msglog"
+    BEGIN
+        INSERT INTO "msglog_fts" ("rowid", "text") VALUES (NEW."rowid", NEW."text");
+    END""",
+    # Message logs not yet indexed by the backfill are not removed from
+    # the index, which would corrupt it.
+    """CREATE TRIGGER IF NOT EXISTS "msglog_fts_delete" AFTER DELETE ON "msglog"
+    BEGIN
+        INSERT INTO "msglog_fts" ("msglog_fts", "rowid", "text") SELECT 'delete', OLD."rowid", OLD."text"
+            WHERE EXISTS (SELECT 1 FROM "msglog_fts_docsize" WHERE "id" = OLD."rowid");
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS "msglog_fts_update" AFTER UPDATE OF "text" ON "msglog"
+    WHEN OLD."text" IS NOT NEW."text"
+    BEGIN
+        INSERT INTO "msglog_fts" ("msglog_fts", "rowid", "text") SELECT 'delete', OLD."rowid", OLD."text"
+            WHERE EXISTS (SELECT 1 FROM "msglog_fts_docsize" WHERE "id" = OLD."rowid");
+        INSERT INTO "msglog_fts" ("rowid", "text") VALUES (NEW."rowid", NEW."text");
+    END""",
+]
+"""Triggers to keep ``MsgLogIndex`` in sync with message log writes."""
+
+
+def create_search_index() -> bool:
+    """Create the full-text index of message logs with its triggers.
+    Existing message logs are indexed by the backfill of migration 11.
+
+    Models must be bound to the database to create the index in.
+
+    Returns:
+        If the index is created, i.e. if FTS5 with the trigram tokenizer
+        is supported by SQLite.
+    """
+    if sqlite3.sqlite_version_info < (3, 34, 0) or not MsgLogIndex.fts5_installed():
+        logging.getLogger(__name__).warning(
+            "Full-text search is not supported by SQLite %s, message search falls back to table scans.",
+            sqlite3.sqlite_version)
+        return False
+    MsgLogIndex.create_table()
+    for trigger in MSG_LOG_INDEX_TRIGGERS:
+        MsgLogIndex._meta.database.execute_sql(trigger)
+    return True
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    """ID of the migration applied, see ``MIGRATIONS``."""
+    description = TextField()
+    """Description of the migration."""
+    applied_at = DateTimeField(default=datetime.datetime.now)
+    """Time when the migration is applied."""
+    backfilled = BooleanField(default=True)
+    """If the data backfill of the migration, if any, is finished."""
+
+
+MODELS: List[Type[Model]] = [ChatAssoc, MsgLog, SlaveChatInfo, ChatActivity, MsgReaction, MsgLogIndex, SchemaVersion]
+
+
+def upsert_message_logs_query(rows: List[Dict[str, Any]]) -> ModelInsert:
+    """Query to insert or update message logs, see
+    ``BaseDatabaseManager._save_message_log``.
+    """
+    return MsgLog.insert_many(rows).on_conflict(
+        conflict_target=[MsgLog.master_msg_id],
+        preserve=[getattr(MsgLog, i) for i in rows[0]
+                  if i not in ('master_msg_id', 'pickle', 'target_msg_id', 'time')],
+        update={MsgLog.pickle: fn.COALESCE(EXCLUDED.pickle, MsgLog.pickle),
+                MsgLog.target_msg_id: Case(None, [(EXCLUDED.pickle.is_null(), MsgLog.target_msg_id)],
+                                           EXCLUDED.target_msg_id)}
+    )
+
+
+BackfillFunc = Callable[[int], int]
+"""Backfill part of the data affected by a migration.
+
+Takes the maximum number of rows to process in this batch, and returns the
+number of rows actually processed. Return 0 when there is nothing left to
+backfill. Backfill functions must be idempotent, as a batch can be
+interrupted and run again.
+"""
+
+
+class Migration(NamedTuple):
+    version: int
+    """ID of the migration, in the order of application."""
+    description: str
+    upgrade: Callable[[SqliteMigrator], None]
+    """Schema changes, applied in a transaction before the database is
+    available to other components."""
+    backfill: Optional[BackfillFunc] = None
+    """Data changes on large tables, applied in batches. These may run in
+    background after ETM has started if ``online_migration`` is enabled,
+    anything depending on it must work with partially backfilled data.
+    """
+    background: bool = False
+    """If the backfill always runs in background, regardless of
+    ``online_migration``, as nothing but optional features depend on it."""
+
+
+MIGRATIONS: List[Migration] = []
+"""Ordered registry of all database migrations."""
+
+
+def register_migration(version: int, description: str,
+                       backfill: Optional[BackfillFunc] = None,
+                       background: bool = False) -> Callable[[Callable[[SqliteMigrator], None]],
+                                                             Callable[[SqliteMigrator], None]]:
+    """Register a schema migration to ``MIGRATIONS``.
+
+    Migrations must be registered in the order of their version.
+    """
+    def decorator(upgrade: Callable[[SqliteMigrator], None]) -> Callable[[SqliteMigrator], None]:
+        assert version == len(MIGRATIONS), \
+            f"Migration {version} is registered out of order, expecting {len(MIGRATIONS)}."
+        MIGRATIONS.append(Migration(version, description, upgrade, backfill, background))
+        return upgrade
+    return decorator
+
+
+@register_migration(0, "Add media file ID and editable message ID")
+def _migration_0(migrator: SqliteMigrator):
+    # 2019JAN08
+    migrate(
+        migrator.add_column("msglog", "file_id", MsgLog.file_id),
+        migrator.add_column("msglog", "media_type", MsgLog.media_type),
+        migrator.add_column("msglog", "mime", MsgLog.mime),
+        migrator.add_column("msglog", "master_msg_id_alt", MsgLog.master_msg_id_alt)
+    )
+
+
+@register_migration(1, "Add pickle objects to MsgLog and SlaveChatInfo")
+def _migration_1(migrator: SqliteMigrator):
+    # 2019JUL24
+    migrate(
+        migrator.add_column("msglog", "pickle", MsgLog.pickle),
+        migrator.add_column("slavechatinfo", "pickle", SlaveChatInfo.pickle)
+    )
+
+
+@register_migration(2, "Add column for group ID to slave chat info table")
+def _migration_2(migrator: SqliteMigrator):
+    # 2019NOV18
+    migrate(
+        migrator.add_column("slavechatinfo", "slave_chat_group_id", SlaveChatInfo.slave_chat_group_id)
+    )
+
+
+@register_migration(3, "Add column for unique file ID to message log table")
+def _migration_3(migrator: SqliteMigrator):
+    # 2019NOV18
+    migrate(
+        migrator.add_column("msglog", "file_unique_id", MsgLog.file_unique_id)
+    )
+
+
+@register_migration(4, "Add indexes for lookups by slave message, slave chat and chat association")
+def _migration_4(migrator: SqliteMigrator):
+    # 2026OCT17
+    indexes: Dict[str, List[Tuple[str, ...]]] = {
+        "chatassoc": [("master_uid",), ("slave_uid",)],
+        "msglog": [("slave_origin_uid", "slave_message_id", "time"), ("slave_origin_uid", "time")],
+        "slavechatinfo": [("slave_channel_id", "slave_chat_uid", "slave_chat_group_id")],
+    }
+    operations = []
+    for table, columns_list in indexes.items():
+        # Indexes might have been created by a previous version of this
+        # migration before the schema version table is introduced.
+        existing = {i.name for i in migrator.database.get_indexes(table)}
+        for columns in columns_list:
+            if make_index_name(table, columns) not in existing:
+                operations.append(migrator.add_index(table, columns))
+    migrate(*operations)
+
+
+@register_migration(5, "Add unique index for slave chat info")
+def _migration_5(migrator: SqliteMigrator):
+    # 2026OCT17
+    # Remove duplicate entries, keep the one that has been looked up and updated.
+    migrator.database.execute_sql(
+        "DELETE FROM slavechatinfo WHERE id NOT IN ("
+        "SELECT MIN(id) FROM slavechatinfo "
+        "GROUP BY slave_channel_id, slave_chat_uid, COALESCE(slave_chat_group_id, ''))"
+    )
+    migrate(migrator.drop_index("slavechatinfo", make_index_name(
+        "slavechatinfo", ("slave_channel_id", "slave_chat_uid", "slave_chat_group_id"))))
+    migrator.database.execute(SlaveChatInfo.index(*SLAVE_CHAT_INFO_KEY, unique=True,
+                                                  name="slavechatinfo_slave_chat_key"))
+
+
+def _backfill_migration_6(limit: int) -> int:
+    sep = fn.INSTR(MsgLog.master_msg_id, '.')
+    batch = MsgLog.select(MsgLog.master_msg_id).where(MsgLog.master_chat_id.is_null()).limit(limit)
+    # Malformed IDs are cast to 0, so that they are not selected again.
+    return MsgLog.update(
+        master_chat_id=fn.SUBSTR(MsgLog.master_msg_id, 1, sep - 1).cast('INTEGER'),
+        master_message_id=fn.SUBSTR(MsgLog.master_msg_id, sep + 1).cast('INTEGER'),
+    ).where(MsgLog.master_msg_id.in_(batch)).execute()
+
+
+@register_migration(6, "Add integer Telegram chat and message ID columns to message log table",
+                    backfill=_backfill_migration_6)
+def _migration_6(migrator: SqliteMigrator):
+    # 2026OCT17
+    migrate(
+        migrator.add_column("msglog", "master_chat_id", MsgLog.master_chat_id),
+        migrator.add_column("msglog", "master_message_id", MsgLog.master_message_id),
+        migrator.add_index("msglog", ("master_chat_id", "slave_origin_uid", "time")),
+    )
+
+
+@register_migration(7, "Add chat activity table")
+def _migration_7(migrator: SqliteMigrator):
+    # 2026OCT17
+    ChatActivity.create_table()
+    for trigger in CHAT_ACTIVITY_TRIGGERS:
+        migrator.database.execute_sql(trigger)
+    # Aggregation is done with the index on slave_origin_uid and time.
+    ChatActivity.insert_from(
+        MsgLog.select(MsgLog.slave_origin_uid, fn.MAX(MsgLog.time), fn.COUNT(MsgLog.master_msg_id))
+              .group_by(MsgLog.slave_origin_uid),
+        [ChatActivity.slave_origin_uid, ChatActivity.last_message_time, ChatActivity.message_count]
+    ).execute()
+
+
+def _reencode(data: bytes, encode: Callable[[Any], bytes]) -> bytes:
+    # noinspection PyBroadException
+    try:
+        return encode(serialization.loads_pickle(data))
+    except Exception:
+        # Keep pickles that cannot be loaded as is, marked as converted.
+        return serialization.VERSIONS[serialization.PICKLE] + data
+
+
+def _backfill_migration_8(limit: int) -> int:
+    count = 0
+    tables = (
+        (MsgLog, MsgLog.master_msg_id, serialization.encode_misc_msg),
+        (SlaveChatInfo, SlaveChatInfo.id, encode_chat),
+    )
+    for model, key, encode in tables:
+        rows = list(model.select(key, model.pickle).where(
+            model.pickle.is_null(False) & fn.SUBSTR(model.pickle, 1, 1).not_in(serialization.VERSIONS)
+        ).limit(limit - count).tuples().iterator())
+        for pk, data in rows:
+            model.update({model.pickle: _reencode(data, encode)}).where(key == pk).execute()
+        count += len(rows)
+        if count >= limit:
+            break
+    return count
+
+
+@register_migration(8, "Convert pickled data to versioned encoding", backfill=_backfill_migration_8)
+def _migration_8(migrator: SqliteMigrator):
+    # 2026OCT17
+    # No schema change, data is converted in backfill.
+    pass
+
+
+def _backfill_migration_9(limit: int) -> int:
+    rows = list(MsgLog.select(MsgLog.master_msg_id, MsgLog.pickle).where(
+        MsgLog.pickle.is_null(False) & MsgLog.target_msg_id.is_null()
+    ).limit(limit).tuples().iterator())
+    for master_msg_id, data in rows:
+        # noinspection PyBroadException
+        try:
+            target = serialization.decode_misc_msg(data).get('target')
+        except Exception:
+            target = None
+        # Messages without target are marked with an empty string, so that
+        # they are not selected again.
+        MsgLog.update(target_msg_id=target or '').where(MsgLog.master_msg_id == master_msg_id).execute()
+    return len(rows)
+
+
+@register_migration(9, "Add reply target column to message log table", backfill=_backfill_migration_9)
+def _migration_9(migrator: SqliteMigrator):
+    # 2026OCT17
+    migrate(
+        migrator.add_column("msglog", "target_msg_id", MsgLog.target_msg_id),
+        migrator.add_index("msglog", ("target_msg_id",)),
+        migrator.add_index("msglog", ("time",)),
+    )
+
+
+class _ReactionsBackfill:
+    """Move reactions in pickled data of message logs to ``MsgReaction``.
+
+    Message logs are scanned in batches in order of their row ID, from the
+    start again if interrupted.
+    """
+
+    def __init__(self):
+        self.last_row_id = 0
+
+    def __call__(self, limit: int) -> int:
+        rows = list(MsgLog.select(SQL("rowid"), MsgLog.master_msg_id, MsgLog.pickle)
+                    .where(SQL("rowid") > self.last_row_id).order_by(SQL("rowid")).limit(limit).tuples().iterator())
+        for row_id, master_msg_id, data in rows:
+            self.last_row_id = row_id
+            if not data:
+                continue
+            # noinspection PyBroadException
+            try:
+                misc_data = serialization.decode_misc_msg(data)
+            except Exception:
+                continue
+            reactions = misc_data.pop('reactions', None)
+            if reactions is None:
+                continue
+            # Reactions updated after the migration are newer.
+            if not MsgReaction.select().where(MsgReaction.master_msg_id == master_msg_id).exists():
+                MsgReaction.insert_many(
+                    {"master_msg_id": master_msg_id, "reaction": k, "member_uid": i}
+                    for k, v in reactions.items() for i in v
+                ).on_conflict_ignore().execute()
+            MsgLog.update(pickle=serialization.encode_misc_msg(misc_data) if misc_data else None) \
+                .where(MsgLog.master_msg_id == master_msg_id).execute()
+        return len(rows)
+
+
+@register_migration(10, "Add message reactions table", backfill=_ReactionsBackfill())
+def _migration_10(migrator: SqliteMigrator):
+    # 2026OCT17
+    MsgReaction.create_table()
+    for trigger in MSG_REACTION_TRIGGERS:
+        migrator.database.execute_sql(trigger)
+
+
+class _SearchIndexBackfill:
+    """Index existing message logs for full-text search.
+
+    Message logs are scanned in batches in order of their row ID, those
+    already indexed, e.g. by triggers, are skipped.
+    """
+
+    def __init__(self):
+        self.last_row_id = 0
+
+    def __call__(self, limit: int) -> int:
+        if not MsgLogIndex.table_exists():
+            return 0
+        row_ids = [i for i, in MsgLog.select(SQL("rowid")).where(SQL("rowid") > self.last_row_id)
+                   .order_by(SQL("rowid")).limit(limit).tuples().execute()]
+        if not row_ids:
+            return 0
+        MsgLogIndex._meta.database.execute_sql(
+            'INSERT INTO "msglog_fts" ("rowid", "text") SELECT "rowid", "text" FROM "msglog" '
+            'WHERE "rowid" > ? AND "rowid" <= ? AND "rowid" NOT IN (SELECT "id" FROM "msglog_fts_docsize")',
+            (self.last_row_id, row_ids[-1]))
+        self.last_row_id = row_ids[-1]
+        return len(row_ids)
+
+
+@register_migration(11, "Add full-text index of message logs", backfill=_SearchIndexBackfill(), background=True)
+def _migration_11(migrator: SqliteMigrator):
+    # 2026OCT17
+    create_search_index()
+
+
+class BaseDatabaseManager(ABC):
+    """Storage of chat associations, message logs and slave chat info.
+
+    :class:`DatabaseManager` stores them in SQLite, other backends are
+    chosen with the ``database_backend`` experimental flag, see
+    :func:`create_database_manager`. Records are returned as model
+    instances regardless of the backend, which need not be saved.
+
+    Chat associations are indexed in memory by this class, backends only
+    persist them.
+    """
+
+    logger = logging.getLogger(__name__)
+    FAIL_FLAG = '__fail__'
+
+    def __init__(self):
+        self.last_message_times: Dict[EFBChannelChatIDStr, datetime.datetime] = {}
+        """Time of the last message logged in each slave chat."""
+        self.last_message_lock = threading.Lock()
+        """Lock of writes to ``last_message_times`` after loading."""
+        self.chat_assoc_lock = threading.RLock()
+        """Lock of chat association writes and their in-memory index."""
+        self.master_links: Dict[EFBChannelChatIDStr, List[EFBChannelChatIDStr]] = {}
+        """Slave chats linked to each Telegram chat, in order of linking."""
+        self.slave_links: Dict[EFBChannelChatIDStr, List[EFBChannelChatIDStr]] = {}
+        """Telegram chats linked to each slave chat, in order of linking."""
+
+    def _index_chat_assocs(self, links: Iterable[Tuple[EFBChannelChatIDStr, EFBChannelChatIDStr]]):
+        """Load chat associations persisted, as pairs of master and slave
+        chat UIDs in order of linking, to the in-memory index.
         """
-        Run migrations.
+        for master_uid, slave_uid in links:
+            self.master_links.setdefault(master_uid, []).append(slave_uid)
+            self.slave_links.setdefault(slave_uid, []).append(master_uid)
 
-        Args:
-            i: Migration ID
-        """
-        migrator = SqliteMigrator(database)
-
-        if i <= 0:
-            # Migration 0: Add media file ID and editable message ID
-            # 2019JAN08
-            migrate(
-                migrator.add_column("msglog", "file_id", MsgLog.file_id),
-                migrator.add_column("msglog", "media_type", MsgLog.media_type),
-                migrator.add_column("msglog", "mime", MsgLog.mime),
-                migrator.add_column("msglog", "master_msg_id_alt", MsgLog.master_msg_id_alt)
-            )
-        if i <= 1:
-            # Migration 1: Add pickle objects to MsgLog and SlaveChatInfo
-            # 2019JUL24
-            migrate(
-                migrator.add_column("msglog", "pickle", MsgLog.pickle),
-                migrator.add_column("slavechatinfo", "pickle", SlaveChatInfo.pickle)
-            )
-        if i <= 2:
-            # Migration 2: Add column for group ID to slave chat info table
-            # 2019NOV18
-            migrate(
-                migrator.add_column("slavechatinfo", "slave_chat_group_id", SlaveChatInfo.slave_chat_group_id)
-            )
-        if i <= 3:
-            # Migration 3: Add column for unique file ID to message log table
-            # 2019NOV18
-            migrate(
-                migrator.add_column("msglog", "file_unique_id", MsgLog.file_unique_id)
-            )
+    def stop_worker(self):
+        """Stop background workers and close the storage."""
 
     def add_chat_assoc(self, master_uid: EFBChannelChatIDStr,
                        slave_uid: EFBChannelChatIDStr,
@@ -260,13 +743,16 @@ class DatabaseManager:
             slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
             multiple_slave: Allow linking to multiple slave channels.
         """
-        if not multiple_slave:
-            self.remove_chat_assoc(master_uid=master_uid)
-        self.remove_chat_assoc(slave_uid=slave_uid)
-        return ChatAssoc.create(master_uid=master_uid, slave_uid=slave_uid)
+        with self.chat_assoc_lock:
+            if not multiple_slave:
+                self.remove_chat_assoc(master_uid=master_uid)
+            self.remove_chat_assoc(slave_uid=slave_uid)
+            result = self._insert_chat_assoc(master_uid, slave_uid)
+            self.master_links.setdefault(master_uid, []).append(slave_uid)
+            self.slave_links.setdefault(slave_uid, []).append(master_uid)
+            return result
 
-    @staticmethod
-    def remove_chat_assoc(master_uid: Optional[EFBChannelChatIDStr] = None,
+    def remove_chat_assoc(self, master_uid: Optional[EFBChannelChatIDStr] = None,
                           slave_uid: Optional[EFBChannelChatIDStr] = None):
         """
         Remove chat associations (chat links).
@@ -276,25 +762,76 @@ class DatabaseManager:
             master_uid (str): Master chat UID ("%(chat_id)s")
             slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
         """
-        try:
-            if bool(master_uid) == bool(slave_uid):
-                raise ValueError("Only one parameter is to be provided.")
-            elif master_uid:
-                return ChatAssoc.delete().where(ChatAssoc.master_uid == master_uid).execute()
+        if bool(master_uid) == bool(slave_uid):
+            raise ValueError("Only one parameter is to be provided.")
+        with self.chat_assoc_lock:
+            result = self._delete_chat_assocs(master_uid=master_uid, slave_uid=slave_uid)
+            if master_uid:
+                links, counterparts, uid = self.master_links, self.slave_links, master_uid
             elif slave_uid:
-                return ChatAssoc.delete().where(ChatAssoc.slave_uid == slave_uid).execute()
-        except DoesNotExist:
-            return 0
+                links, counterparts, uid = self.slave_links, self.master_links, slave_uid
+            for counterpart in links.pop(uid, []):
+                remaining = [i for i in counterparts.get(counterpart, []) if i != uid]
+                if remaining:
+                    counterparts[counterpart] = remaining
+                else:
+                    counterparts.pop(counterpart, None)
+            return result
 
-    @staticmethod
-    def get_master_msg_id(message: EFBMessage) -> Optional[EFBChannelChatIDStr]:
+    @abstractmethod
+    def _insert_chat_assoc(self, master_uid: EFBChannelChatIDStr, slave_uid: EFBChannelChatIDStr) -> Any:
+        """Persist a chat association."""
+
+    @abstractmethod
+    def _delete_chat_assocs(self, master_uid: Optional[EFBChannelChatIDStr] = None,
+                            slave_uid: Optional[EFBChannelChatIDStr] = None) -> int:
+        """Delete persisted chat associations of a chat.
+
+        Returns:
+            Number of chat associations deleted.
+        """
+
+    def get_chat_assoc(self, master_uid: Optional[EFBChannelChatIDStr] = None,
+                       slave_uid: Optional[EFBChannelChatIDStr] = None
+                       ) -> List[EFBChannelChatIDStr]:
+        """
+        Get chat association (chat link) information.
+        Only one parameter is to be provided.
+
+        Chat associations are looked up from memory, see ``master_links``
+        and ``slave_links``.
+
+        Args:
+            master_uid (str): Master channel UID ("%(chat_id)s")
+            slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
+
+        Returns:
+            list: The counterpart ID.
+        """
+        if bool(master_uid) == bool(slave_uid):
+            raise ValueError("Only one parameter is to be provided.")
+        with self.chat_assoc_lock:
+            if master_uid:
+                return list(self.master_links.get(master_uid, []))
+            else:
+                return list(self.slave_links.get(slave_uid, []))  # type: ignore
+
+    def get_active_chats(self, since: datetime.datetime) -> Set[EFBChannelChatIDStr]:
+        """Get slave chats linked to Telegram chats, or with messages
+        logged since a time, from memory.
+        """
+        with self.chat_assoc_lock:
+            active = {k for k, v in self.slave_links.items() if v}
+        with self.last_message_lock:
+            active.update(k for k, v in self.last_message_times.items() if v > since)
+        return active
+
+    def get_master_msg_id(self, message: EFBMessage) -> Optional[TgChatMsgIDStr]:
         """Get master message ID from a message object."""
-        log: Optional[MsgLog] = MsgLog.get_or_none(
-            MsgLog.slave_origin_uid == chat_id_to_str(chat=message.chat),
-            MsgLog.slave_message_id == message.uid
-        )
+        log = self.get_msg_log(slave_msg_id=message.uid,
+                               slave_origin_uid=chat_id_to_str(chat=message.chat))
         if log:
-            return log.master_msg_id
+            return TgChatMsgIDStr(log.master_msg_id)
         return None
 
     def pickle_misc_msg(self, message: EFBMessage) -> Optional[bytes]:
@@ -308,9 +845,18 @@ class DatabaseManager:
         - ``attributes``
         - ``commands``
         - ``substitutions``: ``Dict[Tuple[int, int], SlaveChatID]``
-        - ``reactions``: ``Dict[str, Collection[SlaveChatID]]``
+
+        Reactions are stored separately, see :meth:`set_message_reactions`.
         """
+        data = self._misc_msg_data(message)
+        if data:
+            return serialization.encode_misc_msg(data)  # type: ignore
+        return None
 
+    def _misc_msg_data(self, message: EFBMessage) -> PickledDict:
+        """Miscellaneous information of a message to be pickled, see
+        :meth:`pickle_misc_msg`.
+        """
         data: PickledDict = {}
         if message.is_system:
             data['is_system'] = message.is_system
@@ -323,63 +869,19 @@ class DatabaseManager:
                 k: chat_id_to_str(chat=v)
                 for k, v in message.substitutions.items()
             }
-        if message.reactions:
-            data['reactions'] = {
-                k: tuple(chat_id_to_str(chat=i) for i in v)
-                for k, v in message.reactions.items()
-            }
         if message.target:
             target_id = self.get_master_msg_id(message.target)
             if target_id:
                 data['target'] = target_id
-
-        if data:
-            return pickle.dumps(data)
-        return None
-
-    @staticmethod
-    def get_chat_assoc(master_uid: Optional[EFBChannelChatIDStr] = None,
-                       slave_uid: Optional[EFBChannelChatIDStr] = None
-                       ) -> List[EFBChannelChatIDStr]:
-        """
-        Get chat association (chat link) information.
-        Only one parameter is to be provided.
-
-        Args:
-            master_uid (str): Master channel UID ("%(chat_id)s")
-            slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
-
-        Returns:
-            list: The counterpart ID.
-        """
-        try:
-            if bool(master_uid) == bool(slave_uid):
-                raise ValueError("Only one parameter is to be provided.")
-            elif master_uid:
-                slaves = ChatAssoc.select(ChatAssoc.slave_uid, ChatAssoc.master_uid)\
-                    .where(ChatAssoc.master_uid == master_uid)
-                if len(slaves) > 0:
-                    return [i.slave_uid for i in slaves]
-                else:
-                    return []
-            elif slave_uid:
-                masters = ChatAssoc.select(ChatAssoc.slave_uid, ChatAssoc.master_uid)\
-                    .where(ChatAssoc.slave_uid == slave_uid)
-                if len(masters) > 0:
-                    return [i.master_uid for i in masters]
-                else:
-                    return []
-            else:
-                return []
-        except DoesNotExist:
-            return []
+        return data
 
     def add_or_update_message_log(self,
                                   msg: ETMMsg,
                                   master_message: Message,
                                   old_message_id: Optional[OldMsgID] = None):
         """Add or update a message into the database."""
-        master_msg_id = message_id_to_str(TelegramChatID(master_message.chat_id), TelegramMessageID(master_message.message_id))
+        master_id: OldMsgID = (TelegramChatID(master_message.chat_id), TelegramMessageID(master_message.message_id))
+        master_msg_id = message_id_to_str(*master_id)
         master_msg_id_alt = None
         self.logger.debug("[%s] Received message logging request of %s", master_msg_id, msg.uid)
 
@@ -388,39 +890,691 @@ class DatabaseManager:
             if master_msg_id != old_message_id_str:
                 self.logger.debug("[%s] Message has an old ID: %s", master_msg_id, old_message_id_str)
                 master_msg_id, master_msg_id_alt = old_message_id_str, master_msg_id
+                master_id = old_message_id
+
+        misc_data = self._misc_msg_data(msg)
+        row: MsgLogRow = {
+            "master_msg_id": master_msg_id,
+            "master_msg_id_alt": master_msg_id_alt,
+            "master_chat_id": master_id[0],
+            "master_message_id": master_id[1],
+            "text": msg.text,
+            "slave_origin_uid": chat_id_to_str(chat=msg.chat),
+            "slave_member_uid": chat_id_to_str(chat=msg.author),
+            "msg_type": msg.type.name,
+            "sent_to": msg.deliver_to.channel_id,
+            "slave_message_id": msg.uid or f"{self.FAIL_FLAG}.{time.time()}",
+            "media_type": msg.type_telegram.value,
+            "file_id": msg.file_id,
+            "file_unique_id": msg.file_unique_id,
+            "mime": msg.mime,
+            "pickle": serialization.encode_misc_msg(misc_data) if misc_data else None,  # type: ignore
+            "target_msg_id": misc_data.get('target'),
+            "time": datetime.datetime.now(),
+        }
+
+        # Edited messages also count as activity until the next restart.
+        with self.last_message_lock:
+            if self.last_message_times.get(row['slave_origin_uid'], datetime.datetime.min) < row['time']:
+                self.last_message_times[row['slave_origin_uid']] = row['time']
+
+        self._save_message_log(row)
+        if msg.reactions:
+            self.set_message_reactions(master_msg_id, msg.reactions)
+
+    @abstractmethod
+    def _save_message_log(self, row: MsgLogRow):
+        """Insert or update a message log.
+
+        Everything except for the time of the message is updated for
+        existing records. Previous pickled data and reply target are kept if
+        nothing is to be pickled this time.
+        """
+
+    @staticmethod
+    def _check_msg_log_key(master_msg_id: Optional[TgChatMsgIDStr] = None,
+                           slave_msg_id: Optional[str] = None,
+                           slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[SlaveMsgKey]:
+        """Check arguments to look up a message log by.
+
+        Returns:
+            Key of the slave message to look up, ``None`` if looked up by
+            ``master_msg_id``.
+        """
+        if (master_msg_id and (slave_msg_id or slave_origin_uid)) \
+                or not (master_msg_id or (slave_msg_id or slave_origin_uid)):
+            raise ValueError('master_msg_id and slave_msg_id is mutual exclusive')
+        if master_msg_id:
+            return None
+        if not (slave_msg_id and slave_origin_uid):
+            raise ValueError('slave_msg_id and slave_origin_uid must exists together.')
+        return slave_origin_uid, slave_msg_id
+
+    @abstractmethod
+    def get_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                    slave_msg_id: Optional[MessageID] = None,
+                    slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[MsgLog]:
+        """Get message log by message ID.
+
+        Args:
+            master_msg_id: Telegram message ID in string
+            slave_msg_id: Slave message identifier in string
+            slave_origin_uid: Slave chat identifier in string
+
+        Returns:
+            Optional[MsgLog]: The queried entry, None if not exist.
+        """
+
+    @abstractmethod
+    def delete_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                       slave_msg_id: Optional[EFBChannelChatIDStr] = None,
+                       slave_origin_uid: Optional[EFBChannelChatIDStr] = None):
+        """Remove a message log by message ID, with its reactions.
+
+        Args:
+            master_msg_id: Telegram message ID in string
+            slave_msg_id: Slave message identifier in string
+            slave_origin_uid: Slave chat identifier in string
+        """
+
+    @abstractmethod
+    def get_slave_chat_info(self, slave_channel_id: Optional[ModuleID] = None,
+                            slave_chat_uid: Optional[ChatID] = None,
+                            slave_chat_group_id: Optional[ChatID] = None
+                            ) -> Optional[SlaveChatInfo]:
+        """
+        Get cached slave chat info from database.
+
+        Returns:
+            SlaveChatInfo|None: The matching slave chat info, None if not exist.
+        """
+
+    @staticmethod
+    def _slave_chat_info_row(chat_object: 'ETMChatType') -> Dict[str, Any]:
+        """Column values of the slave chat info entry of a chat, keyed by
+        field name.
+        """
+        parent_chat: Optional['ETMChatType'] = getattr(chat_object, 'chat', None)
+        slave_chat_group_id: Optional[ChatID]
+        if parent_chat:
+            slave_chat_group_id = parent_chat.uid
+        else:
+            slave_chat_group_id = None
+
+        return {
+            "slave_channel_id": chat_object.module_id,
+            "slave_channel_emoji": chat_object.channel_emoji,
+            "slave_chat_uid": chat_object.uid,
+            "slave_chat_group_id": slave_chat_group_id,
+            "slave_chat_name": chat_object.name,
+            "slave_chat_alias": chat_object.alias,
+            "slave_chat_type": chat_object.chat_type_name,
+            "pickle": chat_object.pickle,
+        }
+
+    @abstractmethod
+    def set_slave_chat_info(self, chat_object: 'ETMChatType') -> SlaveChatInfo:
+        """
+        Insert or update slave chat info entry
+
+        Args:
+            chat_object (ETMChatType): Chat object for pickling
+
+        Returns:
+            SlaveChatInfo: The values inserted or updated, not including
+            the row ID.
+        """
+
+    @abstractmethod
+    def delete_slave_chat_info(self, slave_channel_id: ModuleID, slave_chat_uid: ChatID,
+                               slave_chat_group_id: Optional[ChatID] = None) -> int:
+        """Remove a slave chat info entry.
+
+        Returns:
+            Number of entries removed.
+        """
+
+    @abstractmethod
+    def get_recent_slave_chats(self, master_chat_id: TelegramChatID, limit=5) -> List[EFBChannelChatIDStr]:
+        """Get slave chats with messages delivered to a Telegram chat, latest
+        first.
+        """
+
+    @abstractmethod
+    def search_message_logs(self, query: str, master_chat_id: Optional[TelegramChatID] = None,
+                            limit_per_chat: int = 5, limit: int = 100) -> List[MsgLog]:
+        """Search message logs by text, with the best matches in each slave
+        chat.
+
+        Message logs must contain all terms in the query, case-insensitively.
+
+        Args:
+            query: Terms to search, separated by whitespaces.
+            master_chat_id: Telegram chat to search in, all chats if not given.
+            limit_per_chat: Maximum number of message logs from each slave chat.
+            limit: Maximum number of message logs in total.
+
+        Returns:
+            Message logs grouped by slave chat, starting from the chat with
+            the best match, and from the best match in each chat.
+        """
+
+    def get_last_message_time(self, slave_chat_id: EFBChannelChatIDStr) -> datetime.datetime:
+        """Get the time of the last message logged in a slave chat.
+
+        Returns:
+            ``datetime.min`` if no message is logged in the chat.
+        """
+        return self.last_message_times.get(slave_chat_id, datetime.datetime.min)
+
+    @abstractmethod
+    def get_last_message(self, slave_chat_id: EFBChannelChatIDStr) -> Optional[MsgLog]:
+        """Get the latest message log in a slave chat."""
+
+    @abstractmethod
+    def get_message_reactions(self, master_msg_id: TgChatMsgIDStr) -> Dict[ReactionName, List[EFBChannelChatIDStr]]:
+        """Get reactions to a message, in the order they are added.
+
+        Returns:
+            IDs of members reacted, by reaction name.
+        """
+
+    def set_message_reactions(self, master_msg_id: TgChatMsgIDStr, reactions: Reactions):
+        """Replace reactions to a message, only reactions added or removed
+        are written to the database.
+        """
+        current = {(k, i) for k, v in self.get_message_reactions(master_msg_id).items() for i in v}
+        new = {(k, chat_id_to_str(chat=i)): None for k, v in reactions.items() for i in v}
+        removed: Dict[ReactionName, List[EFBChannelChatIDStr]] = {}
+        for reaction, member_uid in current.difference(new):
+            removed.setdefault(reaction, []).append(member_uid)
+        added = [(reaction, member_uid) for reaction, member_uid in new if (reaction, member_uid) not in current]
+        self._update_message_reactions(master_msg_id, removed, added)
+
+    @abstractmethod
+    def _update_message_reactions(self, master_msg_id: TgChatMsgIDStr,
+                                  removed: Dict[ReactionName, List[EFBChannelChatIDStr]],
+                                  added: List[Tuple[ReactionName, EFBChannelChatIDStr]]):
+        """Remove and add reactions to a message, ``added`` in order."""
+
+
+class DatabaseManager(BaseDatabaseManager):
+    """Storage in a SQLite database in the data directory of the channel."""
+
+    BACKFILL_BATCH_SIZE = 1000
+    """Number of rows to process in each batch of migration backfill."""
+    BACKFILL_INTERVAL = 0.1
+    """Seconds to wait between batches of online migration backfill."""
+    MAINTENANCE_BATCH_SIZE = 500
+    """Number of message logs to delete in each batch of database maintenance."""
+    MAINTENANCE_VACUUM_PAGES = 1000
+    """Number of free pages to reclaim in each batch of incremental vacuum."""
+    MAINTENANCE_INTERVAL = 0.1
+    """Seconds to wait between batches of scheduled database maintenance."""
+    MAINTENANCE_STARTUP_DELAY = 300
+    """Maximum seconds to wait before the first scheduled database maintenance."""
+    READ_POOL_TIMEOUT = 10
+    """Seconds to wait for a free connection in the read-only pool."""
+    SEARCH_MIN_TERM_LENGTH = 3
+    """Minimum length of search terms looked up in the full-text index."""
+
+    def __init__(self, channel: 'TelegramChannel'):
+        base_path = utils.get_data_path(channel.channel_id)
+        db_path = str(base_path / 'tgdata.db')
+
+        self.logger.debug("Checking database migration...")
+        # Migrations are applied with a dedicated connection before the
+        # queued writer starts, so that each of them can run in a transaction.
+        # Incremental vacuum only takes effect on new databases.
+        migration_db = SqliteDatabase(db_path, pragmas={'auto_vacuum': 'incremental', 'journal_mode': 'wal'})
+        with migration_db.bind_ctx(MODELS):
+            pending_backfills = self._upgrade(migration_db)
+            if not channel.flag("online_migration"):
+                for migration in pending_backfills:
+                    if not migration.background:
+                        self._backfill(migration)
+                pending_backfills = [i for i in pending_backfills if i.background]
+        migration_db.close()
+        self.logger.debug("Database migration finished...")
+
+        self.logger.debug("Loading database...")
+        pragmas = {**DEFAULT_PRAGMAS, **channel.flag("database_pragmas")}
+        database.init(db_path, pragmas={**pragmas, 'journal_mode': 'wal'})
+        database.start()
+        database.connect()
+        if channel.flag("database_read_connections") > 0:
+            read_database.init(f"file:{urllib.request.pathname2url(db_path)}?mode=ro", uri=True,
+                               check_same_thread=False,
+                               pragmas={k: v for k, v in pragmas.items() if k != 'journal_mode'},
+                               max_connections=channel.flag("database_read_connections"),
+                               timeout=self.READ_POOL_TIMEOUT)
+        self.logger.debug("Database loaded.")
+
+        super().__init__()
+        self.search_index_enabled: bool = MsgLogIndex.table_exists()
+        """If message logs are indexed for full-text search, see ``create_search_index``."""
+
+        # Last message times are kept by triggers, see ``ChatActivity``.
+        self.last_message_times.update(
+            (uid, last_message_time) for uid, last_message_time in
+            ChatActivity.select(ChatActivity.slave_origin_uid, ChatActivity.last_message_time).tuples().iterator()
+            if last_message_time is not None
+        )
+        self._index_chat_assocs(ChatAssoc.select(ChatAssoc.master_uid, ChatAssoc.slave_uid)
+                                .order_by(ChatAssoc.id).tuples().iterator())
+
+        self.message_log_cache: Optional[MessageLogCache] = None
+        if channel.flag("message_log_cache_size") > 0:
+            self.message_log_cache = MessageLogCache(channel.flag("message_log_cache_size"))
+
+        self.message_log_buffer: Optional[MessageLogBuffer] = None
+        if channel.flag("message_log_write_behind"):
+            self.message_log_buffer = MessageLogBuffer(self._write_message_logs,
+                                                       batch_size=channel.flag("message_log_batch_size"),
+                                                       interval=channel.flag("message_log_flush_interval"))
+
+        self._backfill_stop = threading.Event()
+        self.pending_backfills: Set[int] = {i.version for i in pending_backfills}
+        """Versions of migrations with data yet to be backfilled."""
+        self._backfill_thread: Optional[threading.Thread] = None
+        if pending_backfills:
+            self._backfill_thread = threading.Thread(target=self._backfill_worker, args=(pending_backfills,),
+                                                     name="ETM database backfill thread", daemon=True)
+            self._backfill_thread.start()
+
+        self.message_log_max_age: Optional[datetime.timedelta] = None
+        """Maximum age of message logs to keep."""
+        if channel.flag("message_log_max_age") > 0:
+            self.message_log_max_age = datetime.timedelta(days=channel.flag("message_log_max_age"))
+        self.message_log_max_rows_per_chat: int = channel.flag("message_log_max_rows_per_chat")
+        """Maximum number of message logs to keep in each slave chat, 0 for unlimited."""
+        self.database_max_size: int = channel.flag("database_max_size") * 1024 * 1024
+        """Maximum size of data in the database in bytes, 0 for unlimited."""
+        self.message_log_archive_after: Optional[datetime.timedelta] = None
+        """Age of message logs to move from the database to the archive."""
+        self.message_log_archive: Optional[MessageLogArchive] = None
+        if channel.flag("message_log_archive_after") > 0:
+            self.message_log_archive_after = datetime.timedelta(days=channel.flag("message_log_archive_after"))
+            self.message_log_archive = MessageLogArchive(base_path / 'archive')
+        self._maintenance_stop = threading.Event()
+        self._maintenance_thread: Optional[threading.Thread] = None
+        if channel.flag("database_maintenance_interval") > 0:
+            self._maintenance_thread = threading.Thread(target=self._maintenance_worker,
+                                                        args=(channel.flag("database_maintenance_interval"),),
+                                                        name="ETM database maintenance thread", daemon=True)
+            self._maintenance_thread.start()
+
+    def stop_worker(self):
+        self._backfill_stop.set()
+        self._maintenance_stop.set()
+        if self._backfill_thread is not None:
+            self._backfill_thread.join()
+        if self._maintenance_thread is not None:
+            self._maintenance_thread.join()
+        try:
+            if self.message_log_buffer is not None:
+                self.message_log_buffer.stop()
+        finally:
+            if self.message_log_cache is not None:
+                self.logger.debug("Message log cache statistics: %s", self.message_log_cache.stats())
+            if not read_database.deferred:
+                read_database.close_all()
+                read_database.init(None)
+            database.stop()
+
+    @staticmethod
+    def _detect_legacy_version(migration_db: SqliteDatabase) -> int:
+        """Find the first migration to apply on a database created before
+        the schema version table is introduced.
+        """
+        msg_log_columns = {i.name for i in migration_db.get_columns("msglog")}
+        msg_log_indexes = {i.name for i in migration_db.get_indexes("msglog")}
+        slave_chat_info_columns = {i.name for i in migration_db.get_columns("slavechatinfo")}
+        if "file_id" not in msg_log_columns:
+            return 0
+        elif "pickle" not in msg_log_columns:
+            return 1
+        elif "slave_chat_group_id" not in slave_chat_info_columns:
+            return 2
+        elif "file_unique_id" not in msg_log_columns:
+            return 3
+        elif "msglog_slave_origin_uid_time" not in msg_log_indexes:
+            return 4
+        return 5
+
+    def _upgrade(self, migration_db: SqliteDatabase) -> List[Migration]:
+        """Create or upgrade the database to the latest schema.
+
+        Models must be bound to ``migration_db`` when calling this method.
+
+        Returns:
+            Migrations which data is yet to be backfilled.
+        """
+        if not ChatAssoc.table_exists():
+            self.logger.info("Creating database...")
+            with migration_db.atomic():
+                migration_db.create_tables([i for i in MODELS if i is not MsgLogIndex])
+                for trigger in CHAT_ACTIVITY_TRIGGERS + MSG_REACTION_TRIGGERS:
+                    migration_db.execute_sql(trigger)
+                create_search_index()
+                SchemaVersion.insert_many(
+                    {"version": i.version, "description": i.description} for i in MIGRATIONS
+                ).execute()
+            return []
+
+        if not SchemaVersion.table_exists():
+            legacy_version = self._detect_legacy_version(migration_db)
+            self.logger.debug("Database has no schema version, detected migration %s is pending.", legacy_version)
+            with migration_db.atomic():
+                migration_db.create_tables([SchemaVersion])
+                applied = [{"version": i.version, "description": i.description}
+                           for i in MIGRATIONS[:legacy_version]]
+                if applied:
+                    SchemaVersion.insert_many(applied).execute()
+
+        applied_versions = {i.version: i for i in SchemaVersion.select()}
+        pending = [i for i in MIGRATIONS if i.version not in applied_versions]
+        for idx, migration in enumerate(pending):
+            self.logger.info("Applying database migration %s (%s/%s): %s",
+                             migration.version, idx + 1, len(pending), migration.description)
+            start = time.time()
+            with migration_db.atomic():
+                migration.upgrade(SqliteMigrator(migration_db))
+                SchemaVersion.create(version=migration.version, description=migration.description,
+                                     backfilled=migration.backfill is None)
+            self.logger.info("Database migration %s is applied in %.2f seconds.",
+                             migration.version, time.time() - start)
+
+        not_backfilled = {i.version for i in SchemaVersion.select().where(SchemaVersion.backfilled == False)}  # noqa: E712
+        return [i for i in MIGRATIONS if i.version in not_backfilled and i.backfill]
+
+    def _backfill(self, migration: Migration, stop: Optional[threading.Event] = None) -> bool:
+        """Backfill data of a migration in batches.
+
+        Args:
+            migration: The migration to backfill.
+            stop: Event to interrupt backfilling, backfill would resume
+                on next startup.
+
+        Returns:
+            If the backfill is finished.
+        """
+        assert migration.backfill
+        self.logger.info("Backfilling data for database migration %s: %s",
+                         migration.version, migration.description)
+        total = 0
+        while True:
+            if stop is not None and stop.is_set():
+                self.logger.info("Backfill of database migration %s is interrupted after %s rows.",
+                                 migration.version, total)
+                return False
+            count = migration.backfill(self.BACKFILL_BATCH_SIZE)
+            if not count:
+                break
+            total += count
+            self.logger.debug("Backfill of database migration %s: %s rows processed.", migration.version, total)
+            if stop is not None:
+                stop.wait(self.BACKFILL_INTERVAL)
+        SchemaVersion.update(backfilled=True).where(SchemaVersion.version == migration.version).execute()
+        self.logger.info("Backfill of database migration %s is finished, %s rows processed.",
+                         migration.version, total)
+        return True
+
+    def _backfill_worker(self, migrations: List[Migration]):
+        """Backfill migrations in background, interleaving with other
+        writes through the write queue.
+        """
+        for migration in migrations:
+            # noinspection PyBroadException
+            try:
+                if not self._backfill(migration, self._backfill_stop):
+                    return
+            except Exception:
+                self.logger.exception("Error occurred while backfilling data for database migration %s. "
+                                      "Backfill will be retried on next startup.", migration.version)
+                return
+            self.pending_backfills.discard(migration.version)
+
+    def _maintenance_worker(self, interval: float):
+        """Run database maintenance in background every ``interval`` seconds."""
+        delay = min(interval, self.MAINTENANCE_STARTUP_DELAY)
+        while not self._maintenance_stop.wait(delay):
+            delay = interval
+            start = time.time()
+            # noinspection PyBroadException
+            try:
+                removed = self.run_maintenance(self._maintenance_stop)
+            except Exception:
+                self.logger.exception("Error occurred during database maintenance.")
+                continue
+            self.logger.info("Database maintenance finished in %.2f seconds, %s message logs archived or deleted.",
+                             time.time() - start, removed)
 
-        row: MsgLog
-        r = MsgLog.get_or_none(MsgLog.master_msg_id == master_msg_id)
-        if r is not None:
-            row = r
-            save = row.save
-            self.logger.debug("[%s] Message record is found in database, update it", master_msg_id)
+    def run_maintenance(self, stop: Optional[threading.Event] = None) -> int:
+        """Move old message logs to the archive, enforce the message log
+        retention policy, reclaim free space and update statistics of the
+        query planner.
+
+        Message logs are deleted in batches through the write queue, oldest
+        first. Message logs still referenced as reply targets are kept in
+        the database, unless they are archived.
+
+        Args:
+            stop: Event to interrupt maintenance, and to wait between
+                batches with. Batches are run back to back if not given.
+
+        Returns:
+            Number of message logs archived or deleted from the database.
+        """
+        deleted = 0
+        if self.message_log_archive is not None:
+            deleted += self._archive_message_logs(stop)
+            if self.message_log_max_age is not None:
+                for name in self.message_log_archive.prune(datetime.datetime.now() - self.message_log_max_age):
+                    self.logger.info("Archive segment %s is removed as it is older than retention.", name)
+        if 9 in self.pending_backfills:
+            self.logger.info("Message log retention is skipped until reply targets are backfilled.")
+        else:
+            if self.message_log_max_age is not None:
+                deleted += self._delete_message_logs(
+                    MsgLog.time < datetime.datetime.now() - self.message_log_max_age, stop=stop)
+            if self.message_log_max_rows_per_chat > 0:
+                oversized = ChatActivity.select(ChatActivity.slave_origin_uid, ChatActivity.message_count) \
+                    .where(ChatActivity.message_count > self.message_log_max_rows_per_chat).tuples().iterator()
+                for slave_origin_uid, count in list(oversized):
+                    deleted += self._delete_message_logs(MsgLog.slave_origin_uid == slave_origin_uid,
+                                                         count - self.message_log_max_rows_per_chat, stop)
+            if self.database_max_size > 0:
+                while self._database_data_size() > self.database_max_size and not (stop and stop.is_set()):
+                    count = self._delete_message_logs(None, self.MAINTENANCE_BATCH_SIZE, stop)
+                    if not count:
+                        self.logger.warning("Database is larger than %s bytes, but no message logs can be "
+                                            "deleted.", self.database_max_size)
+                        break
+                    deleted += count
+        self._incremental_vacuum(stop)
+        database.execute_sql("PRAGMA optimize").fetchall()
+        return deleted
+
+    def _archive_message_logs(self, stop: Optional[threading.Event] = None) -> int:
+        """Move message logs older than ``message_log_archive_after`` from
+        the database to the archive in batches.
+
+        Returns:
+            Number of message logs archived.
+        """
+        assert self.message_log_archive is not None and self.message_log_archive_after is not None
+        cutoff = datetime.datetime.now() - self.message_log_archive_after
+        total = 0
+        try:
+            while stop is None or not stop.is_set():
+                rows = list(MsgLog.select().where(MsgLog.time < cutoff).order_by(MsgLog.time)
+                            .limit(self.MAINTENANCE_BATCH_SIZE).dicts().iterator())
+                if not rows:
+                    break
+                self._fold_reactions(rows)
+                # Rows are deleted only after they are written to the archive,
+                # rows archived twice if ETM stops in between are identical.
+                self.message_log_archive.append(rows)
+                ids = [i['master_msg_id'] for i in rows]
+                total += MsgLog.delete().where(MsgLog.master_msg_id.in_(ids)).execute()
+                if self.message_log_cache is not None:
+                    for i in ids:
+                        self.message_log_cache.discard(master_msg_id=i)
+                if stop is not None:
+                    stop.wait(self.MAINTENANCE_INTERVAL)
+        finally:
+            self.message_log_archive.flush_index()
+        return total
+
+    @staticmethod
+    def _fold_reactions(rows: List[MsgLogRow]):
+        """Move reactions of message logs into their pickled data, as
+        reactions are removed with message logs from the database.
+        """
+        ids = {i['master_msg_id']: i for i in rows}
+        reactions: Dict[TgChatMsgIDStr, Dict[ReactionName, List[EFBChannelChatIDStr]]] = {}
+        query = MsgReaction.select(MsgReaction.master_msg_id, MsgReaction.reaction, MsgReaction.member_uid) \
+            .where(MsgReaction.master_msg_id.in_(list(ids))).order_by(SQL("rowid"))
+        for master_msg_id, reaction, member_uid in query.tuples().iterator():
+            reactions.setdefault(master_msg_id, {}).setdefault(reaction, []).append(member_uid)
+        for master_msg_id, msg_reactions in reactions.items():
+            row = ids[master_msg_id]
+            misc_data = serialization.decode_misc_msg(row['pickle']) if row['pickle'] else {}
+            misc_data['reactions'] = {k: tuple(v) for k, v in msg_reactions.items()}
+            row['pickle'] = serialization.encode_misc_msg(misc_data)
+
+    def _delete_message_logs(self, condition: Optional[Expression], limit: Optional[int] = None,
+                             stop: Optional[threading.Event] = None) -> int:
+        """Delete the oldest message logs matching a condition in batches,
+        except for reply targets of other message logs.
+
+        Args:
+            condition: Condition of message logs to delete, ``None`` for all.
+            limit: Maximum number of message logs to delete.
+            stop: Event to interrupt deletion, and to wait between batches with.
+
+        Returns:
+            Number of message logs deleted.
+        """
+        referencing = MsgLog.alias("referencing")
+        not_referenced = ~fn.EXISTS(referencing.select(SQL("1"))
+                                    .where(referencing.target_msg_id == MsgLog.master_msg_id))
+        condition = not_referenced if condition is None else condition & not_referenced
+        total = 0
+        while limit is None or total < limit:
+            if stop is not None and stop.is_set():
+                break
+            batch_size = self.MAINTENANCE_BATCH_SIZE if limit is None else min(limit - total,
+                                                                               self.MAINTENANCE_BATCH_SIZE)
+            ids = [i for i, in MsgLog.select(MsgLog.master_msg_id).where(condition)
+                   .order_by(MsgLog.time).limit(batch_size).tuples().iterator()]
+            if not ids:
+                break
+            # Messages may be replied to after they are selected.
+            total += MsgLog.delete().where(MsgLog.master_msg_id.in_(ids) & not_referenced).execute()
+            if self.message_log_cache is not None:
+                for i in ids:
+                    self.message_log_cache.discard(master_msg_id=i)
+            if stop is not None:
+                stop.wait(self.MAINTENANCE_INTERVAL)
+        return total
+
+    @staticmethod
+    def _pragma(name: str) -> int:
+        return database.execute_sql(f"PRAGMA {name}").fetchone()[0]
+
+    def _database_data_size(self) -> int:
+        """Size of pages in use in the database, in bytes."""
+        return (self._pragma("page_count") - self._pragma("freelist_count")) * self._pragma("page_size")
+
+    def _incremental_vacuum(self, stop: Optional[threading.Event] = None):
+        """Reclaim free pages in batches, if incremental vacuum is enabled."""
+        if self._pragma("auto_vacuum") != 2:
+            self.logger.debug("Incremental vacuum is not enabled for the database, free pages are "
+                              "reused but not reclaimed.")
+            return
+        free_pages = self._pragma("freelist_count")
+        while free_pages > 0:
+            if stop is not None and stop.is_set():
+                break
+            database.execute_sql(f"PRAGMA incremental_vacuum({self.MAINTENANCE_VACUUM_PAGES})").fetchall()
+            remaining = self._pragma("freelist_count")
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            if stop is not None:
+                stop.wait(self.MAINTENANCE_INTERVAL)
+
+    @staticmethod
+    def _insert_chat_assoc(master_uid: EFBChannelChatIDStr, slave_uid: EFBChannelChatIDStr) -> ChatAssoc:
+        return ChatAssoc.create(master_uid=master_uid, slave_uid=slave_uid)
+
+    @staticmethod
+    def _delete_chat_assocs(master_uid: Optional[EFBChannelChatIDStr] = None,
+                            slave_uid: Optional[EFBChannelChatIDStr] = None) -> int:
+        try:
+            if master_uid:
+                return ChatAssoc.delete().where(ChatAssoc.master_uid == master_uid).execute()
+            return ChatAssoc.delete().where(ChatAssoc.slave_uid == slave_uid).execute()
+        except DoesNotExist:
+            return 0
+
+    def _save_message_log(self, row: MsgLogRow):
+        if self.message_log_buffer is not None:
+            if self.message_log_cache is not None:
+                # Rows pending in the buffer take precedence, the cache is
+                # populated again when they are written.
+                self.message_log_cache.discard(master_msg_id=row['master_msg_id'])
+            self.message_log_buffer.put(row)
+            self.logger.debug("[%s] Message record is queued for writing.", row['master_msg_id'])
         else:
-            row = MsgLog()
-            save = partial(row.save, force_insert=True)
-            self.logger.debug("[%s] Message record is not found in database, insert it", master_msg_id)
-
-        row.master_msg_id = master_msg_id
-        row.master_msg_id_alt = master_msg_id_alt
-        row.text = msg.text
-        row.slave_origin_uid = chat_id_to_str(chat=msg.chat)
-        row.slave_member_uid = chat_id_to_str(chat=msg.author)
-        row.msg_type = msg.type.name
-        row.sent_to = msg.deliver_to.channel_id
-        row.slave_message_id = msg.uid or f"{self.FAIL_FLAG}.{time.time()}"
-        row.media_type = msg.type_telegram.value
-        row.file_id = msg.file_id
-        row.file_unique_id = msg.file_unique_id
-        row.mime = msg.mime
-        pickle_data = self.pickle_misc_msg(msg)
-        if pickle_data:
-            row.pickle = pickle_data
-
-        result = save()
-        self.logger.debug("[%s] Database insert/update outcome: %s", master_msg_id, result)
+            self._write_message_logs([row])
+            self.logger.debug("[%s] Message record is written to database.", row['master_msg_id'])
+
+    def _write_message_logs(self, rows: List[MsgLogRow]):
+        """Write message logs to database, and update them in cache."""
+        if self.message_log_cache is None:
+            self._upsert_message_logs(rows)
+            return
+        for row in rows:
+            self.message_log_cache.discard(master_msg_id=row['master_msg_id'])
+        written = self._upsert_message_logs(rows)
+        for row in written:
+            self.message_log_cache.put(row)
+        if not written:
+            # Rows read before the write may have been cached in the meantime.
+            for row in rows:
+                self.message_log_cache.discard(master_msg_id=row['master_msg_id'])
 
     @staticmethod
-    def get_msg_log(master_msg_id: Optional[TgChatMsgIDStr] = None,
+    def _upsert_message_logs(rows: List[MsgLogRow]) -> List[MsgLogRow]:
+        """Insert or update message logs in one statement, or one by one
+        before SQLite 3.24.0.
+
+        Everything except for the time of the message is updated for
+        existing records. Previous pickled data and reply target are kept if
+        nothing is to be pickled this time.
+
+        Returns:
+            Rows as written to the database, if supported by SQLite
+            (3.35.0 and later), otherwise an empty list.
+        """
+        if not SQLITE_UPSERT:
+            for row in rows:
+                values = {k: v for k, v in row.items() if k not in ('master_msg_id', 'time')}
+                if values['pickle'] is None:
+                    del values['pickle'], values['target_msg_id']
+                if not MsgLog.update(values).where(MsgLog.master_msg_id == row['master_msg_id']).execute():
+                    MsgLog.insert(row).execute()
+            return []
+        query = upsert_message_logs_query(rows)
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            query.execute()
+            return []
+        return list(query.returning(*MsgLog._meta.sorted_fields).dicts().execute())
+
+    def get_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
                     slave_msg_id: Optional[MessageID] = None,
                     slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[MsgLog]:
         """Get message log by message ID.
@@ -430,27 +1584,59 @@ class DatabaseManager:
             slave_msg_id: Slave message identifier in string
             slave_origin_uid: Slave chat identifier in string
 
+        Message logs not in the database are looked up from the archive,
+        if enabled.
+
         Returns:
             Optional[MsgLog]: The queried entry, None if not exist.
         """
-        if (master_msg_id and (slave_msg_id or slave_origin_uid)) \
-                or not (master_msg_id or (slave_msg_id or slave_origin_uid)):
-            raise ValueError('master_msg_id and slave_msg_id is mutual exclusive')
-        if not master_msg_id and not (slave_msg_id and slave_origin_uid):
-            raise ValueError('slave_msg_id and slave_origin_uid must exists together.')
+        slave_key = self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        # Rows changed while being read are not cached.
+        generation = self.message_log_cache.generation if self.message_log_cache is not None else 0
+        if self.message_log_buffer is not None:
+            row = self.message_log_buffer.get(
+                master_msg_id=master_msg_id,
+                slave_key=slave_key
+            )
+            if row is not None:
+                return MsgLog(**row)
+        if self.message_log_cache is not None:
+            row = self.message_log_cache.get(
+                master_msg_id=master_msg_id,
+                slave_key=slave_key
+            )
+            if row is not None:
+                return MsgLog(**row)
         try:
             if master_msg_id:
-                return MsgLog.select().where(MsgLog.master_msg_id == master_msg_id) \
-                    .order_by(MsgLog.time.desc()).first()
+                query = MsgLog.select().where(MsgLog.master_msg_id == master_msg_id)
             else:
-                return MsgLog.select().where((MsgLog.slave_message_id == slave_msg_id) &
-                                             (MsgLog.slave_origin_uid == slave_origin_uid)
-                                             ).order_by(MsgLog.time.desc()).first()
+                query = MsgLog.select().where((MsgLog.slave_message_id == slave_msg_id) &
+                                              (MsgLog.slave_origin_uid == slave_origin_uid))
+            with reader() as db:
+                log = query.order_by(MsgLog.time.desc()).bind(db).first()
         except DoesNotExist:
             return None
+        if log is None and self.message_log_archive is not None:
+            row = self.message_log_archive.get(
+                master_msg_id=master_msg_id,
+                slave_key=slave_key
+            )
+            if row is not None:
+                log = MsgLog(**row)
+        if log is not None and self.message_log_cache is not None:
+            self.message_log_cache.put(log.__data__, generation, newest=slave_key is not None)
+        return log
 
-    @staticmethod
-    def delete_msg_log(master_msg_id: Optional[TgChatMsgIDStr] = None,
+    def get_message_log_cache_stats(self) -> Dict[str, int]:
+        """Size and hit/miss counters of the message log cache, empty if
+        the cache is disabled.
+        """
+        if self.message_log_cache is None:
+            return {}
+        return self.message_log_cache.stats()
+
+    def delete_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
                        slave_msg_id: Optional[EFBChannelChatIDStr] = None,
                        slave_origin_uid: Optional[EFBChannelChatIDStr] = None):
         """Remove a message log by message ID.
@@ -460,11 +1646,26 @@ class DatabaseManager:
             slave_msg_id: Slave message identifier in string
             slave_origin_uid: Slave chat identifier in string
         """
-        if (master_msg_id and (slave_msg_id or slave_origin_uid)) \
-                or not (master_msg_id or (slave_msg_id or slave_origin_uid)):
-            raise ValueError('master_msg_id and slave_msg_id is mutual exclusive')
-        if not master_msg_id and not (slave_msg_id and slave_origin_uid):
-            raise ValueError('slave_msg_id and slave_origin_uid must exists together.')
+        slave_key = self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        if self.message_log_buffer is not None:
+            with self.message_log_buffer.flush_lock:
+                self.message_log_buffer.discard(
+                    master_msg_id=master_msg_id,
+                    slave_key=slave_key
+                )
+                self._delete_msg_log(master_msg_id, slave_msg_id, slave_origin_uid)
+        else:
+            self._delete_msg_log(master_msg_id, slave_msg_id, slave_origin_uid)
+        if self.message_log_cache is not None:
+            self.message_log_cache.discard(
+                master_msg_id=master_msg_id,
+                slave_key=slave_key
+            )
+
+    @staticmethod
+    def _delete_msg_log(master_msg_id: Optional[TgChatMsgIDStr] = None,
+                        slave_msg_id: Optional[EFBChannelChatIDStr] = None,
+                        slave_origin_uid: Optional[EFBChannelChatIDStr] = None):
         try:
             if master_msg_id:
                 MsgLog.delete().where(MsgLog.master_msg_id == master_msg_id).execute()
@@ -489,10 +1690,11 @@ class DatabaseManager:
         if slave_channel_id is None or slave_chat_uid is None:
             raise ValueError("Both slave_channel_id and slave_chat_id should be provided.")
         try:
-            return SlaveChatInfo.select() \
-                .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
-                       (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
-                       (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).first()
+            with reader() as db:
+                return SlaveChatInfo.select() \
+                    .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
+                           (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
+                           (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).bind(db).first()
         except DoesNotExist:
             return None
 
@@ -504,68 +1706,226 @@ class DatabaseManager:
             chat_object (ETMChatType): Chat object for pickling
 
         Returns:
-            SlaveChatInfo: The inserted or updated row
-        """
-        slave_channel_id = chat_object.module_id
-        slave_channel_name = chat_object.module_name
-        slave_channel_emoji = chat_object.channel_emoji
-        slave_chat_uid = chat_object.uid
-        slave_chat_name = chat_object.name
-        slave_chat_alias = chat_object.alias
-        slave_chat_type = chat_object.chat_type_name
-        parent_chat: Optional['ETMChatType'] = getattr(chat_object, 'chat', None)
-        slave_chat_group_id: Optional[ChatID]
-        if parent_chat:
-            slave_chat_group_id = parent_chat.uid
-        else:
-            slave_chat_group_id = None
-
-        chat_info = self.get_slave_chat_info(slave_channel_id=slave_channel_id,
-                                             slave_chat_uid=slave_chat_uid,
-                                             slave_chat_group_id=slave_chat_group_id)
-        if chat_info is not None:
-            chat_info.slave_channel_name = slave_channel_name
-            chat_info.slave_channel_emoji = slave_channel_emoji
-            chat_info.slave_chat_name = slave_chat_name
-            chat_info.slave_chat_alias = slave_chat_alias
-            chat_info.slave_chat_type = slave_chat_type
-            chat_info.pickle = chat_object.pickle
-            chat_info.save()
-            return chat_info
-        else:
-            return SlaveChatInfo.create(slave_channel_id=slave_channel_id,
-                                        slave_channel_name=slave_channel_name,
-                                        slave_channel_emoji=slave_channel_emoji,
-                                        slave_chat_uid=slave_chat_uid,
-                                        slave_chat_group_id=slave_chat_group_id,
-                                        slave_chat_name=slave_chat_name,
-                                        slave_chat_alias=slave_chat_alias,
-                                        slave_chat_type=slave_chat_type,
-                                        pickle=chat_object.pickle)
+            SlaveChatInfo: The values inserted or updated, not including
+            the row ID.
+        """
+        row = self._slave_chat_info_row(chat_object)
+        if not SQLITE_UPSERT:
+            updated = SlaveChatInfo.update(row) \
+                .where((SlaveChatInfo.slave_channel_id == row['slave_channel_id']) &
+                       (SlaveChatInfo.slave_chat_uid == row['slave_chat_uid']) &
+                       (SlaveChatInfo.slave_chat_group_id == row['slave_chat_group_id'])).execute()
+            if not updated:
+                SlaveChatInfo.insert(row).execute()
+            return SlaveChatInfo(**row)
+        SlaveChatInfo.insert(row).on_conflict(
+            conflict_target=SLAVE_CHAT_INFO_KEY,
+            preserve=[SlaveChatInfo.slave_channel_emoji, SlaveChatInfo.slave_chat_name,
+                      SlaveChatInfo.slave_chat_alias, SlaveChatInfo.slave_chat_type,
+                      SlaveChatInfo.pickle]
+        ).execute()
+        return SlaveChatInfo(**row)
 
     @staticmethod
-    def delete_slave_chat_info(slave_channel_id: ModuleID, slave_chat_uid: ChatID, slave_chat_group_id: ChatID = None):
+    def delete_slave_chat_info(slave_channel_id: ModuleID, slave_chat_uid: ChatID, slave_chat_group_id: Optional[ChatID] = None):
         return SlaveChatInfo.delete() \
             .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
                    (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
                    (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).execute()
 
-    @staticmethod
-    def get_recent_slave_chats(master_chat_id: TelegramChatID, limit=5) -> List[EFBChannelChatIDStr]:
+    def get_recent_slave_chats(self, master_chat_id: TelegramChatID, limit=5) -> List[EFBChannelChatIDStr]:
+        if 6 in self.pending_backfills:
+            # Integer chat IDs are not yet backfilled, fall back to prefix scan.
+            condition = MsgLog.master_msg_id.startswith("{}.".format(master_chat_id))
+        else:
+            condition = MsgLog.master_chat_id == master_chat_id
         query = MsgLog \
             .select(MsgLog.slave_origin_uid, fn.MAX(MsgLog.time)) \
-            .where(MsgLog.master_msg_id.startswith("{}.".format(master_chat_id))) \
+            .where(condition) \
             .group_by(MsgLog.slave_origin_uid) \
             .order_by(fn.MAX(MsgLog.time).desc()) \
             .limit(limit)
 
-        return [EFBChannelChatIDStr(i.slave_origin_uid) for i in query]
+        with reader() as db:
+            return [EFBChannelChatIDStr(i.slave_origin_uid) for i in query.bind(db)]
+
+    def search_message_logs(self, query: str, master_chat_id: Optional[TelegramChatID] = None,
+                            limit_per_chat: int = 5, limit: int = 100) -> List[MsgLog]:
+        """Search message logs by text, with the best matches in each slave
+        chat.
+
+        Message logs must contain all terms in the query, case-insensitively.
+        Terms of at least ``SEARCH_MIN_TERM_LENGTH`` characters are looked up
+        in the full-text index and ranked by relevance, shorter terms are
+        matched by scanning message logs found. Without such terms, or if
+        the index is not available, the latest message logs matched are
+        returned.
+
+        Message logs pending in the write-behind buffer and archived
+        message logs are not searched.
+
+        Args:
+            query: Terms to search, separated by whitespaces.
+            master_chat_id: Telegram chat to search in, all chats if not given.
+            limit_per_chat: Maximum number of message logs from each slave chat.
+            limit: Maximum number of message logs in total.
+
+        Returns:
+            Message logs grouped by slave chat, starting from the chat with
+            the best match, and from the best match in each chat.
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        # Message logs are only partially indexed until the backfill of
+        # migration 11 finishes.
+        use_index = self.search_index_enabled and 11 not in self.pending_backfills
+        indexed = [i for i in terms if len(i) >= self.SEARCH_MIN_TERM_LENGTH] if use_index else []
+        conditions: List[Expression] = [MsgLog.text.contains(i) for i in terms if i not in indexed]
+        if master_chat_id is not None:
+            if 6 in self.pending_backfills:
+                conditions.append(MsgLog.master_msg_id.startswith("{}.".format(master_chat_id)))
+            else:
+                conditions.append(MsgLog.master_chat_id == master_chat_id)
+
+        if indexed:
+            # Terms are quoted as phrases, so that FTS5 query syntax is not
+            # interpreted.
+            match = " ".join('"{}"'.format(i.replace('"', '""')) for i in indexed)
+            matched = MsgLog.select(MsgLog.master_msg_id, MsgLog.slave_origin_uid,
+                                    MsgLogIndex.bm25().alias("score")) \
+                .join(MsgLogIndex, on=(MsgLogIndex.rowid == Column(MsgLog, "rowid"))) \
+                .where(MsgLogIndex.match(match), *conditions)
+        else:
+            # Latest first.
+            matched = MsgLog.select(MsgLog.master_msg_id, MsgLog.slave_origin_uid,
+                                    (0 - fn.julianday(MsgLog.time)).alias("score")) \
+                .where(*conditions)
+        ids: List[TgChatMsgIDStr]
+        if not SQLITE_WINDOW_FUNCTIONS:
+            with reader() as db:
+                ids = self._rank_search_results(matched.order_by(SQL("score")).bind(db).tuples().execute(),
+                                                limit_per_chat, limit)
+                logs = {i.master_msg_id: i for i in MsgLog.select().where(MsgLog.master_msg_id.in_(ids)).bind(db)}
+            return [logs[i] for i in ids if i in logs]
+        # Lower scores are better, rank message logs in each chat, and chats
+        # by their best scores.
+        ranked = Select([matched], [
+            matched.c.master_msg_id,
+            fn.ROW_NUMBER().over(partition_by=[matched.c.slave_origin_uid],
+                                 order_by=[matched.c.score]).alias("chat_rank"),
+            fn.MIN(matched.c.score).over(partition_by=[matched.c.slave_origin_uid]).alias("chat_score"),
+            matched.c.slave_origin_uid,
+        ])
+        top = Select([ranked], [ranked.c.master_msg_id]) \
+            .where(ranked.c.chat_rank <= limit_per_chat) \
+            .order_by(ranked.c.chat_score, ranked.c.slave_origin_uid, ranked.c.chat_rank) \
+            .limit(limit)
+
+        with reader() as db:
+            ids = [i for i, in top.bind(db).tuples()]
+            logs = {i.master_msg_id: i for i in MsgLog.select().where(MsgLog.master_msg_id.in_(ids)).bind(db)}
+        return [logs[i] for i in ids if i in logs]
+
+    @staticmethod
+    def _rank_search_results(matched: Iterable[Tuple[TgChatMsgIDStr, EFBChannelChatIDStr, float]],
+                             limit_per_chat: int, limit: int) -> List[TgChatMsgIDStr]:
+        """Rank message logs matched, best scores first, as the window
+        functions in :meth:`search_message_logs` do, for SQLite before 3.25.0.
+        """
+        chats: Dict[EFBChannelChatIDStr, List[TgChatMsgIDStr]] = {}
+        best_scores: Dict[EFBChannelChatIDStr, float] = {}
+        for master_msg_id, slave_origin_uid, score in matched:
+            best_scores.setdefault(slave_origin_uid, score)
+            chat = chats.setdefault(slave_origin_uid, [])
+            if len(chat) < limit_per_chat:
+                chat.append(master_msg_id)
+        ranked = sorted(chats, key=lambda i: (best_scores[i], i))
+        return [i for uid in ranked for i in chats[uid]][:limit]
+
+    @staticmethod
+    def rebuild_search_index():
+        """Index all message logs again for full-text search, e.g. after
+        ``VACUUM`` which may renumber row IDs of message logs.
+        """
+        if MsgLogIndex.table_exists():
+            MsgLogIndex.rebuild()
+
+    @staticmethod
+    def get_chat_activity(slave_chat_id: EFBChannelChatIDStr) -> Optional[ChatActivity]:
+        """Get the last message time and message count of a slave chat."""
+        with reader() as db:
+            return ChatActivity.select().where(ChatActivity.slave_origin_uid == slave_chat_id).bind(db).first()
+
+    @staticmethod
+    def get_message_reactions(master_msg_id: TgChatMsgIDStr) -> Dict[ReactionName, List[EFBChannelChatIDStr]]:
+        """Get reactions to a message, in the order they are added.
+
+        Returns:
+            IDs of members reacted, by reaction name.
+        """
+        reactions: Dict[ReactionName, List[EFBChannelChatIDStr]] = {}
+        with reader() as db:
+            query = MsgReaction.select(MsgReaction.reaction, MsgReaction.member_uid) \
+                .where(MsgReaction.master_msg_id == master_msg_id).order_by(SQL("rowid")).bind(db)
+            for reaction, member_uid in query.tuples().iterator():
+                reactions.setdefault(reaction, []).append(member_uid)
+        return reactions
+
+    def _update_message_reactions(self, master_msg_id: TgChatMsgIDStr,
+                                  removed: Dict[ReactionName, List[EFBChannelChatIDStr]],
+                                  added: List[Tuple[ReactionName, EFBChannelChatIDStr]]):
+        if 10 in self.pending_backfills:
+            self._drop_pickled_reactions(master_msg_id)
+        for reaction, member_uids in removed.items():
+            MsgReaction.delete().where((MsgReaction.master_msg_id == master_msg_id) &
+                                       (MsgReaction.reaction == reaction) &
+                                       MsgReaction.member_uid.in_(member_uids)).execute()
+        if added:
+            MsgReaction.insert_many([{"master_msg_id": master_msg_id, "reaction": reaction, "member_uid": member_uid}
+                                     for reaction, member_uid in added]).on_conflict_ignore().execute()
+
+    def _drop_pickled_reactions(self, master_msg_id: TgChatMsgIDStr):
+        """Remove reactions not yet moved from pickled data of a message
+        log, as they are replaced in ``MsgReaction``.
+        """
+        data = MsgLog.select(MsgLog.pickle).where(MsgLog.master_msg_id == master_msg_id).scalar()
+        if not data:
+            return
+        # noinspection PyBroadException
+        try:
+            misc_data = serialization.decode_misc_msg(data)
+        except Exception:
+            return
+        if misc_data.pop('reactions', None) is None:
+            return
+        MsgLog.update(pickle=serialization.encode_misc_msg(misc_data) if misc_data else None) \
+            .where(MsgLog.master_msg_id == master_msg_id).execute()
+        if self.message_log_cache is not None:
+            self.message_log_cache.discard(master_msg_id=master_msg_id)
 
     @staticmethod
     def get_last_message(slave_chat_id: EFBChannelChatIDStr) -> Optional[MsgLog]:
         try:
-            return MsgLog.select().where(
-                MsgLog.slave_origin_uid == slave_chat_id
-            ).order_by(MsgLog.time.desc()).limit(1).first()
+            with reader() as db:
+                return MsgLog.select().where(
+                    MsgLog.slave_origin_uid == slave_chat_id
+                ).order_by(MsgLog.time.desc()).limit(1).bind(db).first()
         except DoesNotExist:
             return None
+
+
+def create_database_manager(channel: 'TelegramChannel') -> BaseDatabaseManager:
+    """Open the storage backend chosen with the ``database_backend``
+    experimental flag.
+    """
+    backend = channel.flag("database_backend")
+    if backend == "sqlite":
+        return DatabaseManager(channel)
+    if backend == "memory":
+        from .db_memory import MemoryDatabaseManager
+        return MemoryDatabaseManager()
+    if backend == "postgresql":
+        from .db_postgresql import PostgresqlDatabaseManager
+        return PostgresqlDatabaseManager(channel)
+    raise ValueError(f"Unknown database backend: {backend}")
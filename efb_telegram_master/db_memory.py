@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+Storage backend in memory, for tests and benchmarks.
+
+Everything stored is lost when ETM stops. Enable with experimental flag
+``database_backend: memory``.
+"""
+
+import datetime
+import threading
+from typing import Dict, List, Optional, Tuple, Any, TYPE_CHECKING
+
+from ehforwarderbot.types import ModuleID, ChatID, MessageID, ReactionName
+from .db import BaseDatabaseManager, MsgLog, SlaveChatInfo
+from .msg_log_buffer import MsgLogRow, SlaveMsgKey
+from .utils import TelegramChatID, EFBChannelChatIDStr, TgChatMsgIDStr
+
+if TYPE_CHECKING:
+    from .chat import ETMChatType
+
+__all__ = ['MemoryDatabaseManager']
+
+SlaveChatInfoKey = Tuple[ModuleID, ChatID, ChatID]
+"""Slave channel ID, chat UID and group ID (empty string if none) of a slave chat info entry."""
+
+
+class MemoryDatabaseManager(BaseDatabaseManager):
+    """Storage in dictionaries, with the same behaviour as
+    :class:`~.db.DatabaseManager` except that search ranks message logs
+    found by time only.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        """Lock of all records below."""
+        self.message_logs: Dict[TgChatMsgIDStr, MsgLogRow] = {}
+        """Message logs by ``master_msg_id``, in order of insertion."""
+        self.slave_keys: Dict[SlaveMsgKey, TgChatMsgIDStr] = {}
+        """``master_msg_id`` of the latest message log of each slave message."""
+        self.slave_chat_info: Dict[SlaveChatInfoKey, Dict[str, Any]] = {}
+        self.reactions: Dict[TgChatMsgIDStr, List[Tuple[ReactionName, EFBChannelChatIDStr]]] = {}
+        """Reactions to each message, in order of addition."""
+
+    def _insert_chat_assoc(self, master_uid: EFBChannelChatIDStr, slave_uid: EFBChannelChatIDStr):
+        """Chat associations are only kept in the index of the base class."""
+
+    def _delete_chat_assocs(self, master_uid: Optional[EFBChannelChatIDStr] = None,
+                            slave_uid: Optional[EFBChannelChatIDStr] = None) -> int:
+        if master_uid:
+            return len(self.master_links.get(master_uid, []))
+        return len(self.slave_links.get(slave_uid, []))  # type: ignore
+
+    def _save_message_log(self, row: MsgLogRow):
+        with self.lock:
+            existing = self.message_logs.get(row['master_msg_id'])
+            if existing is not None:
+                self._unlink_slave_key(existing)
+                row = {**existing, **row, "time": existing['time']}
+                if row['pickle'] is None:
+                    row['pickle'], row['target_msg_id'] = existing['pickle'], existing['target_msg_id']
+            self.message_logs[row['master_msg_id']] = row
+            self.slave_keys[(row['slave_origin_uid'], row['slave_message_id'])] = row['master_msg_id']
+
+    def _unlink_slave_key(self, row: MsgLogRow):
+        key = (row['slave_origin_uid'], row['slave_message_id'])
+        if self.slave_keys.get(key) == row['master_msg_id']:
+            del self.slave_keys[key]
+
+    def _find_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                      slave_msg_id: Optional[MessageID] = None,
+                      slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[MsgLogRow]:
+        if not master_msg_id:
+            master_msg_id = self.slave_keys.get((slave_origin_uid, slave_msg_id))  # type: ignore
+        return self.message_logs.get(master_msg_id) if master_msg_id else None  # type: ignore
+
+    def get_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                    slave_msg_id: Optional[MessageID] = None,
+                    slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[MsgLog]:
+        self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        with self.lock:
+            row = self._find_msg_log(master_msg_id, slave_msg_id, slave_origin_uid)
+        return MsgLog(**row) if row is not None else None
+
+    def delete_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                       slave_msg_id: Optional[EFBChannelChatIDStr] = None,
+                       slave_origin_uid: Optional[EFBChannelChatIDStr] = None):
+        self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        with self.lock:
+            row = self._find_msg_log(master_msg_id, slave_msg_id, slave_origin_uid)  # type: ignore
+            if row is None:
+                return
+            self._unlink_slave_key(row)
+            del self.message_logs[row['master_msg_id']]
+            self.reactions.pop(row['master_msg_id'], None)
+
+    def get_slave_chat_info(self, slave_channel_id: Optional[ModuleID] = None,
+                            slave_chat_uid: Optional[ChatID] = None,
+                            slave_chat_group_id: Optional[ChatID] = None
+                            ) -> Optional[SlaveChatInfo]:
+        if slave_channel_id is None or slave_chat_uid is None:
+            raise ValueError("Both slave_channel_id and slave_chat_id should be provided.")
+        with self.lock:
+            row = self.slave_chat_info.get((slave_channel_id, slave_chat_uid, slave_chat_group_id or ChatID("")))
+        return SlaveChatInfo(**row) if row is not None else None
+
+    def set_slave_chat_info(self, chat_object: 'ETMChatType') -> SlaveChatInfo:
+        row = self._slave_chat_info_row(chat_object)
+        with self.lock:
+            self.slave_chat_info[(row['slave_channel_id'], row['slave_chat_uid'],
+                                  row['slave_chat_group_id'] or ChatID(""))] = row
+        return SlaveChatInfo(**row)
+
+    def delete_slave_chat_info(self, slave_channel_id: ModuleID, slave_chat_uid: ChatID,
+                               slave_chat_group_id: Optional[ChatID] = None) -> int:
+        with self.lock:
+            row = self.slave_chat_info.pop((slave_channel_id, slave_chat_uid, slave_chat_group_id or ChatID("")),
+                                           None)
+        return int(row is not None)
+
+    def get_recent_slave_chats(self, master_chat_id: TelegramChatID, limit=5) -> List[EFBChannelChatIDStr]:
+        last_times: Dict[EFBChannelChatIDStr, datetime.datetime] = {}
+        with self.lock:
+            for row in self.message_logs.values():
+                if row['master_chat_id'] == master_chat_id and \
+                        last_times.get(row['slave_origin_uid'], datetime.datetime.min) < row['time']:
+                    last_times[row['slave_origin_uid']] = row['time']
+        return sorted(last_times, key=last_times.__getitem__, reverse=True)[:limit]
+
+    def search_message_logs(self, query: str, master_chat_id: Optional[TelegramChatID] = None,
+                            limit_per_chat: int = 5, limit: int = 100) -> List[MsgLog]:
+        """Search message logs by text, latest first in each slave chat,
+        and chats with the latest match first.
+        """
+        terms = [i.lower() for i in query.split()]
+        if not terms:
+            return []
+        chats: Dict[EFBChannelChatIDStr, List[MsgLogRow]] = {}
+        with self.lock:
+            for row in self.message_logs.values():
+                if master_chat_id is not None and row['master_chat_id'] != master_chat_id:
+                    continue
+                text = row['text'].lower()
+                if all(i in text for i in terms):
+                    chats.setdefault(row['slave_origin_uid'], []).append(row)
+        for rows in chats.values():
+            rows.sort(key=lambda i: i['time'], reverse=True)
+        ranked = sorted(chats.items(), key=lambda i: (-i[1][0]['time'].timestamp(), i[0]))
+        return [MsgLog(**row) for _, rows in ranked for row in rows[:limit_per_chat]][:limit]
+
+    def get_last_message(self, slave_chat_id: EFBChannelChatIDStr) -> Optional[MsgLog]:
+        with self.lock:
+            rows = [i for i in self.message_logs.values() if i['slave_origin_uid'] == slave_chat_id]
+        if not rows:
+            return None
+        return MsgLog(**max(rows, key=lambda i: i['time']))
+
+    def get_message_reactions(self, master_msg_id: TgChatMsgIDStr) -> Dict[ReactionName, List[EFBChannelChatIDStr]]:
+        reactions: Dict[ReactionName, List[EFBChannelChatIDStr]] = {}
+        with self.lock:
+            for reaction, member_uid in self.reactions.get(master_msg_id, []):
+                reactions.setdefault(reaction, []).append(member_uid)
+        return reactions
+
+    def _update_message_reactions(self, master_msg_id: TgChatMsgIDStr,
+                                  removed: Dict[ReactionName, List[EFBChannelChatIDStr]],
+                                  added: List[Tuple[ReactionName, EFBChannelChatIDStr]]):
+        with self.lock:
+            reactions = [(k, v) for k, v in self.reactions.get(master_msg_id, []) if v not in removed.get(k, ())]
+            reactions.extend(i for i in added if i not in reactions)
+            if reactions:
+                self.reactions[master_msg_id] = reactions
+            else:
+                self.reactions.pop(master_msg_id, None)
@@ -0,0 +1,279 @@
+# coding=utf-8
+"""
+Storage backend on a PostgreSQL server, so that message logs can be kept
+on a database server written by multiple ETM instances concurrently.
+
+Requires ``psycopg2``, install with ``pip install efb-telegram-master[postgresql]``.
+Enable with experimental flags ``database_backend: postgresql`` and
+``database_postgresql``.
+
+Tables are created with the latest schema of the SQLite database, except
+for chat activity and the full-text index. SQLite database migrations,
+maintenance and the archive of message logs do not apply to this backend.
+"""
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING, TypeVar, overload
+
+from peewee import DoesNotExist, fn, Select, Expression, Field, Model
+from playhouse.pool import PooledPostgresqlDatabase
+
+from ehforwarderbot.types import ModuleID, ChatID, MessageID, ReactionName
+from .db import BaseDatabaseManager, ChatAssoc, MsgLog, SlaveChatInfo, MsgReaction, SLAVE_CHAT_INFO_KEY, \
+    upsert_message_logs_query
+from .msg_log_buffer import MsgLogRow
+from .utils import TelegramChatID, EFBChannelChatIDStr, TgChatMsgIDStr
+
+if TYPE_CHECKING:
+    from . import TelegramChannel
+    from .chat import ETMChatType
+
+__all__ = ['PostgresqlDatabaseManager']
+
+
+class BigSerialField(Field):
+    """Auto-incremented column which is not the primary key."""
+    field_type = 'BIGSERIAL'
+
+
+class PgMsgReaction(MsgReaction):
+    """``MsgReaction`` with the order of addition, which is kept by row ID
+    in SQLite.
+    """
+    seq = BigSerialField()
+    """Order of addition of the reaction."""
+
+    class Meta:
+        table_name = "msgreaction"
+
+
+MODELS = [ChatAssoc, MsgLog, SlaveChatInfo, PgMsgReaction]
+"""Models stored in PostgreSQL."""
+
+RecordType = TypeVar('RecordType', bound=Model)
+
+DEFAULT_CONNECTION_PARAMS: Dict[str, Any] = {
+    'max_connections': 8,
+    # Seconds to wait for a free connection in the pool.
+    'timeout': 10,
+    # Seconds before an idle connection is recycled.
+    'stale_timeout': 300,
+}
+"""Connection parameters, overridden by ``database_postgresql``."""
+
+
+class PostgresqlDatabaseManager(BaseDatabaseManager):
+    """Storage in a PostgreSQL database, with a pool of connections shared
+    by all threads.
+
+    Models are bound to the PostgreSQL database when this is initialized,
+    so that only one instance is expected in a process.
+    """
+
+    def __init__(self, channel: 'TelegramChannel'):
+        super().__init__()
+        try:
+            import psycopg2  # noqa: F401
+        except ImportError as e:
+            raise ImportError("psycopg2 is required by the PostgreSQL database backend. "
+                              "Install it with: pip install efb-telegram-master[postgresql]") from e
+
+        params = {**DEFAULT_CONNECTION_PARAMS, **channel.flag("database_postgresql")}
+        self.database = PooledPostgresqlDatabase(params.pop('database', None), **params)
+        self.database.bind(MODELS)
+
+        self.logger.debug("Loading database...")
+        with self.connection():
+            with self.database.atomic():
+                self.database.create_tables(MODELS)
+            self.last_message_times.update(
+                MsgLog.select(MsgLog.slave_origin_uid, fn.MAX(MsgLog.time))
+                .group_by(MsgLog.slave_origin_uid).tuples().iterator()
+            )
+            self._index_chat_assocs(ChatAssoc.select(ChatAssoc.master_uid, ChatAssoc.slave_uid)
+                                    .order_by(ChatAssoc.id).tuples().iterator())
+        self.logger.debug("Database loaded.")
+
+    @contextmanager
+    def connection(self) -> Iterator[None]:
+        """Run queries with a connection from the pool, if the current
+        thread does not hold one.
+        """
+        if not self.database.is_closed():
+            yield
+            return
+        with self.database.connection_context():
+            yield
+
+    def stop_worker(self):
+        self.database.close_all()
+
+    @overload
+    @staticmethod
+    def _loaded(record: RecordType) -> RecordType:
+        ...
+
+    @overload
+    @staticmethod
+    def _loaded(record: None) -> None:
+        ...
+
+    @staticmethod
+    def _loaded(record):
+        """Convert blobs of a record loaded, from ``memoryview`` to ``bytes``
+        as in SQLite.
+        """
+        if record is not None and isinstance(getattr(record, 'pickle', None), memoryview):
+            record.pickle = bytes(record.pickle)  # type: ignore
+        return record
+
+    def _insert_chat_assoc(self, master_uid: EFBChannelChatIDStr, slave_uid: EFBChannelChatIDStr) -> ChatAssoc:
+        with self.connection():
+            return ChatAssoc.create(master_uid=master_uid, slave_uid=slave_uid)
+
+    def _delete_chat_assocs(self, master_uid: Optional[EFBChannelChatIDStr] = None,
+                            slave_uid: Optional[EFBChannelChatIDStr] = None) -> int:
+        with self.connection():
+            if master_uid:
+                return ChatAssoc.delete().where(ChatAssoc.master_uid == master_uid).execute()
+            return ChatAssoc.delete().where(ChatAssoc.slave_uid == slave_uid).execute()
+
+    def _save_message_log(self, row: MsgLogRow):
+        with self.connection():
+            upsert_message_logs_query([row]).execute()
+
+    @staticmethod
+    def _msg_log_condition(master_msg_id: Optional[TgChatMsgIDStr] = None,
+                           slave_msg_id: Optional[str] = None,
+                           slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Expression:
+        if master_msg_id:
+            return MsgLog.master_msg_id == master_msg_id
+        return (MsgLog.slave_message_id == slave_msg_id) & (MsgLog.slave_origin_uid == slave_origin_uid)
+
+    def get_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                    slave_msg_id: Optional[MessageID] = None,
+                    slave_origin_uid: Optional[EFBChannelChatIDStr] = None) -> Optional[MsgLog]:
+        self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        try:
+            with self.connection():
+                return self._loaded(MsgLog.select()
+                                    .where(self._msg_log_condition(master_msg_id, slave_msg_id, slave_origin_uid))
+                                    .order_by(MsgLog.time.desc()).first())
+        except DoesNotExist:
+            return None
+
+    def delete_msg_log(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                       slave_msg_id: Optional[EFBChannelChatIDStr] = None,
+                       slave_origin_uid: Optional[EFBChannelChatIDStr] = None):
+        self._check_msg_log_key(master_msg_id, slave_msg_id, slave_origin_uid)
+        with self.connection(), self.database.atomic():
+            deleted = MsgLog.delete() \
+                .where(self._msg_log_condition(master_msg_id, slave_msg_id, slave_origin_uid)) \
+                .returning(MsgLog.master_msg_id).tuples().execute()
+            deleted_ids = [i for i, in deleted]
+            if deleted_ids:
+                PgMsgReaction.delete().where(PgMsgReaction.master_msg_id.in_(deleted_ids)).execute()
+
+    def get_slave_chat_info(self, slave_channel_id: Optional[ModuleID] = None,
+                            slave_chat_uid: Optional[ChatID] = None,
+                            slave_chat_group_id: Optional[ChatID] = None
+                            ) -> Optional[SlaveChatInfo]:
+        if slave_channel_id is None or slave_chat_uid is None:
+            raise ValueError("Both slave_channel_id and slave_chat_id should be provided.")
+        try:
+            with self.connection():
+                return self._loaded(SlaveChatInfo.select()
+                                    .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
+                                           (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
+                                           (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).first())
+        except DoesNotExist:
+            return None
+
+    def set_slave_chat_info(self, chat_object: 'ETMChatType') -> SlaveChatInfo:
+        row = self._slave_chat_info_row(chat_object)
+        with self.connection():
+            SlaveChatInfo.insert(row).on_conflict(
+                conflict_target=SLAVE_CHAT_INFO_KEY,
+                preserve=[SlaveChatInfo.slave_channel_emoji, SlaveChatInfo.slave_chat_name,
+                          SlaveChatInfo.slave_chat_alias, SlaveChatInfo.slave_chat_type,
+                          SlaveChatInfo.pickle]
+            ).execute()
+        return SlaveChatInfo(**row)
+
+    def delete_slave_chat_info(self, slave_channel_id: ModuleID, slave_chat_uid: ChatID,
+                               slave_chat_group_id: Optional[ChatID] = None) -> int:
+        with self.connection():
+            return SlaveChatInfo.delete() \
+                .where((SlaveChatInfo.slave_channel_id == slave_channel_id) &
+                       (SlaveChatInfo.slave_chat_uid == slave_chat_uid) &
+                       (SlaveChatInfo.slave_chat_group_id == slave_chat_group_id)).execute()
+
+    def get_recent_slave_chats(self, master_chat_id: TelegramChatID, limit=5) -> List[EFBChannelChatIDStr]:
+        query = MsgLog \
+            .select(MsgLog.slave_origin_uid, fn.MAX(MsgLog.time)) \
+            .where(MsgLog.master_chat_id == master_chat_id) \
+            .group_by(MsgLog.slave_origin_uid) \
+            .order_by(fn.MAX(MsgLog.time).desc()) \
+            .limit(limit)
+        with self.connection():
+            return [EFBChannelChatIDStr(i) for i, _ in query.tuples().iterator()]
+
+    def search_message_logs(self, query: str, master_chat_id: Optional[TelegramChatID] = None,
+                            limit_per_chat: int = 5, limit: int = 100) -> List[MsgLog]:
+        """Search message logs by text, latest first in each slave chat,
+        and chats with the latest match first.
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        conditions: List[Expression] = [MsgLog.text.contains(i) for i in terms]
+        if master_chat_id is not None:
+            conditions.append(MsgLog.master_chat_id == master_chat_id)
+        matched = MsgLog.select(MsgLog.master_msg_id, MsgLog.slave_origin_uid, MsgLog.time).where(*conditions)
+        ranked = Select([matched], [
+            matched.c.master_msg_id,
+            fn.ROW_NUMBER().over(partition_by=[matched.c.slave_origin_uid],
+                                 order_by=[matched.c.time.desc()]).alias("chat_rank"),
+            fn.MAX(matched.c.time).over(partition_by=[matched.c.slave_origin_uid]).alias("chat_time"),
+            matched.c.slave_origin_uid,
+        ])
+        top = Select([ranked], [ranked.c.master_msg_id]) \
+            .where(ranked.c.chat_rank <= limit_per_chat) \
+            .order_by(ranked.c.chat_time.desc(), ranked.c.slave_origin_uid, ranked.c.chat_rank) \
+            .limit(limit)
+
+        with self.connection():
+            ids: List[TgChatMsgIDStr] = [i for i, in top.bind(self.database).tuples()]
+            logs = {i.master_msg_id: self._loaded(i) for i in MsgLog.select().where(MsgLog.master_msg_id.in_(ids))}
+        return [logs[i] for i in ids if i in logs]
+
+    def get_last_message(self, slave_chat_id: EFBChannelChatIDStr) -> Optional[MsgLog]:
+        try:
+            with self.connection():
+                return self._loaded(MsgLog.select().where(
+                    MsgLog.slave_origin_uid == slave_chat_id
+                ).order_by(MsgLog.time.desc()).limit(1).first())
+        except DoesNotExist:
+            return None
+
+    def get_message_reactions(self, master_msg_id: TgChatMsgIDStr) -> Dict[ReactionName, List[EFBChannelChatIDStr]]:
+        reactions: Dict[ReactionName, List[EFBChannelChatIDStr]] = {}
+        with self.connection():
+            query = PgMsgReaction.select(PgMsgReaction.reaction, PgMsgReaction.member_uid) \
+                .where(PgMsgReaction.master_msg_id == master_msg_id).order_by(PgMsgReaction.seq)
+            for reaction, member_uid in query.tuples().iterator():
+                reactions.setdefault(reaction, []).append(member_uid)
+        return reactions
+
+    def _update_message_reactions(self, master_msg_id: TgChatMsgIDStr,
+                                  removed: Dict[ReactionName, List[EFBChannelChatIDStr]],
+                                  added: List[Tuple[ReactionName, EFBChannelChatIDStr]]):
+        with self.connection(), self.database.atomic():
+            for reaction, member_uids in removed.items():
+                PgMsgReaction.delete().where((PgMsgReaction.master_msg_id == master_msg_id) &
+                                             (PgMsgReaction.reaction == reaction) &
+                                             PgMsgReaction.member_uid.in_(member_uids)).execute()
+            if added:
+                PgMsgReaction.insert_many([{"master_msg_id": master_msg_id, "reaction": reaction,
+                                            "member_uid": member_uid}
+                                           for reaction, member_uid in added]).on_conflict_ignore().execute()
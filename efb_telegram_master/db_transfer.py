@@ -0,0 +1,341 @@
+# coding=utf-8
+"""
+Export and import the ETM database as newline-delimited JSON.
+
+Chat associations, slave chat info, message logs and reactions are streamed
+row by row, so that databases of any size are transferred in constant
+memory. Usage::
+
+    etm-db [-p PROFILE] [-i INSTANCE_ID] export [FILE]
+    etm-db [-p PROFILE] [-i INSTANCE_ID] import [FILE]
+    etm-db [-p PROFILE] [-i INSTANCE_ID] vacuum
+
+``FILE`` defaults to the standard output or input, and is compressed with
+gzip if its name ends with ``.gz``. ETM must not be running while importing.
+
+The first line of an export is a header of the format, followed by a line
+for each row, ``{"table": ..., "row": {...}}``. Times are in ISO 8601
+format. Blobs encoded as JSON (see :mod:`.serialization`) are exported as
+their JSON records, so that they can be read without ETM, other blobs as
+``{"base64": ...}``.
+
+The database is migrated to the latest schema before export and import.
+Chat activity and the full-text index are rebuilt from message logs on
+import, rows already in the database are kept. Message logs moved to the
+archive (see :mod:`.msg_log_archive`) are not exported, the ``archive``
+folder in the data directory is to be copied separately.
+
+``vacuum`` rebuilds the database file with incremental vacuum enabled, so
+that free space is reclaimed by database maintenance afterwards, see
+:func:`vacuum`.
+"""
+
+import argparse
+import base64
+import datetime
+import gzip
+import io
+import json
+import sys
+import time
+from contextlib import contextmanager
+from gettext import translation
+from typing import Any, Dict, IO, Iterator, List, Optional, Type
+
+from peewee import BlobField, DateTimeField, Model, SqliteDatabase, SQL, chunked
+from pkg_resources import resource_filename
+
+from ehforwarderbot import coordinator, utils
+from ehforwarderbot.types import ModuleID
+from . import serialization
+from .db import DatabaseManager, database, ChatAssoc, SlaveChatInfo, MsgLog, MsgReaction, MsgLogIndex, \
+    MODELS, MIGRATIONS, MSG_LOG_INDEX_TRIGGERS
+from .utils import ExperimentalFlagsManager, parse_isoformat
+
+translator = translation("efb_telegram_master",
+                         resource_filename('efb_telegram_master', 'locale'),
+                         fallback=True)
+
+_ = translator.gettext
+
+FORMAT = "etm-db"
+FORMAT_VERSION = 1
+
+TRANSFER_MODELS: Dict[str, Type[Model]] = {i._meta.table_name: i for i in (ChatAssoc, SlaveChatInfo, MsgLog,
+                                                                           MsgReaction)}
+"""Models transferred by their table names, in order of export."""
+
+INSERT_CHUNK_SIZE = 500
+"""Number of rows inserted in each statement, within the limit of variables."""
+
+PROGRESS_INTERVAL = 1.0
+"""Seconds between progress outputs."""
+
+
+class TransferChannel:
+    """Minimal stand-in of ``TelegramChannel`` to open its database with."""
+
+    def __init__(self, channel_id: ModuleID):
+        self.channel_id = channel_id
+        self.config = {"flags": {
+            "online_migration": False,
+            "message_log_cache_size": 0,
+            "database_read_connections": 0,
+            "database_maintenance_interval": 0,
+        }}
+        self.flag = ExperimentalFlagsManager(self)  # type: ignore
+
+
+def encode_value(field, value: Any) -> Any:
+    """Convert a value of a field to be represented in JSON."""
+    if value is None:
+        return None
+    if isinstance(field, DateTimeField):
+        return value.isoformat() if isinstance(value, datetime.datetime) else value
+    if isinstance(field, BlobField):
+        value = bytes(value)
+        if not serialization.is_pickle(value):
+            return serialization.loads(value)
+        return {"base64": base64.b64encode(value).decode()}
+    return value
+
+
+def decode_value(field, value: Any) -> Any:
+    """Convert a value of a field represented in JSON back."""
+    if value is None:
+        return None
+    if isinstance(field, DateTimeField):
+        return parse_isoformat(value)
+    if isinstance(field, BlobField):
+        if isinstance(value, list):
+            return serialization.dumps(value)
+        return base64.b64decode(value["base64"])
+    return value
+
+
+class Progress:
+    """Print the number of rows transferred in each table to standard error."""
+
+    def __init__(self):
+        self.table: Optional[str] = None
+        self.count = 0
+        self.start = self.last_update = self.last_output = time.monotonic()
+
+    def update(self, table: str, count: int = 1):
+        """Count rows transferred, call with ``count=0`` when a table starts."""
+        self.last_update = time.monotonic()
+        if table != self.table:
+            self.finish()
+            self.table, self.count = table, 0
+            self.start = self.last_output = self.last_update
+        self.count += count
+        if self.last_update - self.last_output >= PROGRESS_INTERVAL:
+            self.last_output = self.last_update
+            self.output("\r")
+
+    def output(self, end: str):
+        rate = self.count / max(self.last_update - self.start, 1e-6)
+        print(_("{table}: {count} rows ({rate:.0f} rows/s)").format(table=self.table, count=self.count, rate=rate),
+              end=end, file=sys.stderr, flush=True)
+
+    def finish(self):
+        if self.table is not None:
+            self.output("\n")
+        self.table = None
+
+
+def open_database(channel_id: ModuleID, pragmas: Dict[str, Any]) -> SqliteDatabase:
+    """Migrate the database of an ETM instance to the latest schema, and
+    open a connection to it.
+    """
+    db_manager = DatabaseManager(TransferChannel(channel_id))  # type: ignore
+    db_manager.stop_worker()
+    database.close()
+    db_path = database.database
+    database.init(None)
+    return SqliteDatabase(db_path, pragmas={**pragmas, 'journal_mode': 'wal'})
+
+
+def export_rows(db: SqliteDatabase, out: IO[str]) -> int:
+    """Write all rows to transfer as lines of JSON.
+
+    Returns:
+        Number of rows written.
+    """
+    out.write(json.dumps({"format": FORMAT, "version": FORMAT_VERSION,
+                          "schema_version": MIGRATIONS[-1].version,
+                          "time": datetime.datetime.now().isoformat()}) + "\n")
+    progress = Progress()
+    total = 0
+    with db.bind_ctx(MODELS):
+        for table, model in TRANSFER_MODELS.items():
+            progress.update(table, 0)
+            fields = model._meta.sorted_fields
+            # Rows are read in order of row ID, e.g. to keep the order of reactions.
+            query = model.select(*fields).order_by(SQL("rowid")).tuples()
+            for values in query.iterator():
+                row = {f.name: encode_value(f, v) for f, v in zip(fields, values)}
+                out.write(json.dumps({"table": table, "row": row}, ensure_ascii=False, separators=(',', ':')))
+                out.write("\n")
+                progress.update(table)
+                total += 1
+    progress.finish()
+    return total
+
+
+@contextmanager
+def deferred_search_index(db: SqliteDatabase) -> Iterator[None]:
+    """Suspend full-text indexing of message logs, and rebuild the index
+    afterwards, which is faster than indexing rows one by one.
+    """
+    if not MsgLogIndex.table_exists():
+        yield
+        return
+    for trigger in ("msglog_fts_insert", "msglog_fts_delete", "msglog_fts_update"):
+        db.execute_sql(f'DROP TRIGGER IF EXISTS "{trigger}"')
+    try:
+        yield
+    finally:
+        print(_("Rebuilding full-text index of message logs..."), file=sys.stderr, flush=True)
+        with db.atomic():
+            for trigger in MSG_LOG_INDEX_TRIGGERS:
+                db.execute_sql(trigger)
+            MsgLogIndex.rebuild()
+
+
+def import_rows(db: SqliteDatabase, source: IO[str], batch_size: int = 10000) -> int:
+    """Insert rows from lines of JSON in batches, rows with conflicting
+    keys in the database are skipped.
+
+    Returns:
+        Number of rows read.
+
+    Raises:
+        ValueError: If the input is not an export of a supported format.
+    """
+    header = json.loads(source.readline() or "{}")
+    if header.get("format") != FORMAT or header.get("version") != FORMAT_VERSION:
+        raise ValueError(_("Input is not an ETM database export of a supported format."))
+
+    progress = Progress()
+    total = 0
+    table: Optional[str] = None
+    batch: List[Dict[str, Any]] = []
+
+    def flush():
+        if not batch:
+            return
+        model = TRANSFER_MODELS[table]
+        with db.atomic():
+            for rows in chunked(batch, INSERT_CHUNK_SIZE):
+                model.insert_many(rows).on_conflict_ignore().execute()
+        progress.update(table, len(batch))
+        batch.clear()
+
+    with db.bind_ctx(MODELS), deferred_search_index(db):
+        for line in source:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["table"] not in TRANSFER_MODELS:
+                raise ValueError(_("Unknown table in input: {table}").format(table=entry["table"]))
+            if entry["table"] != table:
+                flush()
+                table = entry["table"]
+                progress.update(table, 0)
+            elif len(batch) >= batch_size:
+                flush()
+            fields = TRANSFER_MODELS[entry["table"]]._meta.fields
+            batch.append({k: decode_value(fields[k], v) for k, v in entry["row"].items() if k in fields})
+            total += 1
+        flush()
+        progress.finish()
+    return total
+
+
+def vacuum(db: SqliteDatabase):
+    """Enable incremental vacuum and rebuild the database file.
+
+    ``VACUUM`` may renumber row IDs of message logs, the full-text index
+    referring to them is rebuilt afterwards.
+    """
+    db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute_sql("VACUUM")
+    print(_("Rebuilding full-text index of message logs..."), file=sys.stderr, flush=True)
+    with db.bind_ctx(MODELS), db.atomic():
+        DatabaseManager.rebuild_search_index()
+
+
+def open_file(path: str, mode: str) -> IO[str]:
+    """Open a file in text mode, ``-`` for standard input or output, with
+    gzip compression if its name ends with ``.gz``.
+    """
+    if path == "-":
+        stream = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.GzipFile(path, mode + "b"), encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="etm-db",
+        description=_("Export or import the database of EFB Telegram Master Channel as newline-delimited JSON, "
+                      "or vacuum it."))
+    parser.add_argument("-p", "--profile", default="default",
+                        help=_("Choose a profile to use. (default: %(default)s)"))
+    parser.add_argument("-i", "--instance-id", default=None,
+                        help=_("Instance ID of the channel, if any."))
+    subparsers = parser.add_subparsers(dest="command")
+    # Not an argument of ``add_subparsers`` before Python 3.7.
+    subparsers.required = True
+    export_parser = subparsers.add_parser("export", help=_("Export the database. Message logs in the archive "
+                                                           "are not exported, copy the archive folder "
+                                                           "separately."))
+    export_parser.add_argument("file", nargs="?", default="-",
+                               help=_("File to export to, standard output by default."))
+    import_parser = subparsers.add_parser("import", help=_("Import an export into the database. "
+                                                           "ETM must not be running."))
+    import_parser.add_argument("file", nargs="?", default="-",
+                               help=_("File to import from, standard input by default."))
+    import_parser.add_argument("--batch-size", type=int, default=10000,
+                               help=_("Number of rows to insert in each transaction. (default: %(default)s)"))
+    subparsers.add_parser("vacuum", help=_("Reclaim free space and enable incremental vacuum of the database. "
+                                           "ETM must not be running."))
+    parsed = parser.parse_args(args)
+
+    coordinator.profile = parsed.profile
+    channel_id = ModuleID("blueset.telegram")
+    if parsed.instance_id:
+        channel_id = ModuleID(channel_id + "#" + parsed.instance_id)
+    print(_("Opening database of {channel_id} in profile {profile}...")
+          .format(channel_id=channel_id, profile=parsed.profile), file=sys.stderr, flush=True)
+
+    start = time.monotonic()
+    if parsed.command == "vacuum":
+        db = open_database(channel_id, {})
+        vacuum(db)
+        db.close()
+        print(_("Database is vacuumed in {seconds:.1f} seconds.").format(seconds=time.monotonic() - start),
+              file=sys.stderr)
+        return
+    if parsed.command == "export":
+        db = open_database(channel_id, {'query_only': True})
+        with open_file(parsed.file, "w") as f:
+            count = export_rows(db, f)
+        archive_path = utils.get_data_path(channel_id) / "archive"
+        if any(archive_path.glob("msglog-*.seg")):
+            print(_("Message logs in {path} are not exported, copy the folder separately.")
+                  .format(path=archive_path), file=sys.stderr)
+    else:
+        db = open_database(channel_id, {'synchronous': 'off', 'cache_size': -64 * 1024})
+        with open_file(parsed.file, "r") as f:
+            count = import_rows(db, f, parsed.batch_size)
+    db.close()
+    print(_("{count} rows transferred in {seconds:.1f} seconds.")
+          .format(count=count, seconds=time.monotonic() - start), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,7 @@ from .utils import EFBChannelChatIDStr, TelegramChatID, TelegramMessageID
 if TYPE_CHECKING:
     from . import TelegramChannel
     from .bot_manager import TelegramBotManager
-    from .db import DatabaseManager, MsgLog
+    from .db import BaseDatabaseManager, MsgLog
     from .chat_object_cache import ChatObjectCacheManager
 
 
@@ -62,7 +62,7 @@ class MasterMessageProcessor(LocaleMixin):
     def __init__(self, channel: 'TelegramChannel'):
         self.channel: 'TelegramChannel' = channel
         self.bot: 'TelegramBotManager' = channel.bot_manager
-        self.db: 'DatabaseManager' = channel.db
+        self.db: 'BaseDatabaseManager' = channel.db
         self.chat_dest_cache: ChatDestinationCache = channel.chat_dest_cache
         self.chat_manager: 'ChatObjectCacheManager' = channel.chat_manager
 
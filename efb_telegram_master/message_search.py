@@ -0,0 +1,194 @@
+# coding=utf-8
+
+import html
+import logging
+from typing import Tuple, Dict, List, TYPE_CHECKING, NamedTuple
+
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
+from telegram.error import BadRequest
+from telegram.ext import ConversationHandler, CommandHandler, CallbackQueryHandler, CallbackContext, Filters
+
+from . import utils
+from .constants import Flags
+from .locale_mixin import LocaleMixin
+from .utils import TelegramChatID, TelegramMessageID, EFBChannelChatIDStr, TgChatMsgIDStr
+
+if TYPE_CHECKING:
+    from . import TelegramChannel
+    from .bot_manager import TelegramBotManager
+    from .chat_object_cache import ChatObjectCacheManager
+    from .db import BaseDatabaseManager, MsgLog
+
+__all__ = ['MessageSearchManager']
+
+
+class SearchResults(NamedTuple):
+    """Message logs found for a query, displayed in a message as inline buttons."""
+    query: str
+    logs: List['MsgLog']
+
+
+class MessageSearchManager(LocaleMixin):
+    """
+    Search of messages delivered to a Telegram chat, triggered by ``/search``.
+    """
+
+    # Message storage
+    msg_storage: Dict[Tuple[TelegramChatID, TelegramMessageID], SearchResults] = dict()
+    logger: logging.Logger = logging.getLogger(__name__)
+
+    # Consts
+    RESULTS_PER_CHAT = 5
+    """Maximum number of messages found in each slave chat."""
+    MAX_RESULTS = 100
+    """Maximum number of messages found in total."""
+    MAX_LEN_SNIPPET = 48
+
+    def __init__(self, channel: 'TelegramChannel'):
+        self.channel: 'TelegramChannel' = channel
+        self.bot: 'TelegramBotManager' = channel.bot_manager
+        self.db: 'BaseDatabaseManager' = channel.db
+        self.chat_manager: 'ChatObjectCacheManager' = channel.chat_manager
+
+        non_edit_filter = Filters.update.message | Filters.update.channel_post
+        self.bot.dispatcher.add_handler(
+            CommandHandler("search", self.search, filters=non_edit_filter))
+        self.search_handler = ConversationHandler(
+            entry_points=[],
+            states={Flags.SEARCH_RESULTS: [CallbackQueryHandler(self.search_result_action)]},
+            fallbacks=[CallbackQueryHandler(self.bot.session_expired)],
+            per_message=True,
+            per_chat=True,
+            per_user=False
+        )
+        self.bot.dispatcher.add_handler(self.search_handler)
+
+    def search(self, update: Update, context: CallbackContext):
+        """
+        Search messages delivered to the current Telegram chat,
+        and list the best matches from each slave chat.
+        Triggered by ``/search``.
+        """
+        assert isinstance(update, Update)
+        assert update.effective_message
+
+        message: Message = update.effective_message
+        query = " ".join(context.args or [])
+        if not query:
+            return self.bot.reply_error(update, self._(
+                "Send /search followed by keywords to search for messages in this chat."
+            ))
+
+        chat_id = TelegramChatID(message.chat_id)
+        message_id = TelegramMessageID(message.reply_text(self._("Searching...")).message_id)
+        self.bot.send_chat_action(chat_id, ChatAction.TYPING)
+        logs = self.db.search_message_logs(query, master_chat_id=chat_id,
+                                           limit_per_chat=self.RESULTS_PER_CHAT, limit=self.MAX_RESULTS)
+        if not logs:
+            self.bot.edit_message_text(text=self._("No message is found for {query}.").format(query=query),
+                                       chat_id=chat_id, message_id=message_id)
+            return
+        self.msg_storage[(chat_id, message_id)] = SearchResults(query, logs)
+        self.search_handler.conversations[(chat_id, message_id)] = Flags.SEARCH_RESULTS
+        return self.search_results_gen_list(chat_id, message_id)
+
+    def search_results_gen_list(self, chat_id: TelegramChatID, message_id: TelegramMessageID,
+                                offset: int = 0) -> int:
+        """
+        Update a page of search results to a message.
+
+        Messages in supergroups and channels are linked to directly,
+        other messages are quoted in a reply when selected.
+
+        Returns:
+            int: The next state
+        """
+        results = self.msg_storage[(chat_id, message_id)]
+        btn_list: List[List[InlineKeyboardButton]] = []
+        per_page = self.channel.flag("chats_per_page")
+        for idx in range(offset, min(offset + per_page, len(results.logs))):
+            log = results.logs[idx]
+            channel_id, chat_uid, _ = utils.chat_id_str_to_id(EFBChannelChatIDStr(log.slave_origin_uid))
+            chat = self.chat_manager.get_chat(channel_id, chat_uid, build_dummy=True)
+            button_text = f"{chat.channel_emoji}{chat.chat_type_emoji} {chat.display_name}: " \
+                          f"{self.snippet(log, results.query)}"
+            link = utils.message_link(*utils.message_id_str_to_id(TgChatMsgIDStr(log.master_msg_id)))
+            if link:
+                btn_list.append([InlineKeyboardButton(button_text, url=link)])
+            else:
+                btn_list.append([InlineKeyboardButton(button_text, callback_data=f"msg {idx}")])
+
+        page_number_row: List[InlineKeyboardButton] = []
+        if offset - per_page >= 0:
+            page_number_row.append(InlineKeyboardButton(self._("< Prev"),
+                                                        callback_data=f"offset {offset - per_page}"))
+        page_number_row.append(InlineKeyboardButton(self._("Cancel"), callback_data=Flags.CANCEL_PROCESS))
+        if offset + per_page < len(results.logs):
+            page_number_row.append(InlineKeyboardButton(self._("Next >"),
+                                                        callback_data=f"offset {offset + per_page}"))
+        btn_list.append(page_number_row)
+
+        txt = self.ngettext("{count} message is found for <b>{query}</b>.",
+                            "{count} messages are found for <b>{query}</b>.",
+                            len(results.logs)).format(count=len(results.logs), query=html.escape(results.query))
+        self.bot.edit_message_text(text=txt, chat_id=chat_id, message_id=message_id,
+                                   reply_markup=InlineKeyboardMarkup(btn_list), parse_mode='HTML')
+        return Flags.SEARCH_RESULTS
+
+    def search_result_action(self, update: Update, context: CallbackContext) -> int:
+        """
+        Turn pages of search results, or show a message found.
+        Triggered by callback message on status ``Flags.SEARCH_RESULTS``.
+
+        Returns:
+            int: Next status
+        """
+        assert isinstance(update, Update)
+        assert update.effective_chat
+        assert update.effective_message
+        assert update.callback_query
+        assert update.callback_query.data
+
+        chat_id = TelegramChatID(update.effective_chat.id)
+        message_id = TelegramMessageID(update.effective_message.message_id)
+        callback_uid: str = update.callback_query.data
+
+        if callback_uid == Flags.CANCEL_PROCESS or (chat_id, message_id) not in self.msg_storage:
+            self.bot.edit_message_text(text=self._("Cancelled."), chat_id=chat_id, message_id=message_id)
+            self.msg_storage.pop((chat_id, message_id), None)
+            update.callback_query.answer()
+            return ConversationHandler.END
+
+        cmd, param = callback_uid.split()
+        if cmd == "offset":
+            update.callback_query.answer()
+            return self.search_results_gen_list(chat_id, message_id, offset=int(param))
+
+        if cmd == "msg":
+            log = self.msg_storage[(chat_id, message_id)].logs[int(param)]
+            _, log_message_id = utils.message_id_str_to_id(TgChatMsgIDStr(log.master_msg_id))
+            try:
+                self.bot.send_message(chat_id, self._("Message found."), reply_to_message_id=log_message_id)
+            except BadRequest:
+                update.callback_query.answer(self._("This message is no longer available in Telegram."))
+                return Flags.SEARCH_RESULTS
+            update.callback_query.answer()
+            return Flags.SEARCH_RESULTS
+
+        txt = self._("Invalid parameter ({0}). (IP01)").format(callback_uid)
+        self.bot.edit_message_text(text=txt, chat_id=chat_id, message_id=message_id)
+        self.msg_storage.pop((chat_id, message_id), None)
+        update.callback_query.answer()
+        return ConversationHandler.END
+
+    def snippet(self, log: 'MsgLog', query: str) -> str:
+        """Part of the text of a message found around the first term matched."""
+        text = " ".join(log.text.split()) or log.msg_type
+        lowered = text.lower()
+        start = min((lowered.find(i.lower()) for i in query.split() if i.lower() in lowered), default=0)
+        start = max(0, start - self.MAX_LEN_SNIPPET // 4)
+        if start:
+            text = "…" + text[start:]
+        if len(text) > self.MAX_LEN_SNIPPET:
+            text = text[:self.MAX_LEN_SNIPPET - 1] + "…"
+        return text
@@ -0,0 +1,258 @@
+# coding=utf-8
+"""
+Cold archive of old message logs.
+
+Message logs older than a configured age are moved out of the database into
+append-only archive segments, one per month, so that the live table stays
+small. Archived logs can still be looked up by either key, so that old
+messages can still be edited, replied to and reacted on.
+
+Each segment consists of two files:
+
+- ``msglog-YYYY-MM.seg``: blocks of message logs, each a 4-byte big-endian
+  length followed by a zlib-compressed JSON array of rows.
+- ``msglog-YYYY-MM.idx``: the length of the segment file covered by the
+  index as an 8-byte big-endian integer, followed by sorted entries of a
+  64-bit hash of a key and the offset of the block with the row, both
+  8-byte big-endian integers. Each row has two entries, one for each key.
+
+Blocks not covered by the index, e.g. when ETM stopped while archiving, are
+indexed again when the segment is loaded.
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, List, Optional, Iterator, Tuple
+
+from .msg_log_buffer import MsgLogRow, SlaveMsgKey
+from .utils import TgChatMsgIDStr, parse_isoformat
+
+SEGMENT_NAME_FORMAT = "msglog-%Y-%m"
+"""Name of the segment of message logs by their time, in ``strftime`` format."""
+
+BLOCK_SIZE = 64
+"""Maximum number of rows in a block, i.e. to decompress on lookups."""
+
+_BLOCK_HEADER = struct.Struct(">I")
+_INDEX_HEADER = struct.Struct(">Q")
+_INDEX_ENTRY = struct.Struct(">QQ")
+
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def _master_key_hash(master_msg_id: TgChatMsgIDStr) -> int:
+    return _key_hash("m" + master_msg_id)
+
+
+def _slave_key_hash(slave_key: SlaveMsgKey) -> int:
+    return _key_hash("s" + slave_key[0] + "\0" + slave_key[1])
+
+
+def _slave_key(row: MsgLogRow) -> SlaveMsgKey:
+    return row['slave_origin_uid'], row['slave_message_id']
+
+
+def _encode_row(row: MsgLogRow) -> MsgLogRow:
+    row = row.copy()
+    if row.get('pickle') is not None:
+        row['pickle'] = base64.b64encode(row['pickle']).decode()
+    if row.get('time') is not None:
+        row['time'] = row['time'].isoformat()
+    return row
+
+
+def _decode_row(row: MsgLogRow) -> MsgLogRow:
+    if row.get('pickle') is not None:
+        row['pickle'] = base64.b64decode(row['pickle'])
+    if row.get('time') is not None:
+        row['time'] = parse_isoformat(row['time'])
+    return row
+
+
+class MessageLogArchive:
+    """Append-only archive of message log rows in monthly segments.
+
+    Rows appended are only visible to :meth:`get` in the same process until
+    :meth:`flush_index` is called, which writes the index of all segments
+    appended to.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Args:
+            path: Directory of segment files.
+        """
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self._indexes: Dict[str, bytes] = {}
+        """Sorted index entries of loaded segments."""
+        self._pending: Dict[str, Dict[int, List[int]]] = {}
+        """Key hashes to block offsets of rows not yet written to index files."""
+
+    def _segment_path(self, name: str) -> Path:
+        return self.path / f"{name}.seg"
+
+    def _index_path(self, name: str) -> Path:
+        return self.path / f"{name}.idx"
+
+    def segments(self) -> List[str]:
+        """Names of all segments, from the newest to the oldest."""
+        return sorted((i.stem for i in self.path.glob("msglog-*.seg")), reverse=True)
+
+    def _iter_blocks(self, name: str, offset: int) -> Iterator[Tuple[int, int, List[MsgLogRow]]]:
+        """Read blocks from an offset of a segment, yielding their start and
+        end offsets and rows, until the end of the segment or an incomplete
+        block.
+        """
+        with self._segment_path(name).open("rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(_BLOCK_HEADER.size)
+                if len(header) < _BLOCK_HEADER.size:
+                    return
+                size = _BLOCK_HEADER.unpack(header)[0]
+                data = f.read(size)
+                if len(data) < size:
+                    return
+                yield offset, f.tell(), json.loads(zlib.decompress(data))
+                offset = f.tell()
+
+    def _read_block(self, name: str, offset: int) -> List[MsgLogRow]:
+        return next(self._iter_blocks(name, offset))[2]
+
+    def _add_pending(self, name: str, offset: int, rows: List[MsgLogRow]):
+        pending = self._pending.setdefault(name, {})
+        for row in rows:
+            pending.setdefault(_master_key_hash(row['master_msg_id']), []).append(offset)
+            pending.setdefault(_slave_key_hash(_slave_key(row)), []).append(offset)
+
+    def _load_index(self, name: str) -> bytes:
+        """Load the index of a segment, and index blocks not covered by it."""
+        if name in self._indexes:
+            return self._indexes[name]
+        covered, entries = 0, b""
+        index_path = self._index_path(name)
+        if index_path.exists():
+            data = index_path.read_bytes()
+            covered, entries = _INDEX_HEADER.unpack_from(data)[0], data[_INDEX_HEADER.size:]
+        segment_path = self._segment_path(name)
+        if segment_path.exists() and segment_path.stat().st_size > covered:
+            self.logger.info("Indexing archived message logs in %s from offset %s.", segment_path, covered)
+            end = covered
+            for offset, end, rows in self._iter_blocks(name, covered):
+                self._add_pending(name, offset, rows)
+            if segment_path.stat().st_size > end:
+                # Remove the incomplete block written before ETM stopped,
+                # its rows are still in the database.
+                self.logger.warning("Incomplete block at offset %s of %s is removed.", end, segment_path)
+                with segment_path.open("r+b") as f:
+                    f.truncate(end)
+        self._indexes[name] = entries
+        return entries
+
+    def append(self, rows: List[MsgLogRow]):
+        """Append rows to segments of their months. Rows must have a time."""
+        groups: Dict[str, List[MsgLogRow]] = {}
+        for row in rows:
+            groups.setdefault(row['time'].strftime(SEGMENT_NAME_FORMAT), []).append(row)
+        with self.lock:
+            for name, group in groups.items():
+                self._load_index(name)
+                with self._segment_path(name).open("ab") as f:
+                    for i in range(0, len(group), BLOCK_SIZE):
+                        block = group[i:i + BLOCK_SIZE]
+                        data = zlib.compress(json.dumps([_encode_row(j) for j in block], ensure_ascii=False,
+                                                        separators=(',', ':')).encode())
+                        offset = f.tell()
+                        f.write(_BLOCK_HEADER.pack(len(data)) + data)
+                        self._add_pending(name, offset, block)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def flush_index(self):
+        """Write index entries of rows appended to index files."""
+        with self.lock:
+            for name, pending in self._pending.items():
+                entries = list(_INDEX_ENTRY.iter_unpack(self._load_index(name)))
+                entries.extend((key, offset) for key, offsets in pending.items() for offset in offsets)
+                entries.sort()
+                data = b"".join(_INDEX_ENTRY.pack(*i) for i in entries)
+                index_path = self._index_path(name)
+                temp_path = index_path.with_suffix(".idx.tmp")
+                with temp_path.open("wb") as f:
+                    f.write(_INDEX_HEADER.pack(self._segment_path(name).stat().st_size) + data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, index_path)
+                self._indexes[name] = data
+            self._pending.clear()
+
+    def _find(self, name: str, key: int) -> List[int]:
+        """Offsets of blocks with rows of a key hash in a segment, from the
+        latest to the earliest.
+        """
+        entries = self._load_index(name)
+        lo, hi = 0, len(entries) // _INDEX_ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _INDEX_ENTRY.unpack_from(entries, mid * _INDEX_ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        offsets = []
+        for entry_key, offset in _INDEX_ENTRY.iter_unpack(memoryview(entries)[lo * _INDEX_ENTRY.size:]):
+            if entry_key != key:
+                break
+            offsets.append(offset)
+        offsets.extend(self._pending.get(name, {}).get(key, []))
+        return sorted(set(offsets), reverse=True)
+
+    def get(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+            slave_key: Optional[SlaveMsgKey] = None) -> Optional[MsgLogRow]:
+        """Get the latest archived row by either key."""
+        if master_msg_id is not None:
+            key = _master_key_hash(master_msg_id)
+        elif slave_key is not None:
+            key = _slave_key_hash(slave_key)
+        else:
+            return None
+        with self.lock:
+            for name in self.segments():
+                for offset in self._find(name, key):
+                    for row in reversed(self._read_block(name, offset)):
+                        if master_msg_id is not None and row['master_msg_id'] == master_msg_id or \
+                                master_msg_id is None and _slave_key(row) == slave_key:
+                            return _decode_row(row)
+        return None
+
+    def prune(self, before: datetime.datetime) -> List[str]:
+        """Remove segments of months entirely before a time.
+
+        Returns:
+            Names of segments removed.
+        """
+        removed = []
+        with self.lock:
+            for name in self.segments():
+                if name >= before.strftime(SEGMENT_NAME_FORMAT):
+                    continue
+                self._segment_path(name).unlink()
+                with suppress(FileNotFoundError):
+                    self._index_path(name).unlink()
+                self._indexes.pop(name, None)
+                self._pending.pop(name, None)
+                removed.append(name)
+        return removed
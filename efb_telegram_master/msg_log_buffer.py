@@ -0,0 +1,198 @@
+# coding=utf-8
+"""
+Write-behind buffer of message logs.
+
+Message logs are kept in memory and written to the database in batches by
+a background thread, so that delivering a message does not wait for the
+database writer.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .utils import TgChatMsgIDStr, EFBChannelChatIDStr
+
+MsgLogRow = Dict[str, Any]
+"""Column values of a ``MsgLog`` row, keyed by field name."""
+SlaveMsgKey = Tuple[EFBChannelChatIDStr, str]
+"""Slave origin chat ID and slave message ID of a message log."""
+
+
+class MessageLogBuffer:
+    """Buffer message log rows and flush them to the database in batches.
+
+    Rows are flushed when ``batch_size`` rows are pending, or every
+    ``interval`` seconds, whichever comes first. Rows written to the same
+    Telegram message before a flush are coalesced into one.
+
+    Rows stay visible through :meth:`get` until they are flushed to the
+    database, so that lookups following a write (edits, replies, reactions)
+    see it. Rows failed to be written are kept and retried, with the delay
+    doubled after each failure, up to :attr:`MAX_RETRY_DELAY` seconds.
+    """
+
+    MAX_RETRY_DELAY = 60.0
+    """Maximum number of seconds to wait before retrying a failed flush."""
+    STOP_ATTEMPTS = 3
+    """Number of attempts of the final flush when the buffer is stopped."""
+
+    def __init__(self, flush: Callable[[List[MsgLogRow]], Any],
+                 batch_size: int = 100, interval: float = 1.0):
+        """
+        Args:
+            flush: Write a list of rows to the database in one transaction.
+            batch_size: Number of pending rows that triggers a flush.
+            interval: Maximum number of seconds a row stays pending.
+        """
+        self.logger: logging.Logger = logging.getLogger(__name__)
+        self._flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.lock = threading.RLock()
+        """Lock of the pending and in-flight rows."""
+        self.flush_lock = threading.Lock()
+        """Lock held while a batch is being written to the database."""
+        self.pending: Dict[TgChatMsgIDStr, MsgLogRow] = {}
+        """Rows waiting for the next flush."""
+        self.in_flight: Dict[TgChatMsgIDStr, MsgLogRow] = {}
+        """Rows being written to the database."""
+        self.slave_index: Dict[SlaveMsgKey, TgChatMsgIDStr] = {}
+        """Slave message key to master message ID of pending and in-flight rows."""
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.worker_thread = threading.Thread(target=self.worker, name="ETM message log writer thread",
+                                              daemon=True)
+        self.worker_thread.start()
+
+    @staticmethod
+    def slave_key(row: MsgLogRow) -> SlaveMsgKey:
+        return row['slave_origin_uid'], row['slave_message_id']
+
+    def put(self, row: MsgLogRow):
+        """Enqueue a row to be inserted or updated."""
+        key: TgChatMsgIDStr = row['master_msg_id']
+        with self.lock:
+            previous = self.pending.get(key) or self.in_flight.get(key)
+            if previous is not None:
+                # Keep the time of the first record, and previous pickled
+                # data if nothing is to be pickled, as updates in database do.
+                row['time'] = previous['time']
+                if row['pickle'] is None:
+                    row['pickle'] = previous['pickle']
+                    if 'target_msg_id' in previous:
+                        row['target_msg_id'] = previous['target_msg_id']
+                if self.slave_index.get(self.slave_key(previous)) == key:
+                    del self.slave_index[self.slave_key(previous)]
+            self.pending[key] = row
+            self.slave_index[self.slave_key(row)] = key
+            if len(self.pending) >= self.batch_size:
+                self._wake.set()
+
+    def _lookup(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                slave_key: Optional[SlaveMsgKey] = None) -> Optional[TgChatMsgIDStr]:
+        if master_msg_id is None and slave_key is not None:
+            master_msg_id = self.slave_index.get(slave_key)
+        if master_msg_id in self.pending or master_msg_id in self.in_flight:
+            return master_msg_id
+        return None
+
+    def get(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+            slave_key: Optional[SlaveMsgKey] = None) -> Optional[MsgLogRow]:
+        """Get a row not yet written to the database, by either key."""
+        with self.lock:
+            key = self._lookup(master_msg_id, slave_key)
+            if key is None:
+                return None
+            return (self.pending.get(key) or self.in_flight[key]).copy()
+
+    def discard(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                slave_key: Optional[SlaveMsgKey] = None):
+        """Remove a row not yet written to the database, by either key.
+
+        Callers should hold :attr:`flush_lock` while removing the row from
+        the database, to prevent an in-flight copy from being written
+        afterwards.
+        """
+        with self.lock:
+            key = self._lookup(master_msg_id, slave_key)
+            if key is None:
+                return
+            row = self.pending.pop(key, None) or self.in_flight.pop(key)
+            if self.slave_index.get(self.slave_key(row)) == key:
+                del self.slave_index[self.slave_key(row)]
+
+    def flush(self):
+        """Write all pending rows to the database.
+
+        Rows failed to be written are put back to be written in the next
+        flush, unless newer rows of the same message are written since.
+
+        Raises:
+            Exception: Error raised from writing rows to the database.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                self.in_flight, self.pending = self.pending, {}
+            batch = list(self.in_flight.values())
+            try:
+                self._flush(batch)
+                self.logger.debug("Flushed %s message logs to database.", len(batch))
+            except Exception:
+                with self.lock:
+                    for key, row in self.in_flight.items():
+                        self.pending.setdefault(key, row)
+                    self.in_flight = {}
+                raise
+            with self.lock:
+                for key, row in self.in_flight.items():
+                    if key not in self.pending and self.slave_index.get(self.slave_key(row)) == key:
+                        del self.slave_index[self.slave_key(row)]
+                self.in_flight = {}
+
+    def worker(self):
+        failures = 0
+        while not self._stop.is_set():
+            if failures:
+                # Retry after a delay, regardless of batches filled up.
+                self._stop.wait(min(max(self.interval, 1.0) * 2 ** (failures - 1), self.MAX_RETRY_DELAY))
+            else:
+                self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                # Rows left are written by stop().
+                break
+            # noinspection PyBroadException
+            try:
+                self.flush()
+                failures = 0
+            except Exception:
+                failures += 1
+                self.logger.exception("Failed to write %s message logs to database, retrying later.",
+                                      len(self.pending))
+
+    def stop(self):
+        """Stop the background thread and flush all pending rows.
+
+        Raises:
+            Exception: Error raised from writing rows to the database in
+                the last of :attr:`STOP_ATTEMPTS` attempts.
+        """
+        self._stop.set()
+        self._wake.set()
+        self.worker_thread.join()
+        for attempt in range(1, self.STOP_ATTEMPTS + 1):
+            try:
+                self.flush()
+                return
+            except Exception:
+                if attempt == self.STOP_ATTEMPTS:
+                    raise
+                self.logger.exception("Failed to write %s message logs to database, retrying (%s/%s).",
+                                      len(self.pending), attempt, self.STOP_ATTEMPTS)
+                time.sleep(attempt)
@@ -0,0 +1,118 @@
+# coding=utf-8
+"""
+Size-bounded LRU cache of recent message logs.
+
+Edits, reactions, removals and replies usually look up message logs written
+shortly before, by either the Telegram message ID or the slave message ID.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from .msg_log_buffer import MsgLogRow, SlaveMsgKey
+from .utils import TgChatMsgIDStr
+
+
+class MessageLogCache:
+    """LRU cache of message log rows, indexed by both master message ID and
+    slave message key.
+
+    Rows in the cache must be identical to those in the database, callers
+    are responsible to :meth:`put` rows as written, and :meth:`discard` rows
+    that are changed otherwise. Rows read from the database are put with the
+    ``generation`` before the read, so that they are not cached if changed
+    in the meantime.
+    """
+
+    def __init__(self, size: int):
+        """
+        Args:
+            size: Maximum number of rows kept in the cache.
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.rows: 'OrderedDict[TgChatMsgIDStr, MsgLogRow]' = OrderedDict()
+        """Cached rows, from the least to the most recently used."""
+        self.slave_index: Dict[SlaveMsgKey, TgChatMsgIDStr] = {}
+        """Slave message key to master message ID of cached rows, the
+        newest row by time where rows share a key, as looked up from the
+        database."""
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        """Number of changes to the cache, see :meth:`put`."""
+
+    @staticmethod
+    def slave_key(row: MsgLogRow) -> SlaveMsgKey:
+        return row['slave_origin_uid'], row['slave_message_id']
+
+    def _remove(self, key: TgChatMsgIDStr):
+        row = self.rows.pop(key, None)
+        if row is not None and self.slave_index.get(self.slave_key(row)) == key:
+            del self.slave_index[self.slave_key(row)]
+
+    def get(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+            slave_key: Optional[SlaveMsgKey] = None) -> Optional[MsgLogRow]:
+        """Get a cached row by either key, and count the hit or miss."""
+        with self.lock:
+            if master_msg_id is None and slave_key is not None:
+                master_msg_id = self.slave_index.get(slave_key)
+            row = self.rows.get(master_msg_id) if master_msg_id is not None else None
+            if row is None or master_msg_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.rows.move_to_end(master_msg_id)
+            return row.copy()
+
+    def put(self, row: MsgLogRow, generation: Optional[int] = None, newest: bool = True) -> bool:
+        """Add or replace a row, and evict the least recently used rows
+        beyond the size limit.
+
+        Args:
+            row: The row to add.
+            generation: ``generation`` before the row is read, if given,
+                the row is not added if any row is put or discarded since.
+            newest: If the row may be the newest row of its slave message
+                key, false for rows read by master message ID, which are
+                then not looked up by slave message key.
+
+        Returns:
+            If the row is added.
+        """
+        key: TgChatMsgIDStr = row['master_msg_id']
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self.generation += 1
+            self._remove(key)
+            self.rows[key] = row.copy()
+            slave_key = self.slave_key(row)
+            indexed_key = self.slave_index.get(slave_key)
+            indexed = self.rows.get(indexed_key) if indexed_key is not None else None
+            if indexed is None or not row['time'] < indexed['time']:
+                if newest:
+                    self.slave_index[slave_key] = key
+                elif indexed is not None:
+                    # A newer row not cached may exist in the database.
+                    del self.slave_index[slave_key]
+            while len(self.rows) > self.size:
+                self._remove(next(iter(self.rows)))
+        return True
+
+    def discard(self, master_msg_id: Optional[TgChatMsgIDStr] = None,
+                slave_key: Optional[SlaveMsgKey] = None):
+        """Remove a row by either key, if cached."""
+        with self.lock:
+            self.generation += 1
+            if master_msg_id is None and slave_key is not None:
+                master_msg_id = self.slave_index.get(slave_key)
+            if master_msg_id is not None:
+                self._remove(master_msg_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Size and hit/miss counters of the cache."""
+        with self.lock:
+            return {"size": len(self.rows), "capacity": self.size,
+                    "hits": self.hits, "misses": self.misses}
@@ -1,8 +1,10 @@
 import threading
-from typing import TYPE_CHECKING, Optional, List
+from typing import TYPE_CHECKING, Optional, List, Dict, Union
 from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
 
 from ehforwarderbot import coordinator
+from . import utils
+from .utils import TelegramChatID, TgChatMsgIDStr
 
 if TYPE_CHECKING:
     from . import TelegramChannel
@@ -34,6 +36,9 @@ class RPCUtilities:
         self.server.register_multicall_functions()
         self.server.register_instance(self.channel.db)
         self.server.register_function(self.get_slave_channels_ids)
+        # Arguments are not typed as any value XML-RPC can marshal.
+        self.server.register_function(self.search_messages)  # type: ignore[arg-type]
+        self.server.register_function(self.get_chat_cache_stats)
 
         threading.Thread(target=self.server.serve_forever, name="ETM RPC server thread")
 
@@ -47,4 +52,47 @@ class RPCUtilities:
         """Get the collection of slave channel IDs in current instance"""
         return list(coordinator.slaves.keys())
 
+    def search_messages(self, query: str, master_chat_id: int = 0, limit_per_chat: int = 5) -> List[Dict[str, str]]:
+        """Search messages delivered to Telegram by text, see
+        ``BaseDatabaseManager.search_message_logs``.
+
+        Args:
+            query: Terms to search, separated by whitespaces.
+            master_chat_id: Telegram chat to search in, 0 for all chats.
+            limit_per_chat: Maximum number of messages from each slave chat.
+
+        Returns:
+            Messages found, with their Telegram and slave message IDs, text,
+            time in ISO 8601 format, and link to the Telegram message
+            if available.
+        """
+        results = []
+        chat_id = TelegramChatID(master_chat_id) if master_chat_id else None
+        for log in self.channel.db.search_message_logs(query, master_chat_id=chat_id, limit_per_chat=limit_per_chat):
+            result = {
+                "master_msg_id": log.master_msg_id,
+                "slave_origin_uid": log.slave_origin_uid,
+                "slave_member_uid": log.slave_member_uid or "",
+                "slave_message_id": log.slave_message_id,
+                "text": log.text,
+                "time": log.time.isoformat() if log.time else "",
+            }
+            link = utils.message_link(*utils.message_id_str_to_id(TgChatMsgIDStr(log.master_msg_id)))
+            if link:
+                result["link"] = link
+            results.append(result)
+        return results
+
+    def get_chat_cache_stats(self) -> Dict[str, Union[int, float]]:
+        """Number of chats and members in the chat object cache, and their
+        estimated size in bytes, see ``ChatObjectCacheManager.stats``.
+
+        Sizes are returned as floats, as integers in XML-RPC are limited
+        to 32 bits.
+        """
+        stats: Dict[str, Union[int, float]] = dict(self.channel.chat_manager.stats())
+        for key in ("estimated_bytes", "memory_limit"):
+            stats[key] = float(stats[key])
+        return stats
+
     # TODO: add more utilities that could be useful for RPC?
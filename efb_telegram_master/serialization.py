@@ -0,0 +1,205 @@
+# coding=utf-8
+"""
+Compact versioned encoding of miscellaneous message data and chat objects
+stored in the database.
+
+An encoded blob is one byte of format version followed by the payload:
+
+- Version 0: a pickle, used for data that cannot be represented in
+  version 1, e.g. vendor specific data of custom types.
+- Version 1: a compact JSON array of the schema described below.
+
+Blobs written before format versions are introduced are bare pickles,
+which start with a byte other than the above.
+
+Format version 1
+----------------
+
+Records are JSON arrays with values in the order of fields in their schema,
+trailing values equal to their defaults are omitted. Miscellaneous message
+data (``MsgLog.pickle``) follows :data:`MISC_MSG_SCHEMA`, where
+
+- ``attributes`` is one of ``["location", latitude, longitude]``,
+  ``["link", title, description, image, url]`` or
+  ``["status", status_type, timeout]``;
+- ``commands`` is a list of ``[name, callable_name, args, kwargs]``;
+- ``substitutions`` is a list of ``[start, end, chat ID string]``;
+- ``reactions`` is an object of reaction names to lists of chat ID strings.
+
+Chat objects (``SlaveChatInfo.pickle``) are described in
+:func:`.chat.encode_chat`.
+"""
+
+import json
+import pickle
+from typing import Any, Dict, List, Sequence, Tuple
+
+from ehforwarderbot.message import MessageAttribute, LocationAttribute, LinkAttribute, StatusAttribute, \
+    MessageCommands, MessageCommand
+
+__all__ = ['PICKLE', 'JSON', 'VERSIONS', 'Schema', 'MISC_MSG_SCHEMA',
+           'is_pickle', 'dumps', 'loads', 'dumps_pickle', 'loads_pickle', 'pack', 'unpack',
+           'is_plain', 'encode_misc_msg', 'decode_misc_msg']
+
+PICKLE = 0
+"""Format version of pickles."""
+JSON = 1
+"""Format version of JSON documents."""
+VERSIONS = (bytes([PICKLE]), bytes([JSON]))
+"""Leading bytes of blobs with format version."""
+
+Schema = Tuple[Tuple[str, Any], ...]
+"""Names and default values of fields in a record, in order."""
+
+MISC_MSG_SCHEMA: Schema = (("target", None), ("is_system", None), ("attributes", None),
+                           ("commands", None), ("substitutions", None), ("reactions", None))
+"""Schema of miscellaneous message data, see ``PickledDict``."""
+
+
+def is_pickle(data: bytes) -> bool:
+    """If the blob is a pickle, with or without format version."""
+    return data[:1] != VERSIONS[JSON]
+
+
+def dumps(record: List[Any]) -> bytes:
+    """Encode a record as JSON."""
+    return VERSIONS[JSON] + json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def loads(data: bytes) -> List[Any]:
+    """Decode a record encoded as JSON.
+
+    Raises:
+        ValueError: If the blob is not encoded as JSON.
+    """
+    if is_pickle(data):
+        raise ValueError(f"Blob of format version {data[:1]!r} is not encoded as JSON.")
+    return json.loads(data[1:].decode())
+
+
+def pack(values: Dict[str, Any], schema: Schema) -> List[Any]:
+    """Pack values into a record, omitting trailing default values."""
+    record = [values.get(k, v) for k, v in schema]
+    while record and record[-1] == schema[len(record) - 1][1]:
+        record.pop()
+    return record
+
+
+def unpack(record: Sequence[Any], schema: Schema) -> Dict[str, Any]:
+    """Unpack a record into values by field names."""
+    values = {k: v for k, v in schema[len(record):]}
+    values.update(zip((k for k, _ in schema), record))
+    return values
+
+
+def dumps_pickle(obj: Any) -> bytes:
+    """Encode an object as pickle."""
+    return VERSIONS[PICKLE] + pickle.dumps(obj)
+
+
+def loads_pickle(data: bytes) -> Any:
+    """Decode a pickle, with or without format version."""
+    if data[:1] == VERSIONS[PICKLE]:
+        data = data[1:]
+    return pickle.loads(data)
+
+
+def is_plain(value: Any) -> bool:
+    """If a value is preserved as is through JSON encoding."""
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    if isinstance(value, list):
+        return all(is_plain(i) for i in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and is_plain(v) for k, v in value.items())
+    return False
+
+
+def _encode_attributes(attributes: MessageAttribute) -> List[Any]:
+    # Check exact types, as subclasses may carry extra data.
+    if type(attributes) is LocationAttribute:
+        return ["location", attributes.latitude, attributes.longitude]
+    if type(attributes) is LinkAttribute:
+        return ["link", attributes.title, attributes.description, attributes.image, attributes.url]
+    if type(attributes) is StatusAttribute:
+        return ["status", attributes.status_type.name, attributes.timeout]
+    raise TypeError(f"Unsupported message attributes: {attributes!r}")
+
+
+def _build(cls, attributes: Dict[str, Any]):
+    # Rebuild objects without verification in constructors, as pickle does.
+    obj = cls.__new__(cls)
+    obj.__dict__.update(attributes)
+    return obj
+
+
+def _decode_attributes(data: List[Any]) -> MessageAttribute:
+    if data[0] == "location":
+        return _build(LocationAttribute, {"latitude": data[1], "longitude": data[2]})
+    if data[0] == "link":
+        return _build(LinkAttribute, {"title": data[1], "description": data[2], "image": data[3], "url": data[4]})
+    if data[0] == "status":
+        return _build(StatusAttribute, {"status_type": StatusAttribute.Types[data[1]], "timeout": data[2]})
+    raise ValueError(f"Unknown message attributes type: {data[0]!r}")
+
+
+def _encode_commands(commands: MessageCommands) -> List[List[Any]]:
+    result = []
+    for i in commands:
+        args, kwargs = list(i.args), dict(i.kwargs)
+        if not is_plain(args) or not is_plain(kwargs):
+            raise TypeError(f"Arguments of message command {i!r} cannot be encoded.")
+        result.append([i.name, i.callable_name, args, kwargs])
+    return result
+
+
+def _decode_commands(data: List[List[Any]]) -> MessageCommands:
+    commands = MessageCommands.__new__(MessageCommands)
+    for name, callable_name, args, kwargs in data:
+        commands.append(_build(MessageCommand, {"name": name, "callable_name": callable_name,
+                                                "args": tuple(args), "kwargs": kwargs}))
+    return commands
+
+
+def encode_misc_msg(data: Dict[str, Any]) -> bytes:
+    """Encode miscellaneous message data, see ``PickledDict``.
+
+    Data that cannot be represented in JSON, e.g. message commands with
+    custom arguments or text with lone surrogates, is encoded as pickle.
+    """
+    values = dict(data)
+    try:
+        if 'attributes' in data:
+            values['attributes'] = _encode_attributes(data['attributes'])
+        if 'commands' in data:
+            values['commands'] = _encode_commands(data['commands'])
+        if 'substitutions' in data:
+            values['substitutions'] = [[k[0], k[1], v] for k, v in data['substitutions'].items()]
+        if 'reactions' in data:
+            values['reactions'] = {k: list(v) for k, v in data['reactions'].items()}
+        return dumps(pack(values, MISC_MSG_SCHEMA))
+    except (TypeError, ValueError):
+        return dumps_pickle(data)
+
+
+def decode_misc_msg(data: bytes) -> Dict[str, Any]:
+    """Decode miscellaneous message data encoded in any format."""
+    if is_pickle(data):
+        return loads_pickle(data)
+    record = loads(data)
+    target, is_system, attributes, commands, substitutions, reactions = \
+        record + [None] * (len(MISC_MSG_SCHEMA) - len(record))
+    result: Dict[str, Any] = {}
+    if target is not None:
+        result['target'] = target
+    if is_system is not None:
+        result['is_system'] = is_system
+    if attributes is not None:
+        result['attributes'] = _decode_attributes(attributes)
+    if commands is not None:
+        result['commands'] = _decode_commands(commands)
+    if substitutions is not None:
+        result['substitutions'] = {(i[0], i[1]): i[2] for i in substitutions}
+    if reactions is not None:
+        result['reactions'] = {k: tuple(v) for k, v in reactions.items()}
+    return result
@@ -34,12 +34,12 @@ from .constants import Emoji
 from .locale_mixin import LocaleMixin
 from .message import ETMMsg
 from .msg_type import get_msg_type
-from .utils import TelegramChatID, TelegramMessageID, OldMsgID
+from .utils import TelegramChatID, TelegramMessageID, OldMsgID, TgChatMsgIDStr
 
 if TYPE_CHECKING:
     from . import TelegramChannel
     from .bot_manager import TelegramBotManager
-    from .db import DatabaseManager
+    from .db import BaseDatabaseManager
 
 
 class SlaveMessageProcessor(LocaleMixin):
@@ -50,7 +50,7 @@ class SlaveMessageProcessor(LocaleMixin):
         self.bot: 'TelegramBotManager' = self.channel.bot_manager
         self.logger: logging.Logger = logging.getLogger(__name__)
         self.flag: utils.ExperimentalFlagsManager = self.channel.flag
-        self.db: 'DatabaseManager' = channel.db
+        self.db: 'BaseDatabaseManager' = channel.db
         self.chat_dest_cache: ChatDestinationCache = channel.chat_dest_cache
         self.chat_manager: ChatObjectCacheManager = channel.chat_manager
 
@@ -125,8 +125,14 @@ class SlaveMessageProcessor(LocaleMixin):
 
     def dispatch_message(self, msg: Message, msg_template: str,
                          old_msg_id: Optional[OldMsgID], tg_dest: TelegramChatID,
-                         silent: bool = False):
-        """Dispatch with header, destination and Telegram message ID and destinations."""
+                         silent: bool = False, reactions_only: bool = False):
+        """Dispatch with header, destination and Telegram message ID and destinations.
+
+        Args:
+            reactions_only: If only reactions of the message are updated, in
+                which case the message log is not written again unless the
+                Telegram message is replaced.
+        """
 
         xid = msg.uid
 
@@ -219,6 +225,10 @@ class SlaveMessageProcessor(LocaleMixin):
         self.logger.debug("[%s] Message is sent to the user with telegram message id %s.%s.",
                           xid, tg_msg.chat.id, tg_msg.message_id)
 
+        if reactions_only and old_msg_id == (tg_msg.chat.id, tg_msg.message_id):
+            self.logger.debug("[%s] Reactions of the message are updated.", xid)
+            return
+
         etm_msg = ETMMsg.from_efbmsg(msg, self.chat_manager)
         etm_msg.type_telegram = get_msg_type(tg_msg)
         etm_msg.put_telegram_file(tg_msg)
@@ -891,9 +901,10 @@ class SlaveMessageProcessor(LocaleMixin):
     def send_status(self, status: Status):
         if isinstance(status, ChatUpdates):
             self.logger.debug("Received chat updates from channel %s", status.channel)
+            self.chat_manager.clear_misses(status.channel.channel_id)
             for i in status.removed_chats:
-                self.db.delete_slave_chat_info(status.channel.channel_id, i)
                 self.chat_manager.delete_chat_object(status.channel.channel_id, i)
+                self.db.delete_slave_chat_info(status.channel.channel_id, i)
             for i in itertools.chain(status.new_chats, status.modified_chats):
                 chat = status.channel.get_chat(i)
                 self.chat_manager.update_chat_obj(chat, full_update=True)
@@ -951,8 +962,10 @@ class SlaveMessageProcessor(LocaleMixin):
                                   'Message ID %s from %s, status: %s.', status.msg_id, status.chat, status.reactions)
             return
 
+        # Only reactions added or removed are written, the footer is then
+        # built from reactions recorded.
+        self.db.set_message_reactions(TgChatMsgIDStr(old_msg_db.master_msg_id), status.reactions)
         old_msg: ETMMsg = old_msg_db.build_etm_msg(chat_manager=self.chat_manager)
-        old_msg.reactions = status.reactions
         old_msg.edit = True
 
         msg_template, _ = self.get_slave_msg_dest(old_msg)
@@ -960,7 +973,8 @@ class SlaveMessageProcessor(LocaleMixin):
         chat_id, msg_id = utils.message_id_str_to_id(effective_msg)
 
         # Go through the ordinary update process
-        self.dispatch_message(old_msg, msg_template, old_msg_id=(chat_id, msg_id), tg_dest=chat_id)
+        self.dispatch_message(old_msg, msg_template, old_msg_id=(chat_id, msg_id), tg_dest=chat_id,
+                              reactions_only=True)
 
     def generate_message_template(self, msg: Message, singly_linked: bool) -> str:
         msg_prefix = ""  # For group member name
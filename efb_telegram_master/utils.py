@@ -1,6 +1,7 @@
 # coding=utf-8
 
 import base64
+import datetime
 import json
 import logging
 import os
@@ -55,6 +56,25 @@ class ExperimentalFlagsManager(LocaleMixin):
         "api_base_url": None,
         "api_base_file_url": None,
         "local_tdlib_api": False,
+        "online_migration": False,
+        "message_log_write_behind": False,
+        "message_log_batch_size": 100,
+        "message_log_flush_interval": 1.0,
+        "message_log_cache_size": 1000,
+        "message_log_max_age": 0,
+        "message_log_max_rows_per_chat": 0,
+        "database_max_size": 0,
+        "message_log_archive_after": 0,
+        "database_pragmas": {},
+        "database_read_connections": 4,
+        "database_maintenance_interval": 21600,
+        "database_backend": "sqlite",
+        "database_postgresql": {},
+        "chat_loading_timeout": 10.0,
+        "chat_cache_snapshot_interval": 600.0,
+        "chat_flush_interval": 5.0,
+        "chat_miss_ttl": 300.0,
+        "chat_cache_memory_limit": 0,
     }
 
     def __init__(self, channel: 'TelegramChannel'):
@@ -113,6 +133,19 @@ def message_id_str_to_id(s: TgChatMsgIDStr) -> Tuple[TelegramChatID, TelegramMes
     return TelegramChatID(int(msg_ids[0])), TelegramMessageID(int(msg_ids[1]))
 
 
+def message_link(chat_id: TelegramChatID, message_id: TelegramMessageID) -> Optional[str]:
+    """
+    Link to a Telegram message, only available for messages in supergroups
+    and channels.
+
+    Returns:
+        URL of the message, None if the message cannot be linked to.
+    """
+    if chat_id > -1000000000000:
+        return None
+    return f"https://t.me/c/{-1000000000000 - chat_id}/{message_id}"
+
+
 def chat_id_to_str(channel_id: Optional[ModuleID] = None, chat_uid: Optional[ChatID] = None,
                    group_id: Optional[ChatID] = None,
                    chat: Optional[BaseChat] = None, channel: Optional[Channel] = None) -> EFBChannelChatIDStr:
@@ -161,6 +194,15 @@ def chat_id_str_to_id(s: EFBChannelChatIDStr) -> Tuple[ModuleID, ChatID, Optiona
     return channel_id, chat_uid, group_id
 
 
+def parse_isoformat(s: str) -> datetime.datetime:
+    """Parse a naive time written by ``datetime.isoformat()``, with either
+    ``T`` or a space as separator, as ``datetime.fromisoformat()`` which is
+    not available in Python 3.6.
+    """
+    s = s.replace(" ", "T", 1)
+    return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f" if "." in s else "%Y-%m-%dT%H:%M:%S")
+
+
 def export_gif(animation, fp, dpi=96, skip_frames=5):
     """ Fork of lottie.exporters.gif.export_gif
     Adapted from jqqqqqqqqqq/UnifiedMessageRelay
@@ -314,6 +314,7 @@ def setup_telegram_bot_commands_list(data):
                 ("update_info", _("Update info of linked Telegram group.")),
                 ("react", _("Send a reaction to a message, or show a list of reactors.")),
                 ("rm", _("Remove a message from its remote chat.")),
+                ("search", _("Search for messages in the current chat.")),
             ]
         )
 
@@ -68,9 +68,11 @@ setup(
             "lottie",
             "cairosvg",  # required by ``lottie`` to export GIF
         ],
+        "postgresql": ["psycopg2"],
     },
     entry_points={
         "ehforwarderbot.master": "blueset.telegram = efb_telegram_master:TelegramChannel",
-        "ehforwarderbot.wizard": "blueset.telegram = efb_telegram_master.wizard:wizard"
+        "ehforwarderbot.wizard": "blueset.telegram = efb_telegram_master.wizard:wizard",
+        "console_scripts": "etm-db = efb_telegram_master.db_transfer:main",
     }
 )
@@ -1,10 +1,13 @@
-from unittest.mock import patch
+import datetime
+import threading
+from unittest.mock import patch, Mock
 
 from pytest import fixture
 
 from efb_telegram_master.chat_object_cache import ChatObjectCacheManager
+from efb_telegram_master.utils import chat_id_to_str
 from ehforwarderbot import Chat
-from ehforwarderbot.chat import PrivateChat
+from ehforwarderbot.chat import PrivateChat, GroupChat, SystemChatMember
 
 
 @fixture(scope="function")
@@ -41,6 +44,26 @@ def test_chat_manager_build_dummy(chat_manager):
     assert generated.uid == id
 
 
+def test_chat_manager_negative_cache(chat_manager, slave):
+    chat = PrivateChat(channel=slave, uid="__missed__", name="Missed chat")
+    with patch.dict('ehforwarderbot.coordinator.slaves', {slave.channel_id: slave}), \
+            patch.object(slave, "get_chat", side_effect=KeyError) as get_chat:
+        for _ in range(3):
+            assert chat_manager.get_chat(chat.module_id, chat.uid) is None
+            assert chat_manager.get_chat(chat.module_id, chat.uid, build_dummy=True).uid == chat.uid
+        get_chat.assert_called_once()
+
+        chat_manager.clear_misses(chat.module_id)
+        assert chat_manager.get_chat(chat.module_id, chat.uid) is None
+        assert get_chat.call_count == 2
+        chat_manager.misses[(chat.module_id, chat.uid)] = 0
+        assert chat_manager.get_chat(chat.module_id, chat.uid) is None
+        assert get_chat.call_count == 3, "Expired misses are looked up again"
+
+    chat_manager.compound_enrol(chat)
+    assert chat_manager.get_chat(chat.module_id, chat.uid) == chat
+
+
 def test_chat_manager_update_chat_obj(chat_manager, slave):
     chat = PrivateChat(channel=slave, uid="unique_id", name="Chat name")
     chat_manager.compound_enrol(chat)
@@ -50,6 +73,221 @@ def test_chat_manager_update_chat_obj(chat_manager, slave):
     assert chat_manager.get_chat(chat.module_id, chat.uid).alias == chat.alias
 
 
+def test_chat_manager_update_chat_members(chat_manager, slave):
+    group = GroupChat(channel=slave, uid="unique_group", name="Group")
+    for i in range(5):
+        group.add_member(name=f"Member {i}", uid=f"member_{i}")
+    cached = chat_manager.compound_enrol(group)
+    group = GroupChat(channel=slave, uid="unique_group", name="Group")
+    for i in range(1, 6):
+        group.add_member(name=f"Member {i}", uid=f"member_{i}")
+    group.get_member("member_1").name = "Renamed member"
+
+    with patch.object(cached, "update_to_db") as update_to_db:
+        assert chat_manager.update_chat_members(cached, group.members) == 3
+        assert [i.uid for i in cached.members if i is not cached.self] == [f"member_{i}" for i in range(1, 6)]
+        assert cached.get_member("member_1").name == "Renamed member"
+        assert cached.get_member("member_5").chat is cached
+        chat_manager.update_chat_obj(group, full_update=True)
+        chat_manager.flush_chats()
+        update_to_db.assert_not_called()
+
+        group.name = "Renamed group"
+        chat_manager.update_chat_obj(group, full_update=True)
+        chat_manager.flush_chats()
+        update_to_db.assert_called_once()
+    assert cached.name == "Renamed group"
+
+
+def test_chat_manager_delete_chat_members(chat_manager, slave):
+    """Members removed are written to the database without a full update."""
+    group = GroupChat(channel=slave, uid="__removed_members__", name="Group")
+    for i in range(3):
+        group.add_member(name=f"Member {i}", uid=f"member_{i}")
+    cached = chat_manager.compound_enrol(group)
+    key = chat_manager.get_cache_key(cached)
+    try:
+        chat_manager.flush_chats()
+        assert chat_manager.delete_chat_members(group.module_id, group.uid, ["member_0", "__unknown__"]) == 1
+        assert chat_manager.delete_chat_members(group.module_id, group.uid, ["member_0"]) == 0
+        chat_manager.flush_chats()
+        loaded = chat_manager._load_chat(key)
+        assert [i.uid for i in loaded.members if i is not loaded.self] == ["member_1", "member_2"]
+    finally:
+        chat_manager.db.delete_slave_chat_info(group.module_id, group.uid)
+
+def test_chat_manager_flush_chats(channel, slave):
+    """Changes of chats are written to the database once per flush."""
+    chat = PrivateChat(channel=slave, uid="flushed_chat", name="Chat name")
+    with patch.dict('ehforwarderbot.coordinator.slaves', {}, clear=True), \
+            patch.dict(channel.flag.config, {"chat_flush_interval": 60}):
+        chat_manager = ChatObjectCacheManager(channel)
+    cached = chat_manager.compound_enrol(chat)
+    with patch.object(cached, "update_to_db") as update_to_db:
+        for alias in ("Alias 1", "Alias 2"):
+            chat.alias = alias
+            chat_manager.update_chat_obj(chat)
+        update_to_db.assert_not_called()
+        chat_manager.flush_chats()
+        update_to_db.assert_called_once()
+
+        chat.alias = "Alias 3"
+        chat_manager.update_chat_obj(chat)
+        chat_manager.delete_chat_object(chat.module_id, chat.uid)
+        chat_manager.stop_worker()
+        update_to_db.assert_called_once()
+
+
+def test_chat_manager_memory_limit(chat_manager, slave):
+    """Least recently used chats are evicted beyond the memory limit, except
+    for linked chats and chats with recent messages, and are loaded from the
+    database when used again.
+    """
+    linked = PrivateChat(channel=slave, uid="__linked__", name="Linked chat")
+    active = PrivateChat(channel=slave, uid="__active__", name="Active chat")
+    chats = [PrivateChat(channel=slave, uid=f"__lru_{i}__", name=f"Chat {i}") for i in range(20)]
+    chat_size = chat_manager.ESTIMATED_CHAT_SIZE + 2 * chat_manager.ESTIMATED_MEMBER_SIZE
+    chat_manager.memory_limit = 10 * chat_size
+    chat_manager.compound_enrol(linked).link("blueset.telegram", "-100001", False)
+    chat_manager.db.last_message_times[chat_id_to_str(chat=active)] = datetime.datetime.now()
+    chat_manager.compound_enrol(active)
+    try:
+        # Chats to evict are checked from a snapshot of chat links.
+        with patch.object(chat_manager.db, "get_chat_assoc", side_effect=AssertionError):
+            for chat in chats:
+                chat_manager.compound_enrol(chat)
+                chat_manager.get_chat(linked.module_id, linked.uid)
+        assert chat_manager.cache_bytes <= chat_manager.memory_limit
+        assert (linked.module_id, linked.uid) in chat_manager.cache
+        assert (active.module_id, active.uid) in chat_manager.cache
+        assert (chats[0].module_id, chats[0].uid) in chat_manager.evicted
+        stats = chat_manager.stats()
+        assert stats["chats"] + stats["evicted"] == 22
+        assert stats["members"] == 2 * stats["chats"]
+        # Chats evicted are listed without being loaded from the database.
+        with patch.object(chat_manager, "_load_chat", side_effect=AssertionError):
+            assert sorted(i.name for i in chat_manager.all_chats) == sorted(i.name for i in [linked, active] + chats)
+
+        chat_manager.flush_chats()
+        assert not chat_manager.dirty
+        assert chat_manager.get_chat(chats[0].module_id, chats[0].uid).name == "Chat 0"
+        assert (chats[0].module_id, chats[0].uid) in chat_manager.stored
+        assert len(list(chat_manager.all_chats)) == 22
+    finally:
+        chat_manager.get_chat(linked.module_id, linked.uid).unlink()
+        chat_manager.db.last_message_times.pop(chat_id_to_str(chat=active))
+        for chat in [active] + chats:
+            chat_manager.db.delete_slave_chat_info(chat.module_id, chat.uid)
+
+
+def test_chat_manager_memory_limit_changed_chats(chat_manager, slave):
+    """Chats being changed are not evicted, and changes of chats after
+    eviction are written to the database.
+    """
+    held = PrivateChat(channel=slave, uid="__held__", name="Held chat")
+    chats = [PrivateChat(channel=slave, uid=f"__evicted_{i}__", name=f"Chat {i}") for i in range(20)]
+    chat_size = chat_manager.ESTIMATED_CHAT_SIZE + 2 * chat_manager.ESTIMATED_MEMBER_SIZE
+    chat_manager.memory_limit = 10 * chat_size
+    held_key = chat_manager.get_cache_key(held)
+    held_lock, other_lock = threading.RLock(), threading.RLock()
+    locked, release = threading.Event(), threading.Event()
+
+    def change_held_chat():
+        with chat_manager.chat_lock(held_key):
+            locked.set()
+            release.wait()
+
+    try:
+        with patch.object(chat_manager, "chat_lock", lambda key: held_lock if key == held_key else other_lock):
+            first = chat_manager.compound_enrol(chats[0])
+            chat_manager.compound_enrol(held)
+            thread = threading.Thread(target=change_held_chat)
+            thread.start()
+            locked.wait()
+            try:
+                for chat in chats[1:]:
+                    chat_manager.compound_enrol(chat)
+            finally:
+                release.set()
+                thread.join()
+            assert held_key in chat_manager.cache
+            assert chat_manager.get_cache_key(first) in chat_manager.evicted
+            chat_manager.flush_chats()
+
+            chat_manager.get_or_enrol_member(first, SystemChatMember(chats[0], name="Late member", uid="__late__"))
+            chat_manager.flush_chats()
+            reloaded = chat_manager.get_chat(first.module_id, first.uid)
+            assert reloaded is not first
+            assert reloaded.get_member("__late__").name == "Late member"
+    finally:
+        for chat in [held] + chats:
+            chat_manager.db.delete_slave_chat_info(chat.module_id, chat.uid)
+
+def test_chat_manager_memory_limit_lookup_lock(chat_manager, slave):
+    """Lookups reorder cached chats with the lock held, as statistics and
+    eviction iterate the cache under the lock.
+    """
+    chat = slave.chat_with_alias
+    chat_manager.compound_enrol(chat)
+    chat_manager.memory_limit = 2 ** 30
+    found = threading.Event()
+
+    def get_chat():
+        chat_manager.get_chat(chat.module_id, chat.uid)
+        found.set()
+
+    thread = threading.Thread(target=get_chat)
+    with chat_manager.lock:
+        thread.start()
+        assert not found.wait(0.1)
+    thread.join(1)
+    assert found.is_set()
+
+def test_chat_manager_concurrent_updates(chat_manager, slave):
+    """Full updates of a chat do not block lookups and updates of other
+    chats, and leave the members of the chat consistent.
+    """
+    group = GroupChat(channel=slave, uid="__concurrent__", name="Concurrent group")
+    for i in range(200):
+        group.add_member(name=f"Member {i}", uid=f"member_{i}")
+    others = [PrivateChat(channel=slave, uid=f"__other_{i}__", name=f"Chat {i}") for i in range(20)]
+    chat_manager.compound_enrol(group)
+    chat_lock = chat_manager.chat_lock(chat_manager.get_cache_key(group))
+    others = [i for i in others if chat_manager.chat_lock(chat_manager.get_cache_key(i)) is not chat_lock]
+    errors = []
+
+    def update_group(offset):
+        try:
+            for i in range(20):
+                update = GroupChat(channel=slave, uid=group.uid, name=group.name)
+                for j in range(offset + i, offset + i + 150):
+                    update.add_member(name=f"Member {j}", uid=f"member_{j}")
+                chat_manager.update_chat_obj(update, full_update=True)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=update_group, args=(i * 10,)) for i in range(4)]
+    try:
+        with chat_lock:
+            for thread in threads:
+                thread.start()
+            # Other chats are looked up and updated while the group is locked.
+            for chat in others:
+                chat_manager.update_chat_obj(chat)
+                assert chat_manager.get_chat(chat.module_id, chat.uid).name == chat.name
+        for thread in threads:
+            thread.join()
+        assert not errors
+        cached = chat_manager.get_chat(group.module_id, group.uid)
+        uids = [i.uid for i in cached.members]
+        assert len(uids) == len(set(uids)) == 151  # including the User Themself
+        assert all(cached.get_member(i) is not None for i in uids)
+    finally:
+        chat_manager.flush_chats()
+        for chat in [group] + others:
+            chat_manager.db.delete_slave_chat_info(chat.module_id, chat.uid)
+
+
 def test_chat_manager_delete_chat_object(chat_manager, slave):
     chat = slave.chat_with_alias
     assert chat_manager.get_chat(chat.module_id, chat.uid) is None
@@ -65,3 +303,72 @@ def test_chat_manager_all_chats(channel, slave):
     """
     chat_manager = channel.chat_manager
     assert len(tuple(chat_manager.all_chats)) == len(slave.get_chats())
+
+
+def test_chat_manager_load_chats_in_background(channel):
+    """Chats from slave channels are loaded concurrently, and slow channels
+    continue loading after the timeout.
+    """
+    fast = PrivateChat(module_id="__fast__", module_name="Fast", channel_emoji="F", uid="fast", name="Fast")
+    slow = PrivateChat(module_id="__slow__", module_name="Slow", channel_emoji="S", uid="slow", name="Slow")
+    release = threading.Event()
+
+    def get_slow_chats():
+        release.wait()
+        return [slow]
+
+    def get_broken_chats():
+        raise Exception("Chats not available.")
+
+    slaves = {"__fast__": Mock(get_chats=lambda: [fast]), "__slow__": Mock(get_chats=get_slow_chats),
+              "__broken__": Mock(get_chats=get_broken_chats)}
+    with patch.dict('ehforwarderbot.coordinator.slaves', slaves, clear=True), \
+            patch.dict(channel.flag.config, {"chat_loading_timeout": 0.1}):
+        chat_manager = ChatObjectCacheManager(channel)
+        assert chat_manager.get_chat(fast.module_id, fast.uid) == fast
+        assert chat_manager.loading_channels == ["__slow__"]
+        assert (slow.module_id, slow.uid) not in chat_manager.cache
+
+        release.set()
+        assert chat_manager.wait_for_chats(5)
+        assert chat_manager.get_chat(slow.module_id, slow.uid) == slow
+        assert len(tuple(chat_manager.all_chats)) == 2
+
+
+def test_chat_manager_snapshot(channel, slave):
+    """Chats are loaded from the snapshot on start, and reconciled with
+    slave channels in background.
+    """
+    kept = PrivateChat(module_id="__snapshot__", module_name="Snapshot", channel_emoji="S", uid="kept", name="Kept")
+    renamed = PrivateChat(module_id="__snapshot__", module_name="Snapshot", channel_emoji="S", uid="renamed",
+                          name="Old name")
+    removed = PrivateChat(module_id="__snapshot__", module_name="Snapshot", channel_emoji="S", uid="removed",
+                          name="Removed")
+    release = threading.Event()
+
+    def get_chats():
+        release.wait()
+        renamed.name = "New name"
+        return [kept, renamed]
+
+    with patch.dict('ehforwarderbot.coordinator.slaves', {"__snapshot__": Mock(get_chats=lambda: [])}, clear=True):
+        chat_manager = ChatObjectCacheManager(channel)
+        for chat in (kept, renamed, removed):
+            chat_manager.compound_enrol(chat)
+        chat_manager.stop_worker()
+    try:
+        with patch.dict('ehforwarderbot.coordinator.slaves', {"__snapshot__": Mock(get_chats=get_chats)},
+                        clear=True):
+            chat_manager = ChatObjectCacheManager(channel)
+            assert chat_manager.loading_channels == ["__snapshot__"]
+            assert chat_manager.get_chat(renamed.module_id, renamed.uid).name == "Old name"
+            assert len(tuple(chat_manager.all_chats)) == 3
+
+            release.set()
+            assert chat_manager.wait_for_chats(5)
+            assert chat_manager.get_chat(renamed.module_id, renamed.uid).name == "New name"
+            assert (removed.module_id, removed.uid) not in chat_manager.cache
+            assert len(tuple(chat_manager.all_chats)) == 2
+            chat_manager.stop_worker()
+    finally:
+        chat_manager.snapshot_path.unlink()
@@ -0,0 +1,280 @@
+import time
+from datetime import datetime, timedelta
+
+import telegram
+from peewee import OperationalError
+from pytest import fixture, raises
+
+from ehforwarderbot import MsgType
+from ehforwarderbot.types import MessageID
+from efb_telegram_master import serialization
+from efb_telegram_master.chat import convert_chat
+from efb_telegram_master.db import database, SchemaVersion, MIGRATIONS, SlaveChatInfo, MsgLog, reader, \
+    read_database
+from efb_telegram_master.msg_log_archive import MessageLogArchive
+from efb_telegram_master.message import ETMMsg
+from efb_telegram_master.utils import chat_id_to_str
+
+
+@fixture(scope="module")
+def db(channel):
+    return channel.db
+
+
+def test_db_lookup_indexes(db):
+    assert "msglog_slave_origin_uid_slave_message_id_time" in {i.name for i in database.get_indexes("msglog")}
+    assert "msglog_slave_origin_uid_time" in {i.name for i in database.get_indexes("msglog")}
+    assert "msglog_master_chat_id_slave_origin_uid_time" in {i.name for i in database.get_indexes("msglog")}
+    assert "msglog_target_msg_id" in {i.name for i in database.get_indexes("msglog")}
+    assert {"chatassoc_master_uid", "chatassoc_slave_uid"} <= {i.name for i in database.get_indexes("chatassoc")}
+    assert database.get_indexes("slavechatinfo")
+
+
+def test_db_schema_version(db):
+    assert {i.version for i in SchemaVersion.select()} == {i.version for i in MIGRATIONS}
+    assert not db.pending_backfills
+
+
+BENCHMARK_WRITES = 1000
+
+
+def test_db_message_log_write_benchmark(db, slave, capsys):
+    chat = convert_chat(db, slave.chat_with_alias)
+    tg_chat = telegram.Chat(id=-1000000, type=telegram.Chat.GROUP)
+    start = time.perf_counter()
+    for i in range(BENCHMARK_WRITES):
+        msg = ETMMsg(chat=chat, author=chat.other, deliver_to=slave, text=f"Message {i}",
+                     type=MsgType.Text, uid=MessageID(f"__benchmark_{i}__"))
+        db.add_or_update_message_log(msg, telegram.Message(i + 1, datetime.now(), tg_chat))
+    rate = BENCHMARK_WRITES / (time.perf_counter() - start)
+    with capsys.disabled():
+        print(f"\nadd_or_update_message_log: {rate:.0f} writes/second")
+
+    log = db.get_msg_log(slave_msg_id=MessageID("__benchmark_0__"), slave_origin_uid=chat_id_to_str(chat=chat))
+    assert log is not None
+    assert log.text == "Message 0"
+    assert (log.master_chat_id, log.master_message_id) == (tg_chat.id, 1)
+    assert chat_id_to_str(chat=chat) in db.get_recent_slave_chats(tg_chat.id)
+    assert chat.last_message_time >= log.time
+    assert db.get_chat_activity(chat_id_to_str(chat=chat)).message_count >= BENCHMARK_WRITES
+
+
+def test_db_slave_chat_info_write_benchmark(db, slave, capsys):
+    chat = convert_chat(db, slave.group)
+    start = time.perf_counter()
+    for i in range(BENCHMARK_WRITES):
+        chat.name = f"Group {i}"
+        db.set_slave_chat_info(chat)
+    rate = BENCHMARK_WRITES / (time.perf_counter() - start)
+    with capsys.disabled():
+        print(f"\nset_slave_chat_info: {rate:.0f} writes/second")
+
+    info = db.get_slave_chat_info(chat.module_id, chat.uid)
+    assert info is not None
+    assert info.slave_chat_name == chat.name
+    assert SlaveChatInfo.select().where((SlaveChatInfo.slave_channel_id == chat.module_id) &
+                                        (SlaveChatInfo.slave_chat_uid == chat.uid)).count() == 1
+
+
+def test_db_write_without_upsert(db, slave, monkeypatch):
+    """Message logs and slave chat info are updated in place without
+    upsert, as in SQLite before 3.24.0.
+    """
+    monkeypatch.setattr("efb_telegram_master.db.SQLITE_UPSERT", False)
+    chat = convert_chat(db, slave.chat_with_alias)
+    tg_chat = telegram.Chat(id=-1000006, type=telegram.Chat.GROUP)
+    msg = ETMMsg(chat=chat, author=chat.other, deliver_to=slave, text="Original",
+                 type=MsgType.Text, uid=MessageID("__no_upsert__"))
+    msg.is_system = True
+    db.add_or_update_message_log(msg, telegram.Message(1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+    log = db.get_msg_log(master_msg_id=f"{tg_chat.id}.1")
+
+    msg.text, msg.is_system = "Edited", False
+    db.add_or_update_message_log(msg, telegram.Message(1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+    edited = db.get_msg_log(master_msg_id=f"{tg_chat.id}.1")
+    assert (edited.text, edited.time, edited.pickle) == ("Edited", log.time, log.pickle)
+
+    chat.name = "Renamed without upsert"
+    db.set_slave_chat_info(chat)
+    db.set_slave_chat_info(chat)
+    assert db.get_slave_chat_info(chat.module_id, chat.uid).slave_chat_name == chat.name
+    assert SlaveChatInfo.select().where((SlaveChatInfo.slave_channel_id == chat.module_id) &
+                                        (SlaveChatInfo.slave_chat_uid == chat.uid)).count() == 1
+
+
+def test_db_chat_assoc_index(db):
+    master_a, master_b = "blueset.telegram -100001", "blueset.telegram -100002"
+    slave_a, slave_b = "test.slave chat_a", "test.slave chat_b"
+    db.add_chat_assoc(master_uid=master_a, slave_uid=slave_a)
+    db.add_chat_assoc(master_uid=master_a, slave_uid=slave_b, multiple_slave=True)
+    assert db.get_chat_assoc(master_uid=master_a) == [slave_a, slave_b]
+    assert db.get_chat_assoc(slave_uid=slave_b) == [master_a]
+
+    # Linking a slave chat to another Telegram chat replaces the previous link.
+    db.add_chat_assoc(master_uid=master_b, slave_uid=slave_b)
+    assert db.get_chat_assoc(master_uid=master_a) == [slave_a]
+    assert db.get_chat_assoc(slave_uid=slave_b) == [master_b]
+
+    db.remove_chat_assoc(master_uid=master_a)
+    db.remove_chat_assoc(master_uid=master_b)
+    assert db.get_chat_assoc(slave_uid=slave_a) == []
+    assert db.get_chat_assoc(slave_uid=slave_b) == []
+    assert not db.master_links.get(master_a) and not db.slave_links.get(slave_a)
+
+
+def test_db_message_log_retention(db, slave):
+    chat = convert_chat(db, slave.group)
+    tg_chat = telegram.Chat(id=-1000001, type=telegram.Chat.GROUP)
+    messages = []
+    for i in range(20):
+        msg = ETMMsg(chat=chat, author=chat.self, deliver_to=slave, text=f"Message {i}",
+                     type=MsgType.Text, uid=MessageID(f"__retention_{i}__"))
+        if i == 10:
+            msg.target = messages[0]
+        db.add_or_update_message_log(msg, telegram.Message(i + 1, datetime.now(), tg_chat))
+        messages.append(msg)
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+
+    max_rows = db.message_log_max_rows_per_chat
+    db.message_log_max_rows_per_chat = 5
+    try:
+        assert db.run_maintenance() >= 15
+    finally:
+        db.message_log_max_rows_per_chat = max_rows
+
+    chat_uid = chat_id_to_str(chat=chat)
+    # Reply target is kept even if older than messages deleted.
+    assert db.get_msg_log(slave_msg_id=messages[0].uid, slave_origin_uid=chat_uid) is not None
+    assert db.get_msg_log(slave_msg_id=messages[1].uid, slave_origin_uid=chat_uid) is None
+    assert db.get_msg_log(slave_msg_id=messages[19].uid, slave_origin_uid=chat_uid) is not None
+
+
+def test_db_message_log_archive(db, slave, tmp_path):
+    chat = convert_chat(db, slave.chat_without_alias)
+    tg_chat = telegram.Chat(id=-1000002, type=telegram.Chat.GROUP)
+    msg = ETMMsg(chat=chat, author=chat.other, deliver_to=slave, text="Archived message",
+                 type=MsgType.Text, uid=MessageID("__archive_0__"))
+    db.add_or_update_message_log(msg, telegram.Message(1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+
+    archive, archive_after = db.message_log_archive, db.message_log_archive_after
+    db.message_log_archive, db.message_log_archive_after = MessageLogArchive(tmp_path), timedelta(0)
+    try:
+        assert db.run_maintenance() >= 1
+        assert not MsgLog.select().where(MsgLog.slave_message_id == msg.uid).exists()
+        if db.message_log_cache is not None:
+            db.message_log_cache.discard(slave_key=(chat_id_to_str(chat=chat), msg.uid))
+        log = db.get_msg_log(slave_msg_id=msg.uid, slave_origin_uid=chat_id_to_str(chat=chat))
+        assert log is not None
+        assert log.text == "Archived message"
+    finally:
+        db.message_log_archive, db.message_log_archive_after = archive, archive_after
+
+
+def test_db_read_only_pool(db):
+    with reader() as read_db:
+        assert read_db is read_database
+        with raises(OperationalError):
+            read_db.execute_sql("DELETE FROM msglog")
+        assert read_db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert not read_database._in_use
+
+
+def test_db_message_reactions(db, slave):
+    chat = convert_chat(db, slave.group)
+    tg_chat = telegram.Chat(id=-1000003, type=telegram.Chat.GROUP)
+    member_a, member_b = chat.members[0], chat.members[1]
+    msg = ETMMsg(chat=chat, author=member_a, deliver_to=slave, text="Reacted message",
+                 type=MsgType.Text, uid=MessageID("__reactions_0__"), reactions={"👍": [member_a]})
+    db.add_or_update_message_log(msg, telegram.Message(1, datetime.now(), tg_chat))
+    log = db.get_msg_log(slave_msg_id=msg.uid, slave_origin_uid=chat_id_to_str(chat=chat))
+    assert db.get_message_reactions(log.master_msg_id) == {"👍": [chat_id_to_str(chat=member_a)]}
+    assert log.pickle is None
+
+    db.set_message_reactions(log.master_msg_id, {"👍": [member_b], "❤️": [member_a]})
+    assert db.get_message_reactions(log.master_msg_id) == {"👍": [chat_id_to_str(chat=member_b)],
+                                                           "❤️": [chat_id_to_str(chat=member_a)]}
+    db.set_message_reactions(log.master_msg_id, {})
+    assert db.get_message_reactions(log.master_msg_id) == {}
+
+
+def test_db_message_reactions_not_migrated(channel, db, slave, monkeypatch):
+    """Reactions in pickled data of message logs are used until reactions
+    of the message are updated, before migration 10 is backfilled.
+    """
+    monkeypatch.setattr(db, "pending_backfills", db.pending_backfills | {10})
+    chat = convert_chat(db, slave.group)
+    tg_chat = telegram.Chat(id=-1000008, type=telegram.Chat.GROUP)
+    member = chat.members[0]
+    msg = ETMMsg(chat=chat, author=member, deliver_to=slave, text="Legacy reactions",
+                 type=MsgType.Text, uid=MessageID("__legacy_reactions__"))
+    db.add_or_update_message_log(msg, telegram.Message(1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+    master_msg_id = f"{tg_chat.id}.1"
+    MsgLog.update(pickle=serialization.encode_misc_msg({"reactions": {"👍": (chat_id_to_str(chat=member),)}})) \
+        .where(MsgLog.master_msg_id == master_msg_id).execute()
+    if db.message_log_cache is not None:
+        db.message_log_cache.discard(master_msg_id=master_msg_id)
+    assert list(db.get_msg_log(master_msg_id=master_msg_id).build_etm_msg(channel.chat_manager).reactions) == ["👍"]
+
+    db.set_message_reactions(master_msg_id, {})
+    assert not db.get_msg_log(master_msg_id=master_msg_id).build_etm_msg(channel.chat_manager).reactions
+    assert db.get_msg_log(master_msg_id=master_msg_id).pickle is None
+
+
+def test_db_message_search(db, slave):
+    chat = convert_chat(db, slave.chat_with_alias)
+    tg_chat = telegram.Chat(id=-1000004, type=telegram.Chat.GROUP)
+    for idx, text in enumerate(["Search for the meeting notes", "Meeting at noon", "会议纪要已发送", "ok"]):
+        msg = ETMMsg(chat=chat, author=chat.other, deliver_to=slave, text=text,
+                     type=MsgType.Text, uid=MessageID(f"__search_{idx}__"))
+        db.add_or_update_message_log(msg, telegram.Message(idx + 1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+
+    assert [i.text for i in db.search_message_logs("MEETING notes", master_chat_id=tg_chat.id)] == \
+        ["Search for the meeting notes"]
+    assert {i.text for i in db.search_message_logs("meeting", master_chat_id=tg_chat.id)} == \
+        {"Search for the meeting notes", "Meeting at noon"}
+    assert [i.text for i in db.search_message_logs("纪要", master_chat_id=tg_chat.id)] == ["会议纪要已发送"]
+    assert [i.text for i in db.search_message_logs("meeting ok", master_chat_id=tg_chat.id)] == []
+    # Query syntax of full-text search is not interpreted.
+    assert db.search_message_logs('"meeting OR (', master_chat_id=tg_chat.id) == []
+    assert len(db.search_message_logs("meeting", master_chat_id=tg_chat.id, limit_per_chat=1)) == 1
+    assert not db.search_message_logs("meeting", master_chat_id=-1000005)
+
+    db.delete_msg_log(master_msg_id=f"{tg_chat.id}.2")
+    assert [i.text for i in db.search_message_logs("meeting", master_chat_id=tg_chat.id)] == \
+        ["Search for the meeting notes"]
+
+
+def test_db_message_search_without_window_functions(db, slave, monkeypatch):
+    """Search results are ranked in Python without window functions, as in
+    SQLite before 3.25.0.
+    """
+    monkeypatch.setattr("efb_telegram_master.db.SQLITE_WINDOW_FUNCTIONS", False)
+    chats = [convert_chat(db, slave.chat_with_alias), convert_chat(db, slave.group)]
+    tg_chat = telegram.Chat(id=-1000007, type=telegram.Chat.GROUP)
+    for idx, text in enumerate(["Ranked notes one", "Ranked notes two", "Ranked notes three"]):
+        chat = chats[idx % 2]
+        msg = ETMMsg(chat=chat, author=chat.members[0], deliver_to=slave, text=text,
+                     type=MsgType.Text, uid=MessageID(f"__ranked_{idx}__"))
+        db.add_or_update_message_log(msg, telegram.Message(idx + 1, datetime.now(), tg_chat))
+    if db.message_log_buffer is not None:
+        db.message_log_buffer.flush()
+
+    assert {i.text for i in db.search_message_logs("ranked notes", master_chat_id=tg_chat.id)} == \
+        {"Ranked notes one", "Ranked notes two", "Ranked notes three"}
+    results = db.search_message_logs("ranked notes", master_chat_id=tg_chat.id, limit_per_chat=1)
+    assert len(results) == 2 and len({i.slave_origin_uid for i in results}) == 2
+    assert len(db.search_message_logs("ranked notes", master_chat_id=tg_chat.id, limit=1)) == 1
+    # Message logs of a chat are returned together.
+    uids = [i.slave_origin_uid for i in db.search_message_logs("ranked", master_chat_id=tg_chat.id)]
+    assert uids == sorted(uids, key=uids.index)
@@ -0,0 +1,106 @@
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import telegram
+from pytest import fixture, importorskip, skip
+
+from ehforwarderbot import MsgType
+from ehforwarderbot.types import MessageID
+from efb_telegram_master.chat import convert_chat
+from efb_telegram_master.db import database, MODELS
+from efb_telegram_master.db_memory import MemoryDatabaseManager
+from efb_telegram_master.message import ETMMsg
+from efb_telegram_master.utils import chat_id_to_str, ExperimentalFlagsManager
+
+
+@fixture(params=["memory", "postgresql"])
+def backend(request):
+    """Storage backends other than SQLite. PostgreSQL is tested against the
+    server in libpq connection string ``ETM_TEST_POSTGRESQL``, if given.
+    """
+    if request.param == "memory":
+        yield MemoryDatabaseManager()
+        return
+    if not os.environ.get("ETM_TEST_POSTGRESQL"):
+        skip("ETM_TEST_POSTGRESQL is not set.")
+    psycopg2 = importorskip("psycopg2")
+    from efb_telegram_master import db_postgresql
+    params = psycopg2.extensions.parse_dsn(os.environ["ETM_TEST_POSTGRESQL"])
+    params["database"] = params.pop("dbname", "postgres")
+    channel = SimpleNamespace(config={"flags": {"database_postgresql": params}})
+    manager = db_postgresql.PostgresqlDatabaseManager(SimpleNamespace(flag=ExperimentalFlagsManager(channel)))
+    try:
+        yield manager
+    finally:
+        with manager.connection():
+            manager.database.drop_tables(db_postgresql.MODELS)
+        manager.stop_worker()
+        database.bind(MODELS)
+
+
+def test_db_backend_message_log(backend, slave):
+    chat = convert_chat(backend, slave.group)
+    chat_uid = chat_id_to_str(chat=chat)
+    tg_chat = telegram.Chat(id=-1000001, type=telegram.Chat.GROUP)
+    first = ETMMsg(chat=chat, author=chat.members[0], deliver_to=slave, text="First message",
+                   type=MsgType.Text, uid=MessageID("msg_1"), reactions={"👍": [chat.members[0]]})
+    backend.add_or_update_message_log(first, telegram.Message(1, datetime.now(), tg_chat))
+    reply = ETMMsg(chat=chat, author=chat.members[1], deliver_to=slave, text="Reply message",
+                   type=MsgType.Text, uid=MessageID("msg_2"), target=first)
+    backend.add_or_update_message_log(reply, telegram.Message(2, datetime.now(), tg_chat))
+
+    log = backend.get_msg_log(slave_msg_id=MessageID("msg_2"), slave_origin_uid=chat_uid)
+    assert log.master_msg_id == f"{tg_chat.id}.2"
+    assert log.target_msg_id == f"{tg_chat.id}.1"
+    assert backend.get_msg_log(master_msg_id=f"{tg_chat.id}.1").text == "First message"
+    assert backend.get_recent_slave_chats(tg_chat.id) == [chat_uid]
+    assert backend.get_last_message(chat_uid).master_msg_id == log.master_msg_id
+    assert backend.get_last_message_time(chat_uid) >= log.time
+
+    # Edits keep the time and the reply target of the message.
+    reply.text, reply.target = "Edited message", None
+    backend.add_or_update_message_log(reply, telegram.Message(2, datetime.now(), tg_chat))
+    edited = backend.get_msg_log(master_msg_id=f"{tg_chat.id}.2")
+    assert (edited.text, edited.time, edited.target_msg_id) == ("Edited message", log.time, log.target_msg_id)
+    assert [i.text for i in backend.search_message_logs("MESSAGE", master_chat_id=tg_chat.id)] == \
+        ["Edited message", "First message"]
+    assert [i.text for i in backend.search_message_logs("first message")] == ["First message"]
+    assert not backend.search_message_logs("message", master_chat_id=-1000002)
+
+    assert backend.get_message_reactions(f"{tg_chat.id}.1") == {"👍": [chat_id_to_str(chat=chat.members[0])]}
+    backend.set_message_reactions(f"{tg_chat.id}.1", {"👍": [chat.members[1], chat.members[0]]})
+    assert backend.get_message_reactions(f"{tg_chat.id}.1") == \
+        {"👍": [chat_id_to_str(chat=chat.members[0]), chat_id_to_str(chat=chat.members[1])]}
+    backend.delete_msg_log(slave_msg_id=MessageID("msg_1"), slave_origin_uid=chat_uid)
+    assert backend.get_msg_log(master_msg_id=f"{tg_chat.id}.1") is None
+    assert backend.get_message_reactions(f"{tg_chat.id}.1") == {}
+
+
+def test_db_backend_chat_assoc(backend):
+    master_a, master_b = "blueset.telegram -100001", "blueset.telegram -100002"
+    slave_a, slave_b = "test.slave chat_a", "test.slave chat_b"
+    backend.add_chat_assoc(master_uid=master_a, slave_uid=slave_a)
+    backend.add_chat_assoc(master_uid=master_a, slave_uid=slave_b, multiple_slave=True)
+    assert backend.get_chat_assoc(master_uid=master_a) == [slave_a, slave_b]
+    backend.add_chat_assoc(master_uid=master_b, slave_uid=slave_b, multiple_slave=True)
+    assert backend.get_chat_assoc(master_uid=master_a) == [slave_a]
+    assert backend.get_chat_assoc(slave_uid=slave_b) == [master_b]
+    assert backend.remove_chat_assoc(master_uid=master_a) == 1
+    assert backend.get_chat_assoc(slave_uid=slave_a) == []
+
+
+def test_db_backend_slave_chat_info(backend, slave):
+    chat, other = convert_chat(backend, slave.group), convert_chat(backend, slave.chat_with_alias)
+    backend.set_slave_chat_info(chat)
+    backend.set_slave_chat_info(other)
+    chat.name = "Renamed group"
+    backend.set_slave_chat_info(chat)
+
+    info = backend.get_slave_chat_info(chat.module_id, chat.uid)
+    assert info.slave_chat_name == "Renamed group"
+    assert info.pickle == chat.pickle
+    assert backend.get_slave_chat_info(other.module_id, other.uid).slave_chat_alias == other.alias
+    assert backend.get_slave_chat_info(chat.module_id, chat.uid, other.uid) is None
+    assert backend.delete_slave_chat_info(chat.module_id, chat.uid) == 1
+    assert backend.get_slave_chat_info(chat.module_id, chat.uid) is None
@@ -0,0 +1,107 @@
+import io
+import json
+from datetime import datetime
+
+from peewee import SqliteDatabase, SQL
+from pytest import raises
+
+from efb_telegram_master import serialization
+from efb_telegram_master.db import MODELS, CHAT_ACTIVITY_TRIGGERS, MSG_REACTION_TRIGGERS, MsgLogIndex, \
+    create_search_index, ChatAssoc, MsgLog, MsgReaction, SlaveChatInfo, ChatActivity, MIGRATIONS
+from efb_telegram_master.db_transfer import export_rows, import_rows, vacuum, main
+
+
+def create_database(path) -> SqliteDatabase:
+    db = SqliteDatabase(str(path), pragmas={'journal_mode': 'wal'})
+    with db.bind_ctx(MODELS):
+        db.create_tables([i for i in MODELS if i is not MsgLogIndex])
+        for trigger in CHAT_ACTIVITY_TRIGGERS + MSG_REACTION_TRIGGERS:
+            db.execute_sql(trigger)
+        create_search_index()
+    return db
+
+
+def msg_log(idx: int, **kwargs):
+    return {"master_msg_id": f"-1000.{idx}", "master_chat_id": -1000, "master_message_id": idx,
+            "slave_message_id": f"msg_{idx}", "text": f"Message {idx}", "slave_origin_uid": "test.slave chat",
+            "slave_member_uid": "test.slave chat member", "msg_type": "Text", "sent_to": "test.slave",
+            "time": datetime(2020, 1, 1, 0, 0, idx), **kwargs}
+
+
+def test_db_transfer_round_trip(tmp_path):
+    source = create_database(tmp_path / "source.db")
+    with source.bind_ctx(MODELS):
+        ChatAssoc.create(master_uid="blueset.telegram -1000", slave_uid="test.slave chat")
+        SlaveChatInfo.create(slave_channel_id="test.slave", slave_channel_emoji="S", slave_chat_uid="chat",
+                             slave_chat_name="Chat", slave_chat_type="PrivateChat",
+                             pickle=serialization.dumps(["PrivateChat", "test.slave"]))
+        MsgLog.insert_many([
+            msg_log(0, pickle=serialization.encode_misc_msg({"is_system": True})),
+            msg_log(1, pickle=serialization.dumps_pickle({"custom": object.__name__})),
+            msg_log(2, text="会议纪要"),
+        ]).execute()
+        MsgReaction.insert_many([{"master_msg_id": "-1000.0", "reaction": r, "member_uid": m}
+                                 for r, m in (("👍", "test.slave b"), ("👍", "test.slave a"))]).execute()
+
+    out = io.StringIO()
+    assert export_rows(source, out) == 7
+    lines = out.getvalue().splitlines()
+    assert json.loads(lines[0])["format"] == "etm-db"
+    assert json.loads(lines[3])["row"]["pickle"] == [None, True], \
+        "Blobs encoded as JSON are exported as JSON"
+
+    target = create_database(tmp_path / "target.db")
+    for _ in range(2):
+        assert import_rows(target, io.StringIO(out.getvalue()), batch_size=2) == 7
+    for model in (ChatAssoc, SlaveChatInfo, MsgLog, MsgReaction, ChatActivity):
+        with source.bind_ctx(MODELS):
+            expected = list(model.select().order_by(model._meta.sorted_fields[0]).tuples())
+        with target.bind_ctx(MODELS):
+            assert list(model.select().order_by(model._meta.sorted_fields[0]).tuples()) == expected
+    with target.bind_ctx(MODELS):
+        reactions = MsgReaction.select(MsgReaction.member_uid).order_by(SQL("rowid")).tuples()
+        assert [i for i, in reactions] == ["test.slave b", "test.slave a"], "Order of reactions is kept"
+        assert MsgLogIndex.select().where(MsgLogIndex.match('"议纪要"')).count() == 1
+        target.execute_sql("INSERT INTO msglog_fts (msglog_fts) VALUES ('integrity-check')")
+
+
+def test_db_transfer_invalid_input(tmp_path):
+    with raises(ValueError):
+        import_rows(create_database(tmp_path / "target.db"), io.StringIO('{"format": "unknown"}\n'))
+
+
+def test_db_transfer_command_required(capsys):
+    with raises(SystemExit):
+        main([])
+    assert "export" in capsys.readouterr().err
+
+
+def test_db_search_index_backfill(tmp_path):
+    db = create_database(tmp_path / "source.db")
+    with db.bind_ctx(MODELS):
+        MsgLog.insert_many([msg_log(i) for i in range(5)]).execute()
+        # Message logs written before migration 11 are not indexed.
+        db.execute_sql("INSERT INTO msglog_fts (msglog_fts) VALUES ('delete-all')")
+        MsgLog.insert_many([msg_log(5)]).execute()
+        MsgLog.delete().where(MsgLog.master_msg_id == "-1000.0").execute()
+        MsgLog.update(text="Edited 1").where(MsgLog.master_msg_id == "-1000.1").execute()
+
+        backfill = MIGRATIONS[11].backfill
+        assert backfill is not None and MIGRATIONS[11].background
+        while backfill(2):
+            pass
+        assert MsgLogIndex.select().where(MsgLogIndex.match('"Message"')).count() == 4
+        assert MsgLogIndex.select().where(MsgLogIndex.match('"Edited"')).count() == 1
+        db.execute_sql("INSERT INTO msglog_fts (msglog_fts) VALUES ('integrity-check')")
+
+
+def test_db_vacuum(tmp_path):
+    db = create_database(tmp_path / "source.db")
+    with db.bind_ctx(MODELS):
+        MsgLog.insert_many([msg_log(i) for i in range(5)]).execute()
+        MsgLog.delete().where(MsgLog.master_msg_id.in_(["-1000.0", "-1000.2"])).execute()
+    vacuum(db)
+    assert db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] == 2
+    with db.bind_ctx(MODELS):
+        assert MsgLogIndex.select().where(MsgLogIndex.match('"Message 3"')).count() == 1
+        db.execute_sql("INSERT INTO msglog_fts (msglog_fts, rank) VALUES ('integrity-check', 1)")
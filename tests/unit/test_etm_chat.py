@@ -1,7 +1,9 @@
+import gc
 import re
-from pytest import fixture
+from pytest import fixture, raises
+from efb_telegram_master import serialization
 from efb_telegram_master.chat import convert_chat, ETMPrivateChat, ETMChatMember, ETMSelfChatMember, ETMSystemChat, \
-    ETMSystemChatMember, ETMGroupChat, unpickle
+    ETMSystemChatMember, ETMGroupChat, unpickle, encode_chat
 from ehforwarderbot.chat import PrivateChat, SystemChat, GroupChat
 
 
@@ -122,6 +124,18 @@ def test_etm_chat_pickle(db, slave):
     assert chat.db is recovered.db
 
 
+def test_etm_chat_encode_group(db, slave):
+    group_chat = convert_chat(db, slave.get_chat_by_criteria(chat_type='GroupChat'))
+    encoded = group_chat.pickle
+    assert not serialization.is_pickle(encoded)
+    recovered = unpickle(encoded, db)
+    assert isinstance(recovered, ETMGroupChat)
+    assert [(type(i), i.uid, i.name, i.module_id) for i in recovered.members] == \
+           [(type(i), i.uid, i.name, i.module_id) for i in group_chat.members]
+    assert all(i.chat is recovered and i.db is db for i in recovered.members)
+    assert recovered.self is not None and recovered.self.uid == group_chat.self.uid
+
+
 def test_etm_chat_copy(db, slave):
     chat = convert_chat(db, chat=slave.chat_with_alias)
     copied = chat.copy()
@@ -130,3 +144,42 @@ def test_etm_chat_copy(db, slave):
     for i in attributes:
         assert getattr(chat, i) == getattr(copied, i)
     assert chat.db is copied.db
+
+
+def test_etm_chat_member_index(db, slave):
+    group_chat = convert_chat(db, slave.get_chat_by_criteria(chat_type='GroupChat'))
+    for i in group_chat.members:
+        assert group_chat.get_member(i.uid) is i
+    with raises(KeyError):
+        group_chat.get_member("__absent__")
+
+    member = group_chat.add_member(name="New member", uid="__new__")
+    system_member = group_chat.add_system_member(name="New system member", uid="__new_system__")
+    assert group_chat.get_member("__new__") is member
+    assert group_chat.get_member("__new_system__") is system_member
+    group_chat.members = [i for i in group_chat.members if i is not member]
+    with raises(KeyError):
+        group_chat.get_member("__new__")
+    group_chat.members.remove(system_member)
+    with raises(KeyError):
+        group_chat.get_member("__new_system__")
+
+    recovered = unpickle(group_chat.pickle, db)
+    assert all(recovered.get_member(i.uid).uid == i.uid for i in group_chat.members)
+    recovered = unpickle(serialization.dumps_pickle(group_chat), db)
+    assert all(recovered.get_member(i.uid).uid == i.uid for i in group_chat.members)
+
+
+def test_etm_chat_member_slots(db, slave):
+    group_chat = convert_chat(db, slave.get_chat_by_criteria(chat_type='GroupChat'))
+    for chat in (group_chat, unpickle(group_chat.pickle, db), unpickle(serialization.dumps_pickle(group_chat), db),
+                 group_chat.copy()):
+        encode_chat(chat)
+        for member in chat.members:
+            # ``vars()`` and ``dir()`` would allocate ``__dict__`` themselves.
+            assert not any(i is not member.vendor_specific and isinstance(i, dict)
+                           for i in gc.get_referents(member)), "Attributes of members are stored in slots"
+            original = group_chat.get_member(member.uid)
+            assert (member.name, member.alias, member.module_id, member.vendor_specific) == \
+                   (original.name, original.alias, original.module_id, original.vendor_specific)
+            assert member.db is db
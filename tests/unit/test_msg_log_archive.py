@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from efb_telegram_master.msg_log_archive import MessageLogArchive
+
+
+def make_row(master_msg_id, time, text="text"):
+    return {"master_msg_id": master_msg_id, "slave_origin_uid": "slave.chat 1",
+            "slave_message_id": f"slave_{master_msg_id}", "text": text,
+            "pickle": b"\x01[]", "time": time}
+
+
+def test_msg_log_archive_lookup(tmp_path):
+    archive = MessageLogArchive(tmp_path)
+    archive.append([make_row("1.1", datetime(2020, 1, 1)), make_row("1.2", datetime(2020, 2, 1))])
+    assert archive.segments() == ["msglog-2020-02", "msglog-2020-01"]
+    # Rows appended are visible before the index is written.
+    assert archive.get(master_msg_id="1.1")["text"] == "text"
+    archive.flush_index()
+
+    archive = MessageLogArchive(tmp_path)
+    row = archive.get(slave_key=("slave.chat 1", "slave_1.2"))
+    assert row["master_msg_id"] == "1.2"
+    assert row["pickle"] == b"\x01[]"
+    assert row["time"] == datetime(2020, 2, 1)
+    assert archive.get(master_msg_id="1.3") is None
+
+
+def test_msg_log_archive_latest_row(tmp_path):
+    archive = MessageLogArchive(tmp_path)
+    archive.append([make_row("1.1", datetime(2020, 1, 1), "first")])
+    archive.append([make_row("1.1", datetime(2020, 1, 1), "second")])
+    archive.flush_index()
+    assert archive.get(master_msg_id="1.1")["text"] == "second"
+
+
+def test_msg_log_archive_recover_unindexed_blocks(tmp_path):
+    archive = MessageLogArchive(tmp_path)
+    archive.append([make_row("1.1", datetime(2020, 1, 1))])
+    archive.flush_index()
+    archive.append([make_row("1.2", datetime(2020, 1, 1))])
+    # Stopped before the index is written, with an incomplete block.
+    with (tmp_path / "msglog-2020-01.seg").open("ab") as f:
+        f.write(b"\x00\x00\x01\x00garbage")
+
+    archive = MessageLogArchive(tmp_path)
+    assert archive.get(master_msg_id="1.2") is not None
+    assert archive.get(master_msg_id="1.1") is not None
+    archive.append([make_row("1.3", datetime(2020, 1, 1))])
+    archive.flush_index()
+    assert MessageLogArchive(tmp_path).get(master_msg_id="1.3") is not None
+
+
+def test_msg_log_archive_prune(tmp_path):
+    archive = MessageLogArchive(tmp_path)
+    archive.append([make_row("1.1", datetime(2020, 1, 31)), make_row("1.2", datetime(2020, 2, 1))])
+    archive.flush_index()
+    assert archive.prune(datetime(2020, 2, 15)) == ["msglog-2020-01"]
+    assert archive.get(master_msg_id="1.1") is None
+    assert archive.get(master_msg_id="1.2") is not None
@@ -0,0 +1,79 @@
+import time
+
+from pytest import raises
+
+from efb_telegram_master.msg_log_buffer import MessageLogBuffer
+
+
+def make_row(master_msg_id, text, pickle=None, time=0):
+    return {"master_msg_id": master_msg_id, "slave_origin_uid": "slave.chat 1",
+            "slave_message_id": f"slave_{master_msg_id}", "text": text,
+            "pickle": pickle, "time": time}
+
+
+def test_msg_log_buffer_coalesce_and_flush():
+    batches = []
+    buffer = MessageLogBuffer(batches.append, batch_size=100, interval=60)
+    try:
+        buffer.put(make_row("1.1", "first", pickle=b"data", time=1))
+        buffer.put(make_row("1.1", "edited", time=2))
+        buffer.put(make_row("1.2", "second", time=3))
+
+        row = buffer.get(slave_key=("slave.chat 1", "slave_1.1"))
+        assert row["text"] == "edited"
+        assert row["pickle"] == b"data"
+        assert row["time"] == 1
+
+        buffer.discard(master_msg_id="1.2")
+        assert buffer.get(slave_key=("slave.chat 1", "slave_1.2")) is None
+    finally:
+        buffer.stop()
+
+    assert len(batches) == 1
+    assert [i["master_msg_id"] for i in batches[0]] == ["1.1"]
+    assert buffer.get(master_msg_id="1.1") is None
+
+
+def test_msg_log_buffer_retry_failed_flush():
+    batches = []
+
+    def flush(batch):
+        if not batches:
+            batches.append(None)
+            raise OSError("database is locked")
+        batches.append(batch)
+
+    buffer = MessageLogBuffer(flush, batch_size=100, interval=60)
+    try:
+        buffer.put(make_row("1.1", "first", pickle=b"data", time=1))
+        buffer.put(make_row("1.2", "second", time=2))
+        with raises(OSError):
+            buffer.flush()
+        assert buffer.get(slave_key=("slave.chat 1", "slave_1.1"))["text"] == "first"
+        assert buffer.get(master_msg_id="1.2")["text"] == "second"
+
+        # Newer rows of the same message are not overwritten by failed ones.
+        buffer.put(make_row("1.2", "edited", time=3))
+        assert buffer.get(master_msg_id="1.2")["time"] == 2
+    finally:
+        buffer.stop()
+
+    assert sorted((i["master_msg_id"], i["text"]) for i in batches[1]) == [("1.1", "first"), ("1.2", "edited")]
+    assert buffer.get(master_msg_id="1.1") is None
+
+
+def test_msg_log_buffer_stop_raises_on_failed_flush(monkeypatch):
+    monkeypatch.setattr(MessageLogBuffer, "STOP_ATTEMPTS", 2)
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+    attempts = []
+
+    def flush(batch):
+        attempts.append(batch)
+        raise OSError("disk I/O error")
+
+    buffer = MessageLogBuffer(flush, batch_size=100, interval=60)
+    buffer.put(make_row("1.1", "first"))
+    with raises(OSError):
+        buffer.stop()
+    assert len(attempts) == 2
+    assert buffer.get(master_msg_id="1.1")["text"] == "first"
@@ -0,0 +1,65 @@
+from efb_telegram_master.msg_log_cache import MessageLogCache
+
+
+def make_row(master_msg_id, text="text", slave_message_id=None, time=0):
+    return {"master_msg_id": master_msg_id, "slave_origin_uid": "slave.chat 1",
+            "slave_message_id": slave_message_id or f"slave_{master_msg_id}", "text": text, "time": time}
+
+
+def test_msg_log_cache_lookup_both_ways():
+    cache = MessageLogCache(10)
+    cache.put(make_row("1.1"))
+    assert cache.get(master_msg_id="1.1")["text"] == "text"
+    assert cache.get(slave_key=("slave.chat 1", "slave_1.1"))["master_msg_id"] == "1.1"
+    assert cache.get(master_msg_id="1.2") is None
+    assert cache.stats() == {"size": 1, "capacity": 10, "hits": 2, "misses": 1}
+
+    cache.discard(slave_key=("slave.chat 1", "slave_1.1"))
+    assert cache.get(master_msg_id="1.1") is None
+    assert not cache.slave_index
+
+
+def test_msg_log_cache_eviction():
+    cache = MessageLogCache(2)
+    cache.put(make_row("1.1"))
+    cache.put(make_row("1.2"))
+    cache.get(master_msg_id="1.1")
+    cache.put(make_row("1.3"))
+    assert cache.get(master_msg_id="1.2") is None
+    assert cache.get(slave_key=("slave.chat 1", "slave_1.2")) is None
+    assert cache.get(master_msg_id="1.1") is not None
+    assert cache.get(master_msg_id="1.3") is not None
+    assert len(cache.slave_index) == 2
+
+
+def test_msg_log_cache_stale_put():
+    cache = MessageLogCache(10)
+    generation = cache.generation
+    cache.discard(master_msg_id="1.1")
+    assert not cache.put(make_row("1.1", "stale"), generation)
+    assert cache.get(master_msg_id="1.1") is None
+
+    generation = cache.generation
+    assert cache.put(make_row("1.1"), generation)
+    assert cache.get(master_msg_id="1.1")["text"] == "text"
+
+
+def test_msg_log_cache_shared_slave_key():
+    """Rows sharing a slave message key are looked up as the newest one by
+    time, as from the database.
+    """
+    cache = MessageLogCache(10)
+    slave_key = ("slave.chat 1", "slave_shared")
+    cache.put(make_row("1.1", "first", "slave_shared", time=1))
+    cache.put(make_row("1.2", "second", "slave_shared", time=2))
+    # Updates keep the time of the row.
+    cache.put(make_row("1.1", "edited", "slave_shared", time=1))
+    assert cache.get(slave_key=slave_key)["master_msg_id"] == "1.2"
+
+    cache.discard(master_msg_id="1.2")
+    assert cache.get(slave_key=slave_key) is None
+
+    # Rows read by master message ID may not be the newest of their key.
+    cache.put(make_row("1.1", "edited", "slave_shared", time=1), newest=False)
+    assert cache.get(slave_key=slave_key) is None
+    assert cache.get(master_msg_id="1.1")["text"] == "edited"
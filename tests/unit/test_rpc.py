@@ -1,3 +1,5 @@
+from xmlrpc.client import dumps
+
 from pytest import fixture
 
 
@@ -8,3 +10,11 @@ def rpc(channel):
 
 def test_rpc_channels_id(rpc, coordinator):
     assert set(coordinator.slaves.keys()) == set(rpc.get_slave_channels_ids())
+
+
+def test_rpc_chat_cache_stats(rpc, channel, monkeypatch):
+    monkeypatch.setattr(channel.chat_manager, "cache_bytes", 2 ** 33)
+    stats = rpc.get_chat_cache_stats()
+    assert stats["estimated_bytes"] == 2 ** 33
+    # Integers beyond 32 bits cannot be marshalled.
+    dumps((stats,))
@@ -0,0 +1,59 @@
+import pickle
+
+from pytest import raises
+
+from ehforwarderbot.message import LocationAttribute, MessageCommands, MessageCommand
+
+from efb_telegram_master import serialization
+
+
+def test_serialization_misc_msg_round_trip():
+    data = {
+        "target": "1.1",
+        "attributes": LocationAttribute(latitude=1.5, longitude=-2.5),
+        "commands": MessageCommands([MessageCommand("Yes", "reply", args=("yes",), kwargs={"n": 1})]),
+        "substitutions": {(0, 3): "slave.chat 1"},
+        "reactions": {"👍": ("slave.chat 2",)},
+    }
+    encoded = serialization.encode_misc_msg(data)
+    assert encoded[:1] == serialization.VERSIONS[serialization.JSON]
+    decoded = serialization.decode_misc_msg(encoded)
+    assert decoded["target"] == "1.1"
+    assert decoded["attributes"].latitude == 1.5
+    assert decoded["attributes"].longitude == -2.5
+    assert decoded["commands"][0].callable_name == "reply"
+    assert decoded["commands"][0].args == ("yes",)
+    assert decoded["commands"][0].kwargs == {"n": 1}
+    assert decoded["substitutions"] == data["substitutions"]
+    assert decoded["reactions"] == data["reactions"]
+
+
+def test_serialization_trailing_defaults_omitted():
+    encoded = serialization.encode_misc_msg({"target": "1.1"})
+    assert serialization.loads(encoded) == ["1.1"]
+    assert serialization.decode_misc_msg(encoded) == {"target": "1.1"}
+
+
+def test_serialization_pickle_fallback():
+    data = {"commands": MessageCommands([MessageCommand("Custom", "reply", args=(object(),))])}
+    encoded = serialization.encode_misc_msg(data)
+    assert encoded[:1] == serialization.VERSIONS[serialization.PICKLE]
+    assert serialization.decode_misc_msg(encoded)["commands"][0].name == "Custom"
+
+
+def test_serialization_pickle_fallback_on_unencodable_values():
+    for data in ({"substitutions": {(0, 2): "slave.chat \ud800"}},
+                 {"reactions": {("not", "a string"): ["slave.chat 1"]}}):
+        encoded = serialization.encode_misc_msg(data)
+        assert encoded[:1] == serialization.VERSIONS[serialization.PICKLE]
+        assert serialization.decode_misc_msg(encoded) == data
+
+
+def test_serialization_trailing_data():
+    with raises(ValueError):
+        serialization.loads(serialization.dumps(["1.1"]) + b"garbage")
+
+
+def test_serialization_legacy_pickle():
+    data = {"target": "1.1", "is_system": True}
+    assert serialization.decode_misc_msg(pickle.dumps(data)) == data
@@ -1,10 +1,11 @@
 import re
+from datetime import datetime
 from io import BytesIO
 
 from pytest import raises
 
 from efb_telegram_master.utils import b64de, b64en, message_id_to_str, \
-    message_id_str_to_id, chat_id_str_to_id, chat_id_to_str, convert_tgs_to_gif
+    message_id_str_to_id, chat_id_str_to_id, chat_id_to_str, convert_tgs_to_gif, message_link, parse_isoformat
 
 
 def test_flag(channel):
@@ -31,6 +32,12 @@ def test_message_id_str_conversion():
         message_id_to_str(chat_id=chat_id, message_id=message_id))
 
 
+def test_message_link():
+    assert message_link(-1001234567890, 42) == "https://t.me/c/1234567890/42"
+    assert message_link(-123456789, 42) is None, "Messages in basic groups cannot be linked to"
+    assert message_link(123456789, 42) is None, "Messages in private chats cannot be linked to"
+
+
 def test_chat_id_str_conversion():
     channel_id = "__channel_id__"
     chat_id = "__chat_id__"
@@ -45,6 +52,12 @@ def test_chat_id_str_conversion():
     ), "Converting channel-chat ID with group ID"
 
 
+def test_parse_isoformat():
+    for time in (datetime(2020, 1, 2, 3, 4, 5, 678), datetime(2020, 1, 2, 3, 4, 5)):
+        assert parse_isoformat(time.isoformat()) == time
+        assert parse_isoformat(str(time)) == time
+
+
 def test_convert_tgs_to_gif():
     out = BytesIO()
     with open('tests/mocks/AnimatedSticker.tgs', 'rb') as f: